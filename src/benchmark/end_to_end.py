@@ -0,0 +1,153 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import shlex
+import sys
+import tempfile
+import time
+from typing import List
+
+from src import main as stage_generator
+from src.benchmark.fake_romfs import build_fake_romfs
+
+# Runs the whole generator on a fake romfs for a fixed set of seeds, so Generator regressions show up without game files.
+# Every seed runs in a fresh process, so caches start empty like in a real run and the peak RSS is that run's alone.
+
+DEFAULT_SEEDS = ['benchmark-0', 'benchmark-1', 'benchmark-2']
+
+# Compared against the baseline, lower is better for all of them
+REGRESSION_METRICS = ['wall_seconds', 'peak_rss_mb', 'tries_per_object']
+
+def run_seed(romfs_path: str, seed: str, generator_args: List[str], results):
+    with tempfile.TemporaryDirectory() as output_dir:
+        report_dir = os.path.join(output_dir, 'reports')
+        start = time.perf_counter()
+        stage_generator.main([
+            '-i', romfs_path,
+            '-o', os.path.join(output_dir, 'romfs'),
+            '-s', seed,
+            '--cache_dir', '', # Measure collision loading too, not a warm cache
+            '--report_dir', report_dir,
+            *generator_args])
+        wall_seconds = time.perf_counter() - start
+
+        tries, placed = 0, 0
+        for report_file in glob.glob(os.path.join(report_dir, '*.json')):
+            with open(report_file) as f:
+                report = json.load(f)
+            tries += report['tries']
+            placed += report['placed']
+
+    # ru_maxrss is in KiB on Linux, kingdom worker processes (--jobs) count as children
+    peak_rss_kib = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.put({
+        'seed': seed,
+        'wall_seconds': wall_seconds,
+        'peak_rss_mb': peak_rss_kib / 1024,
+        'tries': tries,
+        'placed': placed,
+        'tries_per_object': tries / max(placed, 1),
+    })
+
+def run_seeds(romfs_path: str, seeds: List[str], generator_args: List[str]):
+    ctx = multiprocessing.get_context('spawn')
+    runs = []
+    for seed in seeds:
+        results = ctx.Queue()
+        process = ctx.Process(target=run_seed, args=(romfs_path, seed, generator_args, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise Exception(f'Generation failed for seed {seed} with exit code {process.exitcode}')
+        run = results.get()
+        print(f'{seed:<24}{run["wall_seconds"]:>10.1f}s{run["peak_rss_mb"]:>10.0f}MB{run["tries_per_object"]:>10.1f} tries/object')
+        runs.append(run)
+    return runs
+
+def summarize(runs: List[dict]):
+    return {
+        'wall_seconds': sum(run['wall_seconds'] for run in runs) / len(runs),
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in runs),
+        'tries_per_object': sum(run['tries'] for run in runs) / max(sum(run['placed'] for run in runs), 1),
+    }
+
+def find_regressions(summary: dict, baseline_summary: dict, threshold: float):
+    """ Metrics more than threshold (a fraction) worse than the baseline, as (metric, value, baseline value) """
+    return [
+        (metric, summary[metric], baseline_summary[metric])
+        for metric in REGRESSION_METRICS
+        if metric in baseline_summary and summary[metric] > baseline_summary[metric] * (1 + threshold)
+    ]
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+                    prog='End-to-end generation benchmark',
+                    description='Generate every kingdom on a fake romfs for a fixed set of seeds and record wall time, peak RSS and jump candidates tried per placed object')
+    parser.add_argument(
+        '-i', '--input_romfs_path',
+        default=None,
+        help='Fake romfs from //src/benchmark:fake_romfs. Defaults to building one in a temporary directory'
+    )
+    parser.add_argument(
+        '--seeds',
+        nargs='+',
+        default=DEFAULT_SEEDS,
+    )
+    parser.add_argument(
+        '--generator_args',
+        default='',
+        help='Extra arguments for the generator, e.g. "--jobs 4 --collision_backend octree"'
+    )
+    parser.add_argument(
+        '--baseline',
+        default=None,
+        help='Results .json of an earlier run to compare against. Exits with an error if a metric got worse by more than --threshold'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.2,
+        help='Allowed regression against the baseline as a fraction, 0.2 fails on anything more than 20%% worse'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='Optional output .json file for the results, usable as a later --baseline'
+    )
+    return parser.parse_args(args)
+
+def main(args: List[str]):
+    args = parse_args(args)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        romfs_path = args.input_romfs_path
+        if romfs_path is None:
+            romfs_path = os.path.join(tmpdir, 'romfs')
+            build_fake_romfs(romfs_path)
+        runs = run_seeds(romfs_path, args.seeds, shlex.split(args.generator_args))
+
+    summary = summarize(runs)
+    print(f'{"summary":<24}{summary["wall_seconds"]:>10.1f}s{summary["peak_rss_mb"]:>10.0f}MB{summary["tries_per_object"]:>10.1f} tries/object')
+
+    if args.output is not None:
+        out_dir = os.path.dirname(args.output)
+        if out_dir != '':
+            os.makedirs(out_dir, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({'generator_args': args.generator_args, 'runs': runs, 'summary': summary}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline_summary = json.load(f)['summary']
+        regressions = find_regressions(summary, baseline_summary, args.threshold)
+        for metric, value, baseline_value in regressions:
+            print(f'Regression: {metric} {value:.2f} vs {baseline_value:.2f} in the baseline (+{(value/baseline_value - 1)*100:.0f}%)')
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f'No regression above {args.threshold*100:.0f}% against {args.baseline}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
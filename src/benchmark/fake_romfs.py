@@ -0,0 +1,106 @@
+import argparse
+import io
+import os
+import random
+import struct
+import sys
+from typing import List
+
+import byml
+
+from src.benchmark.synthetic import KCLWriter, box_triangles, write_szs
+from src.generator.data.kingdom_dataset import KingdomDataset
+
+# Stand-in input romfs for running the whole generator without game files. Every object is a box of a size derived from its name,
+# so the same romfs is built on every machine.
+
+# Placed by the generator and its segments on top of the kingdom dataset objects
+GENERATOR_OBJECTS = [
+    'CapWorldHomeGround001',
+    'LavaWorldBubbleLaneExKeyMoveParts000',
+    'LavaWorldHomeTimer002WobbleParts000',
+    'LavaWorldWireStep000',
+    'SandWorldHomeLift000',
+    'SandWorldHomeLift001',
+    'SandWorldHomeMeganeStep000',
+    'SandWorldHomeMeganeStep001',
+    'SeaWorldHomeSwitchKeyMoveParts000',
+    'SkyWorldHomeConveyerParts001',
+    'SkyWorldHomeRotateParts000',
+]
+
+NUM_STAGE_SCENARIOS = 15
+
+def get_object_names():
+    obj_names = set(GENERATOR_OBJECTS)
+    for kingdom_dataset in KingdomDataset.get_all_datasets():
+        obj_names.update(kingdom_dataset.get_objects())
+        obj_names.update(kingdom_dataset.get_capture_specific_objects())
+    return sorted(obj_names)
+
+def to_byml(yml):
+    f = io.BytesIO()
+    byml.Writer(yml, be=True).write(f)
+    return f.getvalue()
+
+def minimal_bfres(name: str):
+    """ BFRES header with only the file name filled in, enough for BFRES.rename """
+    name_offset = 0x40
+    header = b'FRES    ' + struct.pack('<IHBBI', 0x00050003, 0xFEFF, 0x0C, 0, name_offset)
+    header += bytes(name_offset - len(header))
+    return header + name.encode('utf-8') + bytes(0x40) # Room for a longer name after renaming
+
+def write_object(romfs_path: str, obj_name: str, object_scale: float, compress_level: int):
+    rng = random.Random(obj_name)
+    size = [rng.uniform(300, 1500), rng.uniform(100, 400), rng.uniform(300, 1500)]
+    write_szs(os.path.join(romfs_path, f'ObjectData/{obj_name}.szs'), {
+        f'{obj_name}.kcl': KCLWriter().to_bytes(box_triangles(*[v*object_scale for v in size])),
+        'InitPose.byml': to_byml({'Pose': 'TRS'}),
+        'InitClipping.byml': to_byml({'Radius': byml.byml.Float(max(size)*object_scale)}),
+    }, compress_level)
+
+def write_kingdom_stage(romfs_path: str, kingdom_dataset: KingdomDataset, compress_level: int):
+    stage_name = f'{kingdom_dataset.name()}HomeStage'
+    empty_scenarios = [{'AreaList': [], 'ObjectList': []} for _ in range(NUM_STAGE_SCENARIOS)]
+    for kind in ['Sound', 'Design']:
+        write_szs(os.path.join(romfs_path, f'StageData/{stage_name}{kind}.szs'), {f'{stage_name}{kind}.byml': to_byml(empty_scenarios)}, compress_level)
+    write_szs(os.path.join(romfs_path, f'ObjectData/CubeMap{stage_name}.szs'), {f'CubeMap{stage_name}.bfres': minimal_bfres(f'CubeMap{stage_name}')}, compress_level)
+
+def build_fake_romfs(romfs_path: str, object_scale: float = 1.0, compress_level: int = 1):
+    obj_names = get_object_names()
+    for i, obj_name in enumerate(obj_names):
+        write_object(romfs_path, obj_name, object_scale, compress_level)
+        print(f'[{i+1}/{len(obj_names)}] {obj_name}')
+    for kingdom_dataset in KingdomDataset.get_all_datasets():
+        write_kingdom_stage(romfs_path, kingdom_dataset, compress_level)
+    print(f'Fake romfs written to {romfs_path}')
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+                    prog='Fake romfs builder',
+                    description='Build a stand-in SMO romfs with a synthetic box collision for every object the generator uses, and minimal Sound, Design and CubeMap archives for every kingdom')
+    parser.add_argument(
+        '-o', '--output_romfs_path',
+        required=True,
+        help='Output directory for the fake romfs, pass it to the generator as --input_romfs_path'
+    )
+    parser.add_argument(
+        '--object_scale',
+        type=float,
+        default=1.0,
+        help='Scale of every object box. Smaller boxes leave less room to land on, which makes the jump search harder'
+    )
+    parser.add_argument(
+        '--compress_level',
+        type=int,
+        default=1,
+        help='Yaz0 compression level of the archives'
+    )
+    return parser.parse_args(args)
+
+def main(args: List[str]):
+    args = parse_args(args)
+    build_fake_romfs(args.output_romfs_path, args.object_scale, args.compress_level)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,131 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from src import sarc_tool
+from src.file_format import KCL
+from src.generator.data.kingdom_dataset import KingdomDataset
+from src.math import Vec
+
+# Compares the CGAL AABB tree backend against the KCL spatial index backend on real romfs objects
+
+def extract_kcl_files(szs_path: str, output_dir: str):
+    sarc_tool.main(['-o', output_dir, szs_path])
+    return [os.path.join(output_dir, f) for f in sorted(os.listdir(output_dir)) if f.endswith('.kcl')]
+
+def load_collision(kcl_files: List[str], backend: str):
+    collision_data = None
+    for kcl_file in kcl_files:
+        new_collision_data = KCL.get_collision_data(kcl_file, backend=backend)
+        collision_data = new_collision_data if collision_data is None else collision_data.union(new_collision_data)
+    return collision_data
+
+def random_query_points(collision: KCL.CollisionData, count: int, margin: float):
+    aabb = collision.get_aabb()
+    return [
+        Vec(*[random.uniform(aabb.minpt.get_data()[i] - margin, aabb.maxpt.get_data()[i] + margin) for i in range(3)])
+        for _ in range(count)
+    ]
+
+def benchmark_object(szs_path: str, num_queries: int, radius: float):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        kcl_files = extract_kcl_files(szs_path, tmpdir)
+        if len(kcl_files) == 0:
+            return None
+
+        results = {}
+        points = None
+        for backend in KCL.BACKENDS:
+            start = time.perf_counter()
+            collision = load_collision(kcl_files, backend)
+            # Same setup as the generator. The tree is only built on first use, build it here so it counts as loading
+            collision.merge_aabb_trees()
+            if backend == KCL.BACKEND_CGAL:
+                collision.distances(np.zeros((1, 3)))
+            load_time = time.perf_counter() - start
+
+            if points is None:
+                points = random_query_points(collision, num_queries, margin=2*radius)
+
+            start = time.perf_counter()
+            hits = [collision.intersects(p, radius) for p in points]
+            query_time = time.perf_counter() - start
+            results[backend] = (load_time, query_time, hits)
+        return results
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+                    prog='KCL collision backend benchmark',
+                    description='Time collision loading and sphere queries for each KCL backend on objects from a romfs dump')
+    parser.add_argument(
+        '-i', '--input_romfs_path',
+        required=True,
+        help='A romfs dump of SMO obtained from your copy of SMO, used for reading object collisions'
+    )
+    parser.add_argument(
+        '--objects',
+        nargs='*',
+        default=None,
+        help='Object names to benchmark. Defaults to every object in the kingdom datasets'
+    )
+    parser.add_argument(
+        '--queries',
+        type=int,
+        default=1000,
+        help='Number of random sphere queries per object'
+    )
+    parser.add_argument(
+        '--radius',
+        type=float,
+        default=180,
+        help='Query sphere radius'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+    )
+    return parser.parse_args(args)
+
+def main(args: List[str]):
+    args = parse_args(args)
+    random.seed(args.seed)
+
+    obj_names = args.objects
+    if obj_names is None:
+        obj_names = sorted({obj_name for dataset in KingdomDataset.get_all_datasets() for obj_name in dataset.get_objects()})
+
+    totals = {backend: [0.0, 0.0] for backend in KCL.BACKENDS}
+    mismatches = 0
+    print(f'{"object":<48}' + ''.join(f'{backend + " load":>14}{backend + " query":>14}' for backend in KCL.BACKENDS))
+    for obj_name in obj_names:
+        szs_path = os.path.join(args.input_romfs_path, f'ObjectData/{obj_name}.szs')
+        if not os.path.exists(szs_path):
+            continue
+        results = benchmark_object(szs_path, args.queries, args.radius)
+        if results is None:
+            continue
+
+        line = f'{obj_name:<48}'
+        for backend in KCL.BACKENDS:
+            load_time, query_time, _ = results[backend]
+            totals[backend][0] += load_time
+            totals[backend][1] += query_time
+            line += f'{load_time*1000:>12.1f}ms{query_time*1000:>12.1f}ms'
+        print(line)
+
+        reference_hits = results[KCL.BACKEND_CGAL][2]
+        for backend in KCL.BACKENDS:
+            mismatches += sum(a != b for a, b in zip(reference_hits, results[backend][2]))
+
+    print(f'{"total":<48}' + ''.join(f'{totals[backend][0]*1000:>12.1f}ms{totals[backend][1]*1000:>12.1f}ms' for backend in KCL.BACKENDS))
+    print(f'Query results differing from {KCL.BACKEND_CGAL}: {mismatches}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
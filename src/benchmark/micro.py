@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import List
+
+from src import sarc_tool
+from src import stage
+from src.benchmark.kcl_backends import extract_kcl_files, random_query_points
+from src.benchmark.synthetic import heightfield_triangles, write_collision_szs
+from src.benchmark.trajectory import random_jumps
+from src.config import GlobalConfig
+from src.file_format import KCL
+from src.generator.generator import Trajectory, MARIO_RADIUS, TRAJECTORY_COLLISION_MODES, TRAJECTORY_COLLISION_CAPSULES
+from src.math import Vec
+from src.stage.serializer import SerializerContext
+
+# Collision, archive and serialization hot paths timed on synthetic meshes, so it runs on machines without a romfs dump.
+# Every benchmark keeps the fastest of --repeat runs.
+
+class BenchmarkResults:
+
+    def __init__(self, repeat: int):
+        self.__repeat = repeat
+        self.__results = []
+
+    def run(self, name: str, num_triangles: int, count: int, func, setup=None):
+        """ Time func over count operations. setup runs untimed before every repeat and its result is passed to func. """
+        best = None
+        for _ in range(self.__repeat):
+            state = setup() if setup is not None else None
+            start = time.perf_counter()
+            func(state)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.__results.append({
+            'name': name,
+            'triangles': num_triangles,
+            'count': count,
+            'seconds': best,
+            'us_per_op': best / count * 1e6,
+        })
+        print(f'{name:<32}{num_triangles if num_triangles is not None else "":>10}{count:>8}{best*1000:>12.2f}ms{best/count*1e6:>14.1f}us/op')
+
+    def to_dict(self):
+        return {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'collision_backend': GlobalConfig.args.collision_backend,
+            'trajectory_collision': GlobalConfig.args.trajectory_collision,
+            'results': self.__results,
+        }
+
+def benchmark_collision(results: BenchmarkResults, args, romfs_dir: str, num_triangles: int):
+    obj_name = f'SyntheticTerrain{num_triangles}'
+    szs_path = os.path.join(romfs_dir, f'ObjectData/{obj_name}.szs')
+    write_collision_szs(szs_path, obj_name, heightfield_triangles(num_triangles, seed=args.seed))
+
+    def extract(tmpdir):
+        sarc_tool.main(['-o', tmpdir.name, szs_path])
+    results.run('szs_extract', num_triangles, 1, extract, setup=tempfile.TemporaryDirectory)
+
+    with tempfile.TemporaryDirectory() as extracted_dir:
+        kcl_file, = extract_kcl_files(szs_path, extracted_dir)
+
+        def pack(tmpdir):
+            sarc_tool.main(['-o', os.path.join(tmpdir.name, f'{obj_name}.szs'), '-compress', '9', extracted_dir])
+        results.run('szs_pack', num_triangles, 1, pack, setup=tempfile.TemporaryDirectory)
+
+        results.run('kcl_parse', num_triangles, 1, lambda _: KCL.get_collision_data(kcl_file, backend=GlobalConfig.args.collision_backend))
+
+        def load_collision():
+            collision = KCL.get_collision_data(kcl_file, backend=GlobalConfig.args.collision_backend)
+            collision.merge_aabb_trees()
+            return collision
+        collision = load_collision()
+
+        # The first draw finds the standable triangles, later draws only sample them
+        results.run('standable_surface_build', num_triangles, 1, lambda fresh_collision: fresh_collision.get_random_standable_pos(MARIO_RADIUS), setup=load_collision)
+
+    points = random_query_points(collision, args.queries, margin=2*MARIO_RADIUS)
+    results.run('collision_intersects', num_triangles, len(points), lambda _: [collision.intersects(p, MARIO_RADIUS) for p in points])
+
+    rng = random.Random(args.seed)
+    results.run('get_random_standable_pos', num_triangles, args.queries, lambda _: [collision.get_random_standable_pos(MARIO_RADIUS, rng=rng) for _ in range(args.queries)])
+
+    # Goes through ObjectFactory like the generator does, so collision comes from the synthetic romfs
+    obj = stage.ObjectFactory.create_fix_map_parts(obj_name, pos=Vec(0, 0, 0))
+    obj.get_collision()
+    jumps = random_jumps(collision, args.jumps)
+    results.run('trajectory_intersects_object', num_triangles, len(jumps), lambda _: [
+        Trajectory.of_mario_jump(jump).scale(scale).intersects_object(start_pos + obj.pos(), y_rotation, MARIO_RADIUS, obj)
+        for jump, scale, start_pos, y_rotation in jumps
+    ])
+
+def benchmark_serialization(results: BenchmarkResults, args):
+    scenario = stage.Scenario()
+    rng = random.Random(args.seed)
+    for i in range(args.scenario_objects):
+        # Names that are not in the romfs, so serializing never tries to update object files
+        scenario.add_object(stage.ObjectFactory.create_fix_map_parts(
+            f'SyntheticScenarioObject{i % 50}',
+            pos=Vec(rng.uniform(-20000, 20000), rng.uniform(0, 40000), rng.uniform(-20000, 20000)),
+            rot=Vec(0, rng.uniform(0, 360), 0)))
+
+    def write_map_byml(tmpdir):
+        SerializerContext(Vec(0, 0, 0)).write_map_byml(scenario, os.path.join(tmpdir.name, 'SyntheticMap.byml'))
+    results.run('scenario_write_map_byml', None, args.scenario_objects, write_map_byml, setup=tempfile.TemporaryDirectory)
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+                    prog='Synthetic microbenchmarks',
+                    description='Time KCL parsing, collision queries, standable position sampling, trajectory tests, SZS extract/pack and Map.byml serialization on generated meshes. No romfs dump needed')
+    parser.add_argument(
+        '--triangles',
+        type=int,
+        nargs='+',
+        default=[1000, 5000],
+        help='Triangle counts of the synthetic collision meshes, every collision benchmark runs once per count'
+    )
+    parser.add_argument(
+        '--queries',
+        type=int,
+        default=1000,
+        help='Number of sphere queries and standable position draws per mesh'
+    )
+    parser.add_argument(
+        '--jumps',
+        type=int,
+        default=200,
+        help='Number of random jump trajectories tested per mesh'
+    )
+    parser.add_argument(
+        '--scenario_objects',
+        type=int,
+        default=500,
+        help='Number of objects in the serialized scenario'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        '--collision_backend',
+        choices=KCL.BACKENDS,
+        default=KCL.BACKEND_CGAL,
+    )
+    parser.add_argument(
+        '--trajectory_collision',
+        choices=TRAJECTORY_COLLISION_MODES,
+        default=TRAJECTORY_COLLISION_CAPSULES,
+    )
+    parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='Optional output .json file for the results'
+    )
+    return parser.parse_args(args)
+
+def main(args: List[str]):
+    args = parse_args(args)
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as romfs_dir, tempfile.TemporaryDirectory() as output_dir:
+        GlobalConfig.args = argparse.Namespace(
+            input_romfs_path=romfs_dir,
+            output_romfs_path=output_dir,
+            cache_dir='', # Always measure loading from the archive
+            collision_backend=args.collision_backend,
+            distance_field=False,
+            trajectory_collision=args.trajectory_collision,
+        )
+        results = BenchmarkResults(args.repeat)
+        print(f'{"benchmark":<32}{"triangles":>10}{"ops":>8}{"best":>14}{"":>16}')
+        for num_triangles in args.triangles:
+            benchmark_collision(results, args, romfs_dir, num_triangles)
+        benchmark_serialization(results, args)
+
+    if args.output is not None:
+        out_dir = os.path.dirname(args.output)
+        if out_dir != '':
+            os.makedirs(out_dir, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results.to_dict(), f, indent=2)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,155 @@
+import os
+import struct
+from typing import Dict
+
+import numpy as np
+
+from src import sarc_tool
+from src.file_format.kcl import KCL, ENDIAN
+
+# Procedural collision meshes written as KCL files and SZS archives, so benchmarks run without a romfs dump
+
+def heightfield_triangles(num_triangles: int, cell_size: float = 100.0, max_height: float = 400.0, seed: int = 0):
+    """ T×3×3 corners of a square bumpy terrain with about num_triangles triangles, two per grid cell """
+    rng = np.random.default_rng(seed)
+    n = max(1, int(round(np.sqrt(num_triangles / 2))))
+    heights = rng.uniform(0, max_height, (n + 1, n + 1))
+    x, z = np.meshgrid(np.arange(n + 1) * cell_size, np.arange(n + 1) * cell_size, indexing='ij')
+    grid = np.stack([x - n*cell_size/2, heights, z - n*cell_size/2], axis=-1)
+    a, b, c, d = grid[:-1, :-1], grid[1:, :-1], grid[:-1, 1:], grid[1:, 1:]
+    # Counter-clockwise seen from above, so the faces point up
+    return np.concatenate([
+        np.stack([a, c, b], axis=-2).reshape(-1, 3, 3),
+        np.stack([b, c, d], axis=-2).reshape(-1, 3, 3),
+    ])
+
+def box_triangles(size_x: float, size_y: float, size_z: float):
+    """ 12×3×3 corners of a closed box with its top face at y=0, centered on the origin in x and z """
+    x0, x1, y0, y1, z0, z1 = -size_x/2, size_x/2, -size_y, 0.0, -size_z/2, size_z/2
+    v = np.array([[x, y, z] for x in (x0, x1) for y in (y0, y1) for z in (z0, z1)])
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    return np.array([tri for a, b, c, d in faces for tri in ([v[a], v[b], v[c]], [v[a], v[c], v[d]])])
+
+class KCLWriter:
+    """ Writes triangles in the format KCL.get_collision_data reads, including the octree spatial index """
+
+    HEADER_SIZE = 0x38
+    MODEL_HEADER_SIZE = 0x3C
+    MAX_TRIANGLES_PER_MODEL = 0xFFFF // 4 # Triangles index their 4 normals with u16, so bigger meshes are split into several models
+    ROOT_CELL_SHIFT = 9 # Root cells of 512 units
+
+    def __init__(self, max_leaf_triangles: int = 16, min_cell_shift: int = 4):
+        self.__max_leaf_triangles = max_leaf_triangles
+        self.__min_cell_shift = min_cell_shift
+
+    def to_bytes(self, corners: np.ndarray):
+        corners = np.asarray(corners, dtype=np.float64)
+        chunks = [corners[i:i + KCLWriter.MAX_TRIANGLES_PER_MODEL] for i in range(0, len(corners), KCLWriter.MAX_TRIANGLES_PER_MODEL)]
+        models = [self.__model_to_bytes(chunk) for chunk in chunks]
+
+        model_offsets = []
+        offset = KCLWriter.HEADER_SIZE + 4*len(models)
+        for model in models:
+            model_offsets.append(offset)
+            offset += len(model)
+
+        points = corners.reshape(-1, 3)
+        header = struct.pack('>I', 0x02020000)
+        header += struct.pack(ENDIAN + 'III', 0, KCLWriter.HEADER_SIZE, len(models))
+        header += struct.pack(ENDIAN + '3f3f3I', *points.min(axis=0), *points.max(axis=0), 0, 0, 0)
+        header += bytes(KCLWriter.HEADER_SIZE - len(header))
+        return header + struct.pack(ENDIAN + 'I'*len(models), *model_offsets) + b''.join(models)
+
+    def write(self, path: str, corners: np.ndarray):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes(corners))
+
+    def __model_to_bytes(self, corners: np.ndarray):
+        num_tris = len(corners)
+        v1, v2, v3 = corners[:, 0], corners[:, 1], corners[:, 2]
+        face_normals = KCLWriter.__normalized(np.cross(v2 - v1, v3 - v1))
+        # Edge normals from which the reader rebuilds the other two corners
+        normal_a = KCLWriter.__normalized(np.cross(face_normals, v3 - v1))
+        normal_b = KCLWriter.__normalized(np.cross(face_normals, v2 - v1))
+        normal_c = KCLWriter.__normalized(np.cross(face_normals, v3 - v2))
+
+        verts = v1.astype(ENDIAN + 'f4')
+        normals = np.concatenate([face_normals, normal_a, normal_b, normal_c]).astype(ENDIAN + 'f4')
+        tris = np.zeros(num_tris, dtype=KCL.TRIANGLE_DTYPE)
+        tris['length'] = np.einsum('ij,ij->i', v2 - v1, normal_c)
+        tris['vert_index'] = np.arange(num_tris)
+        tris['dir_index'] = np.arange(num_tris)
+        for i in range(3):
+            tris['normal_indices'][:, i] = (i + 1)*num_tris + np.arange(num_tris)
+        tris['global_triangle_index'] = np.arange(num_tris)
+
+        points = corners.reshape(-1, 3)
+        first_coord = np.floor(points.min(axis=0)) - 1
+        extent = np.ceil(points.max(axis=0) - first_coord) + 1
+        size = np.array([max(1 << KCLWriter.ROOT_CELL_SHIFT, 1 << int(np.ceil(np.log2(e)))) for e in extent])
+        num_root_cells = size >> KCLWriter.ROOT_CELL_SHIFT
+        x_bits, y_bits = int(np.log2(num_root_cells[0])), int(np.log2(num_root_cells[1]))
+        coord_mask = [~(int(s) - 1) & 0xFFFFFFFF for s in size]
+        spatial_index = self.__spatial_index(corners, first_coord, num_root_cells)
+
+        offset_verts = KCLWriter.MODEL_HEADER_SIZE
+        offset_normals = offset_verts + verts.nbytes
+        offset_triangles = offset_normals + normals.nbytes
+        offset_spatial_index = offset_triangles + tris.nbytes
+        header = struct.pack(ENDIAN + 'iiiif3f3I3If',
+            offset_verts, offset_normals, offset_triangles, offset_spatial_index, 0.0,
+            *first_coord, *coord_mask, KCLWriter.ROOT_CELL_SHIFT, x_bits, x_bits + y_bits, 0.0)
+        return header + verts.tobytes() + normals.tobytes() + tris.tobytes() + spatial_index
+
+    def __spatial_index(self, corners: np.ndarray, first_coord: np.ndarray, num_root_cells: np.ndarray):
+        tri_mins = corners.min(axis=1) - first_coord
+        tri_maxs = corners.max(axis=1) - first_coord
+
+        def overlapping(cell_min: np.ndarray, cell_size: int, tri_indices: np.ndarray):
+            return tri_indices[np.all((tri_maxs[tri_indices] >= cell_min) & (tri_mins[tri_indices] < cell_min + cell_size), axis=1)]
+
+        def block(cells):
+            """ Node words of the cells followed by their triangle lists and child blocks, offsets are relative to the block """
+            nodes = bytearray(4*len(cells))
+            tail = bytearray()
+            for i, (cell_min, shift, tri_indices) in enumerate(cells):
+                offset = len(nodes) + len(tail)
+                if len(tri_indices) <= self.__max_leaf_triangles or shift <= self.__min_cell_shift:
+                    struct.pack_into(ENDIAN + 'I', nodes, 4*i, KCL.SpatialIndex.LEAF_FLAG | offset)
+                    # Same layout as the game files: the leaf points at the u16 before the list
+                    tail += struct.pack(ENDIAN + 'H'*(len(tri_indices) + 2), KCL.SpatialIndex.TRIANGLE_LIST_END, *tri_indices.tolist(), KCL.SpatialIndex.TRIANGLE_LIST_END)
+                    tail += bytes(-len(tail) % 4)
+                else:
+                    struct.pack_into(ENDIAN + 'I', nodes, 4*i, offset)
+                    half = 1 << (shift - 1)
+                    children = []
+                    for child in range(8):
+                        child_min = cell_min + np.array([child & 1, (child >> 1) & 1, (child >> 2) & 1]) * half
+                        children.append((child_min, shift - 1, overlapping(child_min, half, tri_indices)))
+                    tail += block(children)
+            return bytes(nodes + tail)
+
+        all_indices = np.arange(len(corners))
+        root_cells = []
+        for z in range(num_root_cells[2]):
+            for y in range(num_root_cells[1]):
+                for x in range(num_root_cells[0]):
+                    cell_min = np.array([x, y, z]) << KCLWriter.ROOT_CELL_SHIFT
+                    root_cells.append((cell_min, KCLWriter.ROOT_CELL_SHIFT, overlapping(cell_min, 1 << KCLWriter.ROOT_CELL_SHIFT, all_indices)))
+        return block(root_cells)
+
+    @staticmethod
+    def __normalized(v: np.ndarray):
+        return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+def write_szs(output_file: str, files: Dict[str, bytes], compress_level: int = 9):
+    """ Pack files (archive path -> content) into a Yaz0 compressed SARC archive """
+    out_dir = os.path.dirname(output_file)
+    if out_dir != '':
+        os.makedirs(out_dir, exist_ok=True)
+    with open(output_file, 'wb') as f:
+        f.write(sarc_tool.build_archive(files, '>', compress_level))
+
+def write_collision_szs(output_file: str, obj_name: str, corners: np.ndarray, compress_level: int = 9):
+    """ Object archive holding only the collision, as ObjectFactory.get_collision reads it """
+    write_szs(output_file, {f'{obj_name}.kcl': KCLWriter().to_bytes(corners)}, compress_level)
@@ -0,0 +1,110 @@
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import List
+
+from src.benchmark.kcl_backends import extract_kcl_files, load_collision
+from src.file_format import KCL
+from src.generator.generator import Trajectory, MARIO_RADIUS
+from src.generator.data.jump_dataset import JumpDataset, JumpData
+from src.generator.data.kingdom_dataset import KingdomDataset
+from src.math import Vec
+
+# Points-checked-per-second of the jump trajectory collision test: per-point Vec math (how Trajectory used to work), one NumPy transform
+# feeding a batched sphere query, and the continuous capsule query over merged segments
+
+JUMP_SETS = [None, 'Pokio', 'TestCaptureBubble']
+
+def vec_trajectory_intersects(points: List[Vec], scale: float, start_pos: Vec, y_rotation: float, radius: float, collision: KCL.CollisionData):
+    points = [p - points[0] for p in points]
+    points = [p*scale for p in points]
+    for point in points:
+        if collision.intersects(start_pos + point.rotate_y(y_rotation), radius):
+            return True
+    return False
+
+def array_trajectory_intersects(jump: JumpData, scale: float, start_pos: Vec, y_rotation: float, radius: float, collision: KCL.CollisionData):
+    return collision.intersects_any(Trajectory.of_mario_jump(jump).scale(scale).world_points(start_pos, y_rotation), radius)
+
+def capsule_trajectory_intersects(jump: JumpData, scale: float, start_pos: Vec, y_rotation: float, radius: float, collision: KCL.CollisionData):
+    return collision.capsules_intersect_any(*Trajectory.of_mario_jump(jump).scale(scale).capsules(start_pos, y_rotation, radius))
+
+def random_jumps(collision: KCL.CollisionData, count: int):
+    """ (jump, scale, start pos, y rotation) taking off around the object so both hits and misses get tested """
+    jumps = [jump for jump_set in JUMP_SETS for jump in JumpDataset.get_all_jumps(jump_set)]
+    aabb = collision.get_aabb()
+    margin = 2000
+    return [
+        (
+            random.choice(jumps),
+            random.uniform(0.4, 1.1),
+            Vec(*[random.uniform(aabb.minpt.get_data()[i] - margin, aabb.maxpt.get_data()[i] + margin) for i in range(3)]),
+            random.uniform(0, 2*math.pi),
+        )
+        for _ in range(count)
+    ]
+
+def parse_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+                    prog='Trajectory collision benchmark',
+                    description='Time the jump trajectory transform and collision test on an object from a romfs dump')
+    parser.add_argument(
+        '-i', '--input_romfs_path',
+        required=True,
+        help='A romfs dump of SMO obtained from your copy of SMO, used for reading object collisions'
+    )
+    parser.add_argument(
+        '--object',
+        default=None,
+        help='Object to test the trajectories against. Defaults to the first object of the first kingdom dataset'
+    )
+    parser.add_argument(
+        '--jumps',
+        type=int,
+        default=2000,
+        help='Number of random jumps to test'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=0,
+    )
+    return parser.parse_args(args)
+
+def main(args: List[str]):
+    args = parse_args(args)
+    random.seed(args.seed)
+
+    obj_name = args.object if args.object is not None else KingdomDataset.get_all_datasets()[0].get_objects()[0]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        kcl_files = extract_kcl_files(os.path.join(args.input_romfs_path, f'ObjectData/{obj_name}.szs'), tmpdir)
+        collision = load_collision(kcl_files, KCL.BACKEND_CGAL)
+    collision.merge_aabb_trees()
+    jumps = random_jumps(collision, args.jumps)
+    num_points = sum(jump.get_point_count() for jump, _, _, _ in jumps)
+
+    results = {}
+    for name, run in [
+        ('vec', lambda jump, scale, start_pos, y_rotation: vec_trajectory_intersects(jump.get_mario_trajectory(), scale, start_pos, y_rotation, MARIO_RADIUS, collision)),
+        ('array', lambda jump, scale, start_pos, y_rotation: array_trajectory_intersects(jump, scale, start_pos, y_rotation, MARIO_RADIUS, collision)),
+        ('capsule', lambda jump, scale, start_pos, y_rotation: capsule_trajectory_intersects(jump, scale, start_pos, y_rotation, MARIO_RADIUS, collision)),
+    ]:
+        start = time.perf_counter()
+        hits = [run(*jump) for jump in jumps]
+        elapsed = time.perf_counter() - start
+        results[name] = hits
+        print(f'{name:<8}{elapsed*1000:>10.1f}ms{num_points/elapsed:>14.0f} points/s{sum(hits):>8} hits')
+
+    mismatches = sum(a != b for a, b in zip(results['vec'], results['array']))
+    # Capsules cover the spheres, so they can only add hits, e.g. thin geometry between two samples
+    missed_by_capsules = sum(a and not b for a, b in zip(results['array'], results['capsule']))
+    missed_by_spheres = sum(b and not a for a, b in zip(results['array'], results['capsule']))
+    print(f'{obj_name}: {len(jumps)} jumps, {num_points} points, vec/array results differing: {mismatches}, '
+          f'hits only found by capsules: {missed_by_spheres}, sphere hits missed by capsules: {missed_by_capsules}')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,2 +1,4 @@
 from src.file_format.bfres import BFRES        
-from src.file_format.kcl import KCL        
\ No newline at end of file
+from src.file_format.byml_writer import BymlWriter
+from src.file_format.kcl import KCL        
+from src.file_format.szs import SZS
\ No newline at end of file
@@ -10,17 +10,23 @@ class BFRES:
         input_name = os.path.basename(input_path).replace('.bfres', '')
         output_name = os.path.basename(output_path).replace('.bfres', '')
 
-        file_name_offset = None
         with open(output_path, 'rb') as file:
-            # Format spec https://mk8.tockdom.com/wiki/BFRES_(File_Format)
-            file.seek(0x14-4)
-            file_name_offset, = struct.unpack('<i', file.read(4))
+            data = file.read()
+        with open(output_path, 'wb') as file:
+            file.write(BFRES.rename_data(data, input_name, output_name))
 
-        with open(output_path, 'r+b') as file:
-            # Format spec https://mk8.tockdom.com/wiki/BFRES_(File_Format)
-            file.seek(file_name_offset)
-            file.write(bytes([0] * len(input_name))) # Clear input name
-            file.seek(file_name_offset)
-            file.write(bytes(output_name, 'UTF-8'))
+    @staticmethod
+    def rename_data(data: bytes, input_name: str, output_name: str):
+        """ BFRES file bytes with the file name changed from input_name to output_name """
+        data = bytearray(data)
+        # Format spec https://mk8.tockdom.com/wiki/BFRES_(File_Format)
+        file_name_offset, = struct.unpack_from('<i', data, 0x14-4)
+
+        def write_at(offset: int, value: bytes):
+            if len(data) < offset + len(value):
+                data.extend(bytes(offset + len(value) - len(data)))
+            data[offset:offset + len(value)] = value
 
-        
\ No newline at end of file
+        write_at(file_name_offset, bytes([0] * len(input_name))) # Clear input name
+        write_at(file_name_offset, bytes(output_name, 'UTF-8'))
+        return bytes(data)
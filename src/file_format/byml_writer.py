@@ -0,0 +1,175 @@
+import struct
+from byml.byml import NodeType, Int, Float, UInt, Int64, UInt64, Double
+
+class BymlWriter:
+    """ BYML v2 writer producing the same bytes as byml.Writer.
+        Both write structurally identical nodes once and point every reference at that offset. byml.Writer re-walks a subtree
+        for every reference and re-freezes it at every ancestor level, here every dict and list is walked and keyed once,
+        so a subtree shared by many parents (like the scenario in all 14 slots of a Map.byml) costs a single walk. """
+
+    VERSION = 2
+
+    __NODE_TYPES = {
+        str: NodeType.STRING,
+        bytes: NodeType.BINARY,
+        list: NodeType.ARRAY,
+        dict: NodeType.HASH,
+        bool: NodeType.BOOL,
+        Int: NodeType.INT,
+        Float: NodeType.FLOAT,
+        UInt: NodeType.UINT,
+        Int64: NodeType.INT64,
+        UInt64: NodeType.UINT64,
+        Double: NodeType.DOUBLE,
+        type(None): NodeType.NULL,
+    }
+
+    __VALUE_TYPES = {NodeType.STRING, NodeType.BOOL, NodeType.INT, NodeType.FLOAT, NodeType.UINT, NodeType.NULL}
+
+    def __init__(self, data, be: bool = False):
+        if not isinstance(data, list) and not isinstance(data, dict):
+            raise ValueError('Data should be a dict or a list')
+        self.__data = data
+        self.__endian = '>' if be else '<'
+        self.__be = be
+
+        self.__frozen = {} # id of every dict and list -> hashable structure, equal for structurally identical nodes
+        hash_keys, strings = set(), set()
+        self.__freeze(data, hash_keys, strings)
+        # Nintendo sorts both tables alphabetically
+        self.__hash_key_table = sorted(hash_keys)
+        self.__string_table = sorted(strings)
+        self.__hash_key_indices = {key: i for i, key in enumerate(self.__hash_key_table)}
+        self.__string_indices = {string: i for i, string in enumerate(self.__string_table)}
+
+    def get_bytes(self):
+        out = bytearray(b'BY' if self.__be else b'YB')
+        out += struct.pack(self.__endian + 'H', BymlWriter.VERSION)
+        header_offsets = len(out)
+        out += bytes(12) # Hash key table, string table and root node offsets
+
+        hash_key_table_offset = self.__write_string_table(out, self.__hash_key_table)
+        string_table_offset = self.__write_string_table(out, self.__string_table)
+        struct.pack_into(self.__endian + '3I', out, header_offsets, hash_key_table_offset, string_table_offset, len(out))
+
+        # Nintendo attempts to minimize document size by reusing nodes where possible, byml.Writer does too
+        self.__write_nonvalue_node(out, self.__data, {})
+        return bytes(out)
+
+    def write(self, stream):
+        stream.write(self.get_bytes())
+
+    def __freeze(self, data, hash_keys: set, strings: set):
+        """ Same structure as byml's _freeze_object, so nodes are shared exactly when byml.Writer would share them """
+        if isinstance(data, dict):
+            frozen = self.__frozen.get(id(data))
+            if frozen is None:
+                hash_keys.update(data.keys())
+                frozen = frozenset((key, self.__freeze(value, hash_keys, strings)) for key, value in data.items())
+                self.__frozen[id(data)] = frozen
+            return frozen
+        if isinstance(data, list):
+            frozen = self.__frozen.get(id(data))
+            if frozen is None:
+                frozen = tuple([self.__freeze(item, hash_keys, strings) for item in data])
+                self.__frozen[id(data)] = frozen
+            return frozen
+        if isinstance(data, str):
+            strings.add(data)
+        return data
+
+    def __write_string_table(self, out: bytearray, table: list):
+        """ Offset of the table, 0 for an empty table which is left out """
+        if len(table) == 0:
+            return 0
+        base = len(out)
+        encoded = [bytes(string, 'utf8') + b'\x00' for string in table]
+        out += self.__type_and_u24(NodeType.STRING_TABLE, len(table))
+        offset = 4 + 4*(len(table) + 1)
+        offsets = []
+        for string in encoded:
+            offsets.append(offset)
+            offset += len(string)
+        offsets.append(offset)
+        out += struct.pack(f'{self.__endian}{len(offsets)}I', *offsets)
+        out += b''.join(encoded)
+        out += bytes(-len(out) % 4)
+        return base
+
+    def __write_nonvalue_node(self, out: bytearray, data, node_to_offset_map: dict):
+        nonvalue_nodes = [] # (node, node type, offset of the placeholder to point at it)
+
+        if isinstance(data, list):
+            node_types = [self.__to_byml_type(item) for item in data]
+            out += self.__type_and_u24(NodeType.ARRAY, len(data))
+            out += bytes(node_types)
+            out += bytes(-len(out) % 4)
+            for item, node_type in zip(data, node_types):
+                if node_type in BymlWriter.__VALUE_TYPES:
+                    out += self.__to_byml_value(item, node_type)
+                else:
+                    nonvalue_nodes.append((item, node_type, len(out)))
+                    out += b'\xff\xff\xff\xff'
+        elif isinstance(data, dict):
+            out += self.__type_and_u24(NodeType.HASH, len(data))
+            for key in sorted(data.keys()):
+                value = data[key]
+                node_type = self.__to_byml_type(value)
+                out += self.__u24(self.__hash_key_indices[key]) + bytes([node_type])
+                if node_type in BymlWriter.__VALUE_TYPES:
+                    out += self.__to_byml_value(value, node_type)
+                else:
+                    nonvalue_nodes.append((value, node_type, len(out)))
+                    out += b'\xff\xff\xff\xff'
+        elif isinstance(data, bytes):
+            out += struct.pack(self.__endian + 'I', len(data)) + data
+        elif isinstance(data, UInt64):
+            out += struct.pack(self.__endian + 'Q', data)
+        elif isinstance(data, Int64):
+            out += struct.pack(self.__endian + 'q', data)
+        elif isinstance(data, Double):
+            out += struct.pack(self.__endian + 'd', data)
+        else:
+            raise ValueError('Invalid non-value type')
+
+        for node, node_type, placeholder_offset in nonvalue_nodes:
+            node_key = (node_type, self.__frozen[id(node)] if node_type == NodeType.ARRAY or node_type == NodeType.HASH else node)
+            node_offset = node_to_offset_map.get(node_key)
+            if node_offset is not None:
+                struct.pack_into(self.__endian + 'I', out, placeholder_offset, node_offset)
+            else:
+                struct.pack_into(self.__endian + 'I', out, placeholder_offset, len(out))
+                node_to_offset_map[node_key] = len(out)
+                self.__write_nonvalue_node(out, node, node_to_offset_map)
+
+    def __to_byml_type(self, data):
+        node_type = BymlWriter.__NODE_TYPES.get(type(data))
+        if node_type is not None:
+            return node_type
+        # Subclasses, checked in the order byml.Writer checks them
+        for data_type, node_type in BymlWriter.__NODE_TYPES.items():
+            if isinstance(data, data_type):
+                return node_type
+        if isinstance(data, int) or isinstance(data, float):
+            raise ValueError('Implicit conversions from int/float are not supported -- please use Int/Float/UInt/Int64/UInt64/Double')
+        raise ValueError('Invalid value type')
+
+    def __to_byml_value(self, value, node_type):
+        if node_type == NodeType.STRING:
+            return struct.pack(self.__endian + 'I', self.__string_indices[value])
+        if node_type == NodeType.BOOL:
+            return struct.pack(self.__endian + 'I', 1 if value != 0 else 0)
+        if node_type == NodeType.INT:
+            return struct.pack(self.__endian + 'i', value)
+        if node_type == NodeType.UINT:
+            return struct.pack(self.__endian + 'I', value)
+        if node_type == NodeType.FLOAT:
+            return struct.pack(self.__endian + 'f', value)
+        return struct.pack(self.__endian + 'I', 0) # NULL
+
+    def __type_and_u24(self, node_type, value: int):
+        return bytes([node_type]) + self.__u24(value)
+
+    def __u24(self, value: int):
+        b = struct.pack(self.__endian + 'I', value)
+        return b[1:] if self.__be else b[:-1]
@@ -1,9 +1,13 @@
+import bisect
 from functools import reduce
 import math
+import mmap
 import struct
 import random
 from typing import List
 
+import numpy as np
+
 from CGAL.CGAL_Kernel import Point_3, Triangle_3, Ray_3, Vector_3, cross_product
 from CGAL.CGAL_AABB_tree import AABB_tree_Triangle_3_soup
 
@@ -16,155 +20,790 @@ ENDIAN = '<'
 def dot(a: Vector_3, b: Vector_3):
     return a.x()*b.x() + a.y()*b.y() + a.z()*b.z()
 
+def squared_distances_to_triangles(points: np.ndarray, corners: np.ndarray):
+    """ Squared distance from each of N points (N×3) to each of T triangles (T×3×3), returned as N×T.
+        Closest point on triangle from Ericson, Real-Time Collision Detection 5.1.5 """
+    p = points[:, np.newaxis, :]
+    a, b, c = corners[np.newaxis, :, 0], corners[np.newaxis, :, 1], corners[np.newaxis, :, 2]
+    ab, ac, bc = b - a, c - a, c - b
+    ap, bp, cp = p - a, p - b, p - c
+    d1, d2 = (ab*ap).sum(-1), (ac*ap).sum(-1)
+    d3, d4 = (ab*bp).sum(-1), (ac*bp).sum(-1)
+    d5, d6 = (ab*cp).sum(-1), (ac*cp).sum(-1)
+    va, vb, vc = d3*d6 - d5*d4, d5*d2 - d1*d6, d1*d4 - d3*d2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Regions applied lowest precedence first so vertex regions win over edges, and edges over the face interior
+        denom = va + vb + vc
+        closest = a + ab*(vb/denom)[..., np.newaxis] + ac*(vc/denom)[..., np.newaxis]
+        regions = [
+            (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0), lambda: b + bc*((d4 - d3)/((d4 - d3) + (d5 - d6)))[..., np.newaxis],
+            (vb <= 0) & (d2 >= 0) & (d6 <= 0), lambda: a + ac*(d2/(d2 - d6))[..., np.newaxis],
+            (d6 >= 0) & (d5 <= d6), lambda: np.broadcast_to(c, closest.shape),
+            (vc <= 0) & (d1 >= 0) & (d3 <= 0), lambda: a + ab*(d1/(d1 - d3))[..., np.newaxis],
+            (d3 >= 0) & (d4 <= d3), lambda: np.broadcast_to(b, closest.shape),
+            (d1 <= 0) & (d2 <= 0), lambda: np.broadcast_to(a, closest.shape),
+        ]
+        for i in range(0, len(regions), 2):
+            mask, region_closest = regions[i], regions[i+1]
+            if mask.any():
+                closest = np.where(mask[..., np.newaxis], region_closest(), closest)
+
+    diff = closest - p
+    return (diff*diff).sum(-1)
+
+def squared_distances_between_segments(p1: np.ndarray, q1: np.ndarray, p2: np.ndarray, q2: np.ndarray):
+    """ Squared distance between segments p1q1 and p2q2, all arguments broadcast as (..., 3).
+        Closest points of two segments from Ericson, Real-Time Collision Detection 5.1.9 """
+    d1, d2, r = q1 - p1, q2 - p2, p1 - p2
+    a, e = (d1*d1).sum(-1), (d2*d2).sum(-1)
+    b, c, f = (d1*d2).sum(-1), (d1*r).sum(-1), (d2*r).sum(-1)
+    eps = 1e-12
+    safe_a, safe_e = np.where(a > eps, a, 1), np.where(e > eps, e, 1)
+    denom = a*e - b*b
+    # Closest point on the infinite lines, clamped to the first segment, arbitrary (0) if parallel
+    s = np.where(denom > eps*np.maximum(a*e, eps), np.clip((b*f - c*e)/np.where(denom > 0, denom, 1), 0, 1), 0)
+    t = np.where(e > eps, (b*s + f)/safe_e, 0)
+    # Clamp t and recompute s for the clamped t
+    s = np.where(t < 0, np.clip(-c/safe_a, 0, 1), np.where(t > 1, np.clip((b - c)/safe_a, 0, 1), s))
+    t = np.clip(t, 0, 1)
+    s = np.where(a > eps, s, 0)
+    t = np.where(a > eps, t, np.clip(f/safe_e, 0, 1))
+    diff = (p1 + d1*s[..., np.newaxis]) - (p2 + d2*t[..., np.newaxis])
+    return (diff*diff).sum(-1)
+
+def squared_distances_segments_to_triangles(starts: np.ndarray, ends: np.ndarray, corners: np.ndarray):
+    """ Squared distance from each of N segments (N×3 start and end points) to each of T triangles (T×3×3), returned as N×T """
+    # Segment doesn't cross the triangle: the closest pair involves a segment endpoint or a triangle edge
+    sqd = np.fmin(squared_distances_to_triangles(starts, corners), squared_distances_to_triangles(ends, corners))
+    p, q = starts[:, np.newaxis, :], ends[:, np.newaxis, :]
+    for i in range(3):
+        sqd = np.fmin(sqd, squared_distances_between_segments(p, q, corners[np.newaxis, :, i], corners[np.newaxis, :, (i+1) % 3]))
+
+    # Segment crosses the triangle plane inside the triangle
+    a, b, c = corners[np.newaxis, :, 0], corners[np.newaxis, :, 1], corners[np.newaxis, :, 2]
+    normal = np.cross(b - a, c - a)
+    dp, dq = ((p - a)*normal).sum(-1), ((q - a)*normal).sum(-1)
+    crosses_plane = (dp*dq <= 0) & (dp != dq)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = p + (q - p)*(dp/(dp - dq))[..., np.newaxis]
+        inside = np.ones(crosses_plane.shape, dtype=bool)
+        for v0, v1 in [(a, b), (b, c), (c, a)]:
+            inside &= (np.cross(v1 - v0, x - v0)*normal).sum(-1) >= 0
+    return np.where(crosses_plane & inside, 0.0, sqd)
+
+def squared_distances_to_aabbs(points: np.ndarray, mins: np.ndarray, maxs: np.ndarray):
+    """ N×M squared distances from N×3 points to M boxes given as M×3 min and max corners, 0 inside a box """
+    p = points[:, np.newaxis, :]
+    outside = np.maximum(mins[np.newaxis] - p, 0) + np.maximum(p - maxs[np.newaxis], 0)
+    return (outside*outside).sum(-1)
+
+def build_aabb_tree(corners: np.ndarray):
+    return AABB_tree_Triangle_3_soup([Triangle_3(Point_3(*v1), Point_3(*v2), Point_3(*v3)) for v1, v2, v3 in corners.tolist()])
+
+def aabb_tree_intersects_any(aabb_tree: AABB_tree_Triangle_3_soup, sphere_centers: np.ndarray, sphere_radius: float):
+    squared_radius = sphere_radius*sphere_radius
+    for point_query in [Point_3(x, y, z) for x, y, z in sphere_centers.tolist()]:
+        if aabb_tree.squared_distance(point_query) <= squared_radius:
+            return True
+    return False
+
+def aabb_tree_intersects_each(aabb_tree: AABB_tree_Triangle_3_soup, sphere_centers: np.ndarray, sphere_radius: float):
+    squared_radius = sphere_radius*sphere_radius
+    return np.array([aabb_tree.squared_distance(Point_3(x, y, z)) <= squared_radius for x, y, z in sphere_centers.tolist()], dtype=bool)
+
+def aabb_tree_distances(aabb_tree: AABB_tree_Triangle_3_soup, points: np.ndarray):
+    return np.sqrt([aabb_tree.squared_distance(Point_3(x, y, z)) for x, y, z in points.tolist()] + [0.0])[:-1]
+
+def aligned_size(size: int, alignment: int = 8):
+    return (size + alignment - 1) // alignment * alignment
+
+def write_aligned(file, data, alignment: int = 8):
+    file.write(data)
+    file.write(bytes(aligned_size(len(data), alignment) - len(data)))
+
 class KCL:
 
+    # 0x14-byte triangle record, see https://mk8.tockdom.com/wiki/KCL_(File_Format)
+    TRIANGLE_DTYPE = np.dtype([
+        ('length', ENDIAN + 'f4'),
+        ('vert_index', ENDIAN + 'u2'),
+        ('dir_index', ENDIAN + 'u2'),
+        ('normal_indices', ENDIAN + 'u2', (3,)),
+        ('collision_flags', ENDIAN + 'u2'),
+        ('global_triangle_index', ENDIAN + 'u4'),
+    ])
+
+    BACKEND_CGAL = 'cgal' # CGAL AABB tree built from the triangles on load
+    BACKEND_OCTREE = 'octree' # Walk the spatial index already stored in the KCL file, no tree construction
+    BACKENDS = [BACKEND_CGAL, BACKEND_OCTREE]
+
     @staticmethod
-    def get_collision_data(kcl_file_path: str):
+    def get_collision_data(kcl_file_path: str, backend: str = BACKEND_CGAL):
         with open(kcl_file_path, 'rb') as file:
-            # Format spec https://mk8.tockdom.com/wiki/KCL_(File_Format)
+            data = file.read()
+        return KCL.parse_collision_data(data, backend)
+
+    @staticmethod
+    def parse_collision_data(data, backend: str = BACKEND_CGAL):
+        """ Collision data from the bytes of a KCL file, any buffer works (e.g. a memoryview of an archive entry) """
+        # Format spec https://mk8.tockdom.com/wiki/KCL_(File_Format)
+
+        ## KCL File Header
+        magic_num, = struct.unpack_from('>I', data, 0)
+        assert magic_num == 0x02020000
+        octree_offset, model_offset, model_count = struct.unpack_from(ENDIAN + 'III', data, 0x04)
+        aabb = AABB(
+            minpt=Vec(*struct.unpack_from(ENDIAN + 'f'*3, data, 0x10)),
+            maxpt=Vec(*struct.unpack_from(ENDIAN + 'f'*3, data, 0x1C)))
+        coordinate_shift = Vec(*struct.unpack_from(ENDIAN + 'I'*3, data, 0x28))
+
+        model_offsets = struct.unpack_from(ENDIAN + 'I'*model_count, data, model_offset)
+
+        # Each model's spatial index runs until the next model (or the end of the file)
+        model_ends = {offset: min([o for o in model_offsets if o > offset], default=len(data)) for offset in model_offsets}
+
+        models = []
+        for base_model_offset in model_offsets:
+            models.append(KCL.__parse_model(data, base_model_offset, model_ends[base_model_offset], backend))
 
-            ## KCL File Header
-            magic_num, = struct.unpack('>I', file.read(4))
-            assert magic_num == 0x02020000
-            octree_offset, model_offset, model_count = struct.unpack(ENDIAN + 'III', file.read(4*3))
-            aabb = AABB(
-                minpt=Vec(*struct.unpack(ENDIAN + 'f'*3, file.read(4*3))),
-                maxpt=Vec(*struct.unpack(ENDIAN + 'f'*3, file.read(4*3))))
-            coordinate_shift = Vec(*struct.unpack(ENDIAN + 'I'*3, file.read(4*3)))
+        return KCL.CollisionData(models, aabb)
 
-            file.seek(model_offset+4)
+    # Compiled collision format, a flat dump of the parsed arrays that loads without any decoding:
+    #   file header, then per model: model header, verts (V×3 f4), corners (T×3×3 f4), face normals (T×3 f4),
+    #   spatial index header and the raw spatial index bytes. Every section is 8-byte aligned.
+    COMPILED_MAGIC = b'KCLC'
+    COMPILED_VERSION = 2
+    COMPILED_HEADER = struct.Struct(ENDIAN + '4sII4x6d') # magic, version, model count, collision aabb
 
-            models = []
-            for i in range(model_count):
-                models.append(KCL.__parse_model(file)) 
+    @staticmethod
+    def load_compiled(compiled_file_path: str, backend: str = BACKEND_CGAL):
+        """ Load collision data written by CollisionData.write_compiled. Arrays are views into a read-only mmap of the file. """
+        with open(compiled_file_path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, model_count, *aabb = KCL.COMPILED_HEADER.unpack_from(buffer, 0)
+        if magic != KCL.COMPILED_MAGIC or version != KCL.COMPILED_VERSION:
+            raise Exception(f'Unsupported compiled collision file: {compiled_file_path}')
+        offset = KCL.COMPILED_HEADER.size
+
+        models = []
+        for _ in range(model_count):
+            model, offset = KCL.Model.read_compiled(buffer, offset, backend)
+            models.append(model)
+
+        return KCL.CollisionData(models, AABB(Vec(*aabb[:3]), Vec(*aabb[3:])))
 
-            return KCL.CollisionData(models, aabb)
-        
     @staticmethod
-    def __parse_model(file):
-        base_model_offset = file.tell()
-        offset_verts, offset_normals, offset_triangles, offset_spatial_index = struct.unpack(ENDIAN + 'i'*4, file.read(4*4))
-        file.read(4)
-        file.read(12) # spatial grid first coordinate
-        coord_mask = Vec(*struct.unpack(ENDIAN + 'I'*3, file.read(4*3)))
-        coord_shift = Vec(*struct.unpack(ENDIAN + 'I'*3, file.read(4*3)))
-        file.read(4)
+    def __parse_model(data: bytes, base_model_offset: int, model_end: int, backend: str):
+        offset_verts, offset_normals, offset_triangles, offset_spatial_index = struct.unpack_from(ENDIAN + 'i'*4, data, base_model_offset)
+        # 0x10 prism thickness
+        spatial_grid_first_coord = Vec(*struct.unpack_from(ENDIAN + 'f'*3, data, base_model_offset + 0x14))
+        coord_mask = Vec(*struct.unpack_from(ENDIAN + 'I'*3, data, base_model_offset + 0x20))
+        coord_shift = Vec(*struct.unpack_from(ENDIAN + 'I'*3, data, base_model_offset + 0x2C))
 
         # MODEL_HEADER_SIZE = 0x3C
-        # file.seek(base_model_offset + MODEL_HEADER_SIZE)
 
-        file.seek(base_model_offset + offset_verts)
         num_verts = (offset_normals - offset_verts) // 12
-        verts = [Point_3(*struct.unpack(ENDIAN + 'f'*3, file.read(4*3))) for _ in range(num_verts)]
+        verts = np.frombuffer(data, dtype=ENDIAN + 'f4', count=num_verts*3, offset=base_model_offset + offset_verts).reshape(num_verts, 3).astype(np.float64)
 
-        file.seek(base_model_offset + offset_normals)
         num_normals = (offset_triangles - offset_normals) // 12
-        normals = [Vector_3(*struct.unpack(ENDIAN + 'f'*3, file.read(4*3))) for _ in range(num_normals)]
-
-        file.seek(base_model_offset + offset_triangles)
-        num_tris = (offset_spatial_index - offset_triangles) // 0x14
-        triangles = []
-        triangle_face_normals = []
-        for _ in range(num_tris):
-            length, = struct.unpack(ENDIAN + 'f', file.read(4))
-            vert_index, = struct.unpack(ENDIAN + 'H', file.read(2))
-            dir_index, = struct.unpack(ENDIAN + 'H', file.read(2))
-            normal_a_index, normal_b_index, normal_c_index = struct.unpack(ENDIAN + 'HHH', file.read(2*3))
-            collision_flags, = struct.unpack(ENDIAN + 'H', file.read(2))
-            global_triangle_index, = struct.unpack(ENDIAN + 'I', file.read(4))
-
-            # Conversion code from https://mk8.tockdom.com/wiki/KCL_(File_Format)
-            position = verts[vert_index]
-            direction = normals[dir_index]
-            normal_a = normals[normal_a_index]
-            normal_b = normals[normal_b_index]
-            normal_c = normals[normal_c_index]
-            cross_a  = cross_product(normal_a,direction)
-            cross_b  = cross_product(normal_b,direction)
-            v1 = position
-            v2 = position + cross_b * (length / dot(cross_b,normal_c))
-            v3 = position + cross_a * (length / dot(cross_a,normal_c))
-            
-            triangles.append(Triangle_3(v1, v2, v3))
-            triangle_face_normals.append(direction)
-
-        return KCL.Model(verts, triangles, triangle_face_normals)
-    
+        normals = np.frombuffer(data, dtype=ENDIAN + 'f4', count=num_normals*3, offset=base_model_offset + offset_normals).reshape(num_normals, 3).astype(np.float64)
+
+        num_tris = (offset_spatial_index - offset_triangles) // KCL.TRIANGLE_DTYPE.itemsize
+        tris = np.frombuffer(data, dtype=KCL.TRIANGLE_DTYPE, count=num_tris, offset=base_model_offset + offset_triangles)
+
+        corners, face_normals = KCL.__reconstruct_triangles(verts, normals, tris)
+
+        # Copied out, a view would keep the whole archive the KCL came from alive
+        spatial_index = KCL.SpatialIndex(
+            bytes(memoryview(data)[base_model_offset + offset_spatial_index:model_end]),
+            spatial_grid_first_coord, coord_mask, coord_shift)
+
+        return KCL.Model(verts, corners, face_normals, spatial_index, backend)
+
+    @staticmethod
+    def __reconstruct_triangles(verts: np.ndarray, normals: np.ndarray, tris: np.ndarray):
+        """ Batched triangle corner reconstruction, returns (T×3×3 corners, T×3 face normals). """
+        # Conversion code from https://mk8.tockdom.com/wiki/KCL_(File_Format)
+        length = tris['length'].astype(np.float64)[:, np.newaxis]
+        position = verts[tris['vert_index']]
+        direction = normals[tris['dir_index']]
+        normal_a = normals[tris['normal_indices'][:, 0]]
+        normal_b = normals[tris['normal_indices'][:, 1]]
+        normal_c = normals[tris['normal_indices'][:, 2]]
+        cross_a = np.cross(normal_a, direction)
+        cross_b = np.cross(normal_b, direction)
+        v1 = position
+        v2 = position + cross_b * (length / np.einsum('ij,ij->i', cross_b, normal_c)[:, np.newaxis])
+        v3 = position + cross_a * (length / np.einsum('ij,ij->i', cross_a, normal_c)[:, np.newaxis])
+        return np.stack([v1, v2, v3], axis=1), direction
+
+    class SpatialIndex:
+        """ Octree stored in each KCL model, used to find candidate triangles near a query box without building a tree.
+            Node layout from https://wiki.tockdom.com/wiki/KCL_(File_Format)#Spatial_Index_Section """
+
+        LEAF_FLAG = 0x80000000
+        TRIANGLE_LIST_END = 0xFFFF
+
+        def __init__(self, data: memoryview, first_coord: Vec, coord_mask: Vec, coord_shift: Vec):
+            # Node offsets are relative to their block, so the index is self-contained and can be stored on its own
+            self.__data = data
+            self.__coord_mask = coord_mask
+            self.__coord_shift = coord_shift
+            self.__first_coord = np.array(first_coord.get_data(), dtype=np.float64)
+            self.__block_shift = coord_shift.x()
+            # Root cells are indexed as (z << z_shift) | (y << y_shift) | x, so the masks give the grid extent in each axis
+            self.__root_shifts = [0, coord_shift.y(), coord_shift.z()]
+            self.__size = np.array([(~int(m) & 0xFFFFFFFF) + 1 for m in coord_mask.get_data()], dtype=np.int64)
+            self.__triangle_lists = {}
+
+        COMPILED_HEADER = struct.Struct(ENDIAN + 'I4x3d3I3I') # index size, first coord, coord mask, coord shift
+
+        def write_compiled(self, file):
+            file.write(KCL.SpatialIndex.COMPILED_HEADER.pack(len(self.__data), *self.__first_coord, *self.__coord_mask.get_data(), *self.__coord_shift.get_data()))
+            write_aligned(file, self.__data)
+
+        @staticmethod
+        def read_compiled(buffer, offset: int):
+            size, *fields = KCL.SpatialIndex.COMPILED_HEADER.unpack_from(buffer, offset)
+            offset += KCL.SpatialIndex.COMPILED_HEADER.size
+            spatial_index = KCL.SpatialIndex(memoryview(buffer)[offset:offset + size], Vec(*fields[0:3]), Vec(*fields[3:6]), Vec(*fields[6:9]))
+            return spatial_index, offset + aligned_size(size)
+
+        def query(self, minpt: np.ndarray, maxpt: np.ndarray):
+            """ Indices of all triangles in leaf cells overlapping the box [minpt, maxpt] (model space) """
+            lo = np.floor(minpt - self.__first_coord).astype(np.int64)
+            hi = np.floor(maxpt - self.__first_coord).astype(np.int64)
+            if np.any(hi < 0) or np.any(lo >= self.__size):
+                return np.empty(0, dtype=np.int64)
+            lo = np.clip(lo, 0, self.__size - 1).tolist()
+            hi = np.clip(hi, 0, self.__size - 1).tolist()
+
+            shift = self.__block_shift
+            triangle_lists = []
+            for z in range((lo[2] >> shift), (hi[2] >> shift) + 1):
+                for y in range((lo[1] >> shift), (hi[1] >> shift) + 1):
+                    for x in range((lo[0] >> shift), (hi[0] >> shift) + 1):
+                        root_index = (z << self.__root_shifts[2]) | (y << self.__root_shifts[1]) | x
+                        self.__visit(0, root_index, (x << shift, y << shift, z << shift), shift, lo, hi, triangle_lists)
+
+            if len(triangle_lists) == 0:
+                return np.empty(0, dtype=np.int64)
+            return np.unique(np.concatenate(triangle_lists))
+
+        def __visit(self, block_offset: int, index: int, cell_min, shift: int, lo: List[int], hi: List[int], triangle_lists: list):
+            node, = struct.unpack_from(ENDIAN + 'I', self.__data, block_offset + 4*index)
+            if node & KCL.SpatialIndex.LEAF_FLAG:
+                # Leaves point one u16 before their list (usually the end marker of the previous list), as read by Syroot/KclLibrary
+                triangle_lists.append(self.__get_triangle_list(block_offset + (node & ~KCL.SpatialIndex.LEAF_FLAG) + 2))
+                return
+
+            # Branch into 8 children, child index bits are (z << 2) | (y << 1) | x
+            child_block_offset = block_offset + node
+            child_shift = shift - 1
+            child_size = 1 << child_shift
+            halves = [
+                [h for h in (0, 1) if cell_min[i] + h*child_size <= hi[i] and cell_min[i] + (h+1)*child_size > lo[i]]
+                for i in range(3)
+            ]
+            for hz in halves[2]:
+                for hy in halves[1]:
+                    for hx in halves[0]:
+                        child_min = (cell_min[0] + hx*child_size, cell_min[1] + hy*child_size, cell_min[2] + hz*child_size)
+                        self.__visit(child_block_offset, (hz << 2) | (hy << 1) | hx, child_min, child_shift, lo, hi, triangle_lists)
+
+        def __get_triangle_list(self, list_offset: int):
+            if list_offset not in self.__triangle_lists:
+                indices = []
+                while True:
+                    tri_index, = struct.unpack_from(ENDIAN + 'H', self.__data, list_offset + 2*len(indices))
+                    if tri_index == KCL.SpatialIndex.TRIANGLE_LIST_END:
+                        break
+                    indices.append(tri_index)
+                self.__triangle_lists[list_offset] = np.array(indices, dtype=np.int64)
+            return self.__triangle_lists[list_offset]
 
     class Model:
 
-        def __init__(self, verts: List[Vector_3], triangles: List[Triangle_3], triangle_face_normals: List[Vector_3]):
-            self.__verts = verts
-            self.__triangles = triangles
-            self.__triangle_face_normals = triangle_face_normals
-            self.__aabb_tree = AABB_tree_Triangle_3_soup(triangles)
-            self.__aabb = AABB(
-                minpt = reduce(lambda a,b: Vec(min(a.x(), b.x()), min(a.y(), b.y()), min(a.z(), b.z())), [Vec(tri.vertex(i).x(), tri.vertex(i).y(), tri.vertex(i).z()) for tri in triangles for i in range(3)]),
-                maxpt = reduce(lambda a,b: Vec(max(a.x(), b.x()), max(a.y(), b.y()), max(a.z(), b.z())), [Vec(tri.vertex(i).x(), tri.vertex(i).y(), tri.vertex(i).z()) for tri in triangles for i in range(3)]),
-            )
+        def __init__(self, verts: np.ndarray, corners: np.ndarray, face_normals: np.ndarray, spatial_index, backend: str, aabb: AABB = None):
+            if backend not in KCL.BACKENDS:
+                raise Exception(f'Unsupported collision backend: {backend}')
+            # Contiguous float32 storage (V×3, T×3×3, T×3), CGAL objects only exist inside the AABB tree
+            self.__verts = np.asarray(verts, dtype=np.float32)
+            self.__corners = np.asarray(corners, dtype=np.float32)
+            self.__face_normals = np.asarray(face_normals, dtype=np.float32)
+            self.__spatial_index = spatial_index
+            # Sphere queries go through the AABB tree on the CGAL backend. Either way the tree is only built on first use,
+            # e.g. objects only needed for their AABB or surface positions never pay for it.
+            self.__use_aabb_tree = backend == KCL.BACKEND_CGAL
+            self.__aabb_tree = None
+            self.__on_aabb_tree_built = None
+            self.__triangle_bounds = None # Per-triangle T×3 min and max, for capsule queries
+            self.__corners64 = None # Float64 copy of the corners, for capsule queries
+            if aabb is None:
+                points = self.__corners.reshape(-1, 3)
+                aabb = AABB(minpt=Vec(points.min(axis=0).tolist()), maxpt=Vec(points.max(axis=0).tolist()))
+            self.__aabb = aabb
+
+        def get_corners(self):
+            return self.__corners
+
+        def uses_aabb_tree(self):
+            return self.__use_aabb_tree
+
+        def set_on_aabb_tree_built(self, callback):
+            self.__on_aabb_tree_built = callback
+
+        def __get_aabb_tree(self):
+            if self.__aabb_tree is None:
+                self.__aabb_tree = build_aabb_tree(self.__corners)
+                if self.__on_aabb_tree_built is not None:
+                    self.__on_aabb_tree_built()
+            return self.__aabb_tree
+
+        COMPILED_HEADER = struct.Struct(ENDIAN + 'II6d') # vert count, triangle count, model aabb
+
+        def write_compiled(self, file):
+            file.write(KCL.Model.COMPILED_HEADER.pack(len(self.__verts), len(self.__corners), *self.__aabb.minpt.get_data(), *self.__aabb.maxpt.get_data()))
+            for array in [self.__verts, self.__corners, self.__face_normals]:
+                write_aligned(file, np.ascontiguousarray(array, dtype=ENDIAN + 'f4').tobytes())
+            self.__spatial_index.write_compiled(file)
+
+        @staticmethod
+        def read_compiled(buffer, offset: int, backend: str):
+            num_verts, num_tris, *aabb = KCL.Model.COMPILED_HEADER.unpack_from(buffer, offset)
+            offset += KCL.Model.COMPILED_HEADER.size
+            arrays = []
+            for shape in [(num_verts, 3), (num_tris, 3, 3), (num_tris, 3)]:
+                count = int(np.prod(shape))
+                arrays.append(np.frombuffer(buffer, dtype=ENDIAN + 'f4', count=count, offset=offset).reshape(shape))
+                offset += aligned_size(4*count)
+            spatial_index, offset = KCL.SpatialIndex.read_compiled(buffer, offset)
+            verts, corners, face_normals = arrays
+            return KCL.Model(verts, corners, face_normals, spatial_index, backend, aabb=AABB(Vec(*aabb[:3]), Vec(*aabb[3:]))), offset
 
         def get_aabb(self):
             return self.__aabb
 
         def intersects(self, sphere_center: Vec, sphere_radius: float):
+            if not self.__use_aabb_tree:
+                return self.__intersects_spatial_index(sphere_center, sphere_radius)
             point_query = Point_3(sphere_center.x(), sphere_center.y(), sphere_center.z())
-            sqd = self.__aabb_tree.squared_distance(point_query)
+            sqd = self.__get_aabb_tree().squared_distance(point_query)
             # print(f'Distance: {math.sqrt(sqd)}')
             return math.sqrt(sqd) <= sphere_radius
 
-        def try_get_random_standable_pos(self, target_surface_normal: Vec = Vec(0, 1, 0), angle_threshold_degrees: int = 45):
-            tri_index = random.randrange(len(self.__triangles))
-            tri = self.__triangles[tri_index]
-            normal = self.__triangle_face_normals[tri_index]
+        def __intersects_spatial_index(self, sphere_center: Vec, sphere_radius: float):
+            return self.__intersects_spatial_index_point(np.array(sphere_center.get_data(), dtype=np.float64), sphere_radius)
+
+        def __intersects_spatial_index_point(self, center: np.ndarray, sphere_radius: float):
+            candidates = self.__spatial_index.query(center - sphere_radius, center + sphere_radius)
+            if len(candidates) == 0:
+                return False
+            sqd = squared_distances_to_triangles(center[np.newaxis], self.__corners[candidates])
+            return math.sqrt(np.nanmin(sqd)) <= sphere_radius
+
+        def intersects_any(self, sphere_centers: np.ndarray, sphere_radius: float):
+            """ True if a sphere of the given radius at any of the N×3 centers touches this model, stops at the first hit """
+            if not self.__use_aabb_tree:
+                return any(self.__intersects_spatial_index_point(center, sphere_radius) for center in sphere_centers)
+            return aabb_tree_intersects_any(self.__get_aabb_tree(), sphere_centers, sphere_radius)
+
+        def distances(self, points: np.ndarray):
+            """ Distance from each of the N×3 points to the closest triangle of this model """
+            # The spatial index only covers cells near the surface, so unbounded distances always need the tree
+            return aabb_tree_distances(self.__get_aabb_tree(), points)
+
+        def intersects_each(self, sphere_centers: np.ndarray, sphere_radius: float):
+            """ Per-center intersects() over N×3 sphere centers, returned as an N bool array """
+            if not self.__use_aabb_tree:
+                return np.array([self.__intersects_spatial_index_point(center, sphere_radius) for center in sphere_centers], dtype=bool)
+            return aabb_tree_intersects_each(self.__get_aabb_tree(), sphere_centers, sphere_radius)
+
+        def capsules_intersect_any(self, starts: np.ndarray, ends: np.ndarray, radii: np.ndarray):
+            """ True if any capsule (segment from starts[i] to ends[i], N×3, with radius radii[i]) touches this model.
+                Exact segment to triangle distances against the triangles whose AABB overlaps the capsule's. """
+            if self.__triangle_bounds is None:
+                self.__triangle_bounds = (self.__corners.min(axis=1), self.__corners.max(axis=1))
+                self.__corners64 = self.__corners.astype(np.float64)
+            triangle_mins, triangle_maxs = self.__triangle_bounds
+            for start, end, radius in zip(starts, ends, radii):
+                capsule_min, capsule_max = np.minimum(start, end) - radius, np.maximum(start, end) + radius
+                if self.__use_aabb_tree:
+                    candidates = np.flatnonzero(np.all((triangle_mins <= capsule_max) & (triangle_maxs >= capsule_min), axis=1))
+                else:
+                    # Only the triangles listed in the spatial index cells the capsule overlaps can touch it
+                    candidates = self.__spatial_index.query(capsule_min, capsule_max)
+                    candidates = candidates[np.all((triangle_mins[candidates] <= capsule_max) & (triangle_maxs[candidates] >= capsule_min), axis=1)]
+                if len(candidates) == 0:
+                    continue
+                sqd = squared_distances_segments_to_triangles(start[np.newaxis], end[np.newaxis], self.__corners64[candidates])
+                if np.nanmin(sqd) <= radius*radius:
+                    return True
+            return False
+
+        def get_standable_triangles(self, target_surface_normal: Vec = Vec(0, 1, 0), angle_threshold_degrees: int = 45):
+            """ Centroids, face normals and areas of the triangles facing within angle_threshold_degrees of target_surface_normal """
             # Ensure triangle is roughly flat (e.g. is not a slope/wall, is not on the underside of an object)
-            if dot(normal, Vector_3(target_surface_normal.x(), target_surface_normal.y(), target_surface_normal.z())) < math.cos(angle_threshold_degrees * math.pi / 180):
-                return None
-            pos_on_object_surface = (sum([Vec(tri.vertex(v).x(), tri.vertex(v).y(), tri.vertex(v).z()) for v in range(3)])) / 3
-            return pos_on_object_surface, normal
-        
+            is_flat = self.__face_normals @ np.array(target_surface_normal.get_data(), dtype=np.float64) >= math.cos(angle_threshold_degrees * math.pi / 180)
+            corners = self.__corners[is_flat].astype(np.float64)
+            centroids = corners.sum(axis=1) / 3
+            areas = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+            return centroids, self.__face_normals[is_flat].astype(np.float64), areas
+
         def to_obj(self, vertices: List[Vec], translation: Vec):
-            for triangle in self.__triangles:
-                for i in range(3):
-                    p = triangle.vertex(i)
-                    p = Vec(p.x(), p.y(), p.z())
-                    vertices.append(p + translation)                
-    
+            for p in self.__corners.reshape(-1, 3).tolist():
+                vertices.append(Vec(p) + translation)
+
+    class DistanceField:
+        """ Sparse voxel distance field over an object's collision in object-local space, for conservative O(1) sphere queries.
+            Space is split into bricks of BRICK_DIM^3 voxels. Bricks near the surface store the distance at every voxel center,
+            bricks further away than the band only store the distance at the brick center. """
+
+        CLEAR = 0
+        HIT = 1
+        UNKNOWN = 2
+
+        BRICK_DIM = 8
+        COARSE_BRICK = -1
+        DEFAULT_VOXEL_SIZE = 64
+        DEFAULT_BAND = 256 # Must be larger than the largest sphere radius queried (MARIO_RADIUS) for far away queries to be conclusive
+        FILE_HEADER = struct.Struct(ENDIAN + '4sI2d3d3I') # magic, fine brick count, voxel size, band, origin, brick grid dims
+        FILE_MAGIC = b'KSDF'
+
+        def __init__(self, voxel_size: float, band: float, origin: np.ndarray, brick_dims: np.ndarray, brick_distances: np.ndarray, brick_indices: np.ndarray, voxel_distances: np.ndarray):
+            self.__voxel_size = voxel_size
+            self.__band = band
+            self.__origin = origin
+            self.__brick_dims = brick_dims
+            self.__brick_distances = brick_distances # distance at each brick center
+            self.__brick_indices = brick_indices # index into voxel_distances, or COARSE_BRICK
+            self.__voxel_distances = voxel_distances # fine bricks × BRICK_DIM^3
+            brick_size = voxel_size * KCL.DistanceField.BRICK_DIM
+            # Distance is 1-Lipschitz, so a sample is off by at most the distance to the furthest point it represents
+            epsilon = 1e-3 * voxel_size
+            self.__voxel_slack = voxel_size * math.sqrt(3) / 2 + epsilon
+            self.__brick_slack = brick_size * math.sqrt(3) / 2 + epsilon
+
+        @staticmethod
+        def build(collision_data, voxel_size: float, band: float):
+            """ Sample collision_data.distances() on a brick grid covering its models padded by band """
+            brick_dim = KCL.DistanceField.BRICK_DIM
+            brick_size = voxel_size * brick_dim
+            aabb = collision_data.get_model_aabb()
+            origin = np.array(aabb.minpt.get_data(), dtype=np.float64) - band
+            extent = np.array(aabb.maxpt.get_data(), dtype=np.float64) + band - origin
+            brick_dims = np.maximum(np.ceil(extent / brick_size).astype(np.int64), 1)
+
+            brick_coords = np.stack(np.meshgrid(*[np.arange(n) for n in brick_dims], indexing='ij'), axis=-1).reshape(-1, 3)
+            brick_distances = collision_data.distances(origin + (brick_coords + 0.5) * brick_size)
+            is_fine = brick_distances - brick_size * math.sqrt(3) / 2 <= band
+
+            brick_indices = np.full(len(brick_coords), KCL.DistanceField.COARSE_BRICK, dtype=np.int32)
+            brick_indices[is_fine] = np.arange(is_fine.sum())
+            voxel_offsets = np.stack(np.meshgrid(*[np.arange(brick_dim)]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+            voxel_centers = origin + ((brick_coords[is_fine] * brick_dim)[:, np.newaxis, :] + voxel_offsets[np.newaxis] + 0.5) * voxel_size
+            voxel_distances = collision_data.distances(voxel_centers.reshape(-1, 3)).reshape(-1, brick_dim**3)
+
+            return KCL.DistanceField(voxel_size, band, origin, brick_dims, brick_distances.astype(np.float32), brick_indices, voxel_distances.astype(np.float32))
+
+        def classify(self, sphere_centers: np.ndarray, sphere_radius: float):
+            """ CLEAR, HIT or UNKNOWN for each of the N×3 sphere centers, with one radius for all or one per sphere. UNKNOWN ones need an exact query. """
+            brick_dim = KCL.DistanceField.BRICK_DIM
+            voxel_coords = np.floor((sphere_centers - self.__origin) / self.__voxel_size).astype(np.int64)
+            inside = np.all((voxel_coords >= 0) & (voxel_coords < self.__brick_dims * brick_dim), axis=1)
+            sphere_radius = np.broadcast_to(np.asarray(sphere_radius, dtype=np.float64), (len(sphere_centers),))
+            # Everything outside the grid is at least band away from the surface
+            states = np.where(self.__band > sphere_radius, KCL.DistanceField.CLEAR, KCL.DistanceField.UNKNOWN).astype(np.int8)
+
+            voxel_coords = voxel_coords[inside]
+            brick_coords = voxel_coords // brick_dim
+            brick_flat = (brick_coords[:, 0] * self.__brick_dims[1] + brick_coords[:, 1]) * self.__brick_dims[2] + brick_coords[:, 2]
+            brick_indices = self.__brick_indices[brick_flat]
+
+            # Coarse bricks only know a lower bound
+            lower = self.__brick_distances[brick_flat] - self.__brick_slack
+            upper = np.full(len(voxel_coords), np.inf)
+
+            is_fine = brick_indices != KCL.DistanceField.COARSE_BRICK
+            local = voxel_coords[is_fine] % brick_dim
+            voxel_flat = (local[:, 0] * brick_dim + local[:, 1]) * brick_dim + local[:, 2]
+            voxel_distances = self.__voxel_distances[brick_indices[is_fine], voxel_flat]
+            lower[is_fine] = voxel_distances - self.__voxel_slack
+            upper[is_fine] = voxel_distances + self.__voxel_slack
+
+            inside_states = np.full(len(voxel_coords), KCL.DistanceField.UNKNOWN, dtype=np.int8)
+            inside_states[lower > sphere_radius[inside]] = KCL.DistanceField.CLEAR
+            inside_states[upper <= sphere_radius[inside]] = KCL.DistanceField.HIT
+            states[inside] = inside_states
+            return states
+
+        def write(self, file_path: str):
+            with open(file_path, 'wb') as file:
+                file.write(KCL.DistanceField.FILE_HEADER.pack(KCL.DistanceField.FILE_MAGIC, len(self.__voxel_distances), self.__voxel_size, self.__band, *self.__origin, *self.__brick_dims))
+                for array in [self.__brick_distances, self.__brick_indices, self.__voxel_distances]:
+                    write_aligned(file, np.ascontiguousarray(array, dtype=array.dtype.newbyteorder(ENDIAN)).tobytes())
+
+        @staticmethod
+        def read(file_path: str):
+            with open(file_path, 'rb') as file:
+                buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, num_fine_bricks, voxel_size, band, *fields = KCL.DistanceField.FILE_HEADER.unpack_from(buffer, 0)
+            if magic != KCL.DistanceField.FILE_MAGIC:
+                raise Exception(f'Unsupported distance field file: {file_path}')
+            origin, brick_dims = np.array(fields[:3]), np.array(fields[3:], dtype=np.int64)
+            offset = KCL.DistanceField.FILE_HEADER.size
+            arrays = []
+            for dtype, shape in [('f4', (int(np.prod(brick_dims)),)), ('i4', (int(np.prod(brick_dims)),)), ('f4', (num_fine_bricks, KCL.DistanceField.BRICK_DIM**3))]:
+                count = int(np.prod(shape))
+                arrays.append(np.frombuffer(buffer, dtype=ENDIAN + dtype, count=count, offset=offset).reshape(shape))
+                offset += aligned_size(4*count)
+            return KCL.DistanceField(voxel_size, band, origin, brick_dims, *arrays)
+
+    class NoStandablePosError(Exception):
+        """ The object has no surface that an actor of the requested size can stand on """
+        pass
+
+    class BroadPhaseStats:
+        """ Process-wide count of sphere and capsule queries and the layer that settled each of them """
+        queries = 0
+        object_rejected = 0 # Outside the AABB of the whole object
+        distance_field_resolved = 0
+        model_rejected = 0 # Inside the object AABB but outside every model AABB
+        narrow_phase = 0 # Left for the exact triangle query
+
+        @staticmethod
+        def clear():
+            KCL.BroadPhaseStats.queries = 0
+            KCL.BroadPhaseStats.object_rejected = 0
+            KCL.BroadPhaseStats.distance_field_resolved = 0
+            KCL.BroadPhaseStats.model_rejected = 0
+            KCL.BroadPhaseStats.narrow_phase = 0
+
+        @staticmethod
+        def to_dict():
+            return {
+                'queries': KCL.BroadPhaseStats.queries,
+                'object_rejected': KCL.BroadPhaseStats.object_rejected,
+                'distance_field_resolved': KCL.BroadPhaseStats.distance_field_resolved,
+                'model_rejected': KCL.BroadPhaseStats.model_rejected,
+                'narrow_phase': KCL.BroadPhaseStats.narrow_phase,
+            }
+
     class CollisionData:
 
         def __init__(self, models, aabb: AABB):
             self.__models: List[KCL.Model] = models
             self.__aabb = aabb
+            self.__standable_surfaces = {} # (target normal, angle threshold, actor radius) -> standable surface samples
+            self.__distance_field = None
+            self.__distance_field_params = None
+            self.__merge_aabb_trees = False
+            self.__merged_aabb_tree = None
+            self.__on_aabb_tree_built = None
+            # Model AABBs as M×3 arrays so the broad phase tests all of them at once
+            self.__model_mins = np.array([model.get_aabb().minpt.get_data() for model in models], dtype=np.float64).reshape(-1, 3)
+            self.__model_maxs = np.array([model.get_aabb().maxpt.get_data() for model in models], dtype=np.float64).reshape(-1, 3)
+            self.__object_bounds = np.array([self.__model_mins.min(axis=0, initial=np.inf), self.__model_maxs.max(axis=0, initial=-np.inf)])
             # self.__aabb = reduce(lambda a,b: a.union(b), [model.get_aabb() for model in models])
 
         def get_aabb(self):
             return self.__aabb
 
+        def write_compiled(self, compiled_file_path: str):
+            """ Write this collision data in the format read by KCL.load_compiled """
+            with open(compiled_file_path, 'wb') as file:
+                file.write(KCL.COMPILED_HEADER.pack(KCL.COMPILED_MAGIC, KCL.COMPILED_VERSION, len(self.__models), *self.__aabb.minpt.get_data(), *self.__aabb.maxpt.get_data()))
+                for model in self.__models:
+                    model.write_compiled(file)
+
+        def get_model_aabb(self):
+            """ Bounds of the triangles themselves, unlike get_aabb() which is the bounds stored in the KCL header """
+            return reduce(lambda a,b: a.union(b), [model.get_aabb() for model in self.__models])
+
+        def enable_distance_field(self, voxel_size: float, band: float, distance_field = None, on_build = None):
+            """ Answer sphere queries from a DistanceField where it is conclusive. Unless one is given, it is built on the first query
+                and passed to on_build (e.g. to store it in a cache). """
+            self.__distance_field = distance_field
+            self.__distance_field_params = (voxel_size, band, on_build)
+
+        def get_distance_field(self):
+            if self.__distance_field is None and self.__distance_field_params is not None:
+                voxel_size, band, on_build = self.__distance_field_params
+                self.__distance_field = KCL.DistanceField.build(self, voxel_size, band)
+                if on_build is not None:
+                    on_build(self.__distance_field)
+            return self.__distance_field
+
+        def __broad_phase(self, sphere_centers: np.ndarray, sphere_radius: float):
+            """ State of each of the N×3 spheres after the object AABB, distance field and model AABB tests, plus the N×M mask of
+                model AABBs each sphere touches. Only UNKNOWN spheres need a narrow phase query against the masked models. """
+            stats = KCL.BroadPhaseStats
+            stats.queries += len(sphere_centers)
+            squared_radius = sphere_radius*sphere_radius
+            states = np.full(len(sphere_centers), KCL.DistanceField.CLEAR, dtype=np.int8)
+            model_mask = np.zeros((len(sphere_centers), len(self.__models)), dtype=bool)
+
+            in_object = squared_distances_to_aabbs(sphere_centers, self.__object_bounds[0:1], self.__object_bounds[1:2])[:, 0] <= squared_radius
+            stats.object_rejected += int(np.count_nonzero(~in_object))
+            if not np.any(in_object):
+                return states, model_mask
+
+            distance_field = self.get_distance_field()
+            if distance_field is None:
+                states[in_object] = KCL.DistanceField.UNKNOWN
+            else:
+                states[in_object] = distance_field.classify(sphere_centers[in_object], sphere_radius)
+                stats.distance_field_resolved += int(np.count_nonzero(states[in_object] != KCL.DistanceField.UNKNOWN))
+
+            unknown = states == KCL.DistanceField.UNKNOWN
+            model_mask[unknown] = squared_distances_to_aabbs(sphere_centers[unknown], self.__model_mins, self.__model_maxs) <= squared_radius
+            outside_models = unknown & ~model_mask.any(axis=1)
+            states[outside_models] = KCL.DistanceField.CLEAR
+            stats.model_rejected += int(np.count_nonzero(outside_models))
+            stats.narrow_phase += int(np.count_nonzero(unknown & ~outside_models))
+            return states, model_mask
+
+        def merge_aabb_trees(self):
+            """ Answer tree queries from one AABB tree over the triangles of all models instead of one tree per model """
+            self.__merge_aabb_trees = True
+
+        def set_on_aabb_tree_built(self, callback):
+            """ Called whenever an AABB tree gets built for this collision data, e.g. to record which objects needed one """
+            self.__on_aabb_tree_built = callback
+            for model in self.__models:
+                model.set_on_aabb_tree_built(callback)
+
+        def __uses_merged_aabb_tree(self):
+            return self.__merge_aabb_trees and all(model.uses_aabb_tree() for model in self.__models)
+
+        def __get_merged_aabb_tree(self):
+            if self.__merged_aabb_tree is None:
+                self.__merged_aabb_tree = build_aabb_tree(np.concatenate([model.get_corners() for model in self.__models]))
+                if self.__on_aabb_tree_built is not None:
+                    self.__on_aabb_tree_built()
+            return self.__merged_aabb_tree
+
         def union(self, other_collision_data):
-            return KCL.CollisionData(self.__models + other_collision_data.__models, self.__aabb.union(other_collision_data.__aabb))
+            collision_data = KCL.CollisionData(self.__models + other_collision_data.__models, self.__aabb.union(other_collision_data.__aabb))
+            if self.__merge_aabb_trees or other_collision_data.__merge_aabb_trees:
+                collision_data.merge_aabb_trees()
+            return collision_data
 
         def intersects(self, sphere_center: Vec, sphere_radius: float):
-            for model in self.__models:
-                if model.intersects(sphere_center, sphere_radius):
+            states, model_mask = self.__broad_phase(np.array([sphere_center.get_data()], dtype=np.float64), sphere_radius)
+            if states[0] != KCL.DistanceField.UNKNOWN:
+                return states[0] == KCL.DistanceField.HIT
+            if self.__uses_merged_aabb_tree():
+                return aabb_tree_intersects_any(self.__get_merged_aabb_tree(), np.array([sphere_center.get_data()], dtype=np.float64), sphere_radius)
+            for model, touches_model in zip(self.__models, model_mask[0]):
+                if touches_model and model.intersects(sphere_center, sphere_radius):
                     return True
             return False
+
+        def intersects_any(self, sphere_centers: np.ndarray, sphere_radius: float):
+            """ Batched intersects() over N×3 sphere centers, True as soon as any sphere touches any model """
+            sphere_centers = np.asarray(sphere_centers, dtype=np.float64).reshape(-1, 3)
+            states, model_mask = self.__broad_phase(sphere_centers, sphere_radius)
+            if np.any(states == KCL.DistanceField.HIT):
+                return True
+            unknown = states == KCL.DistanceField.UNKNOWN
+            if not np.any(unknown):
+                return False
+            if self.__uses_merged_aabb_tree():
+                return aabb_tree_intersects_any(self.__get_merged_aabb_tree(), sphere_centers[unknown], sphere_radius)
+            for i, model in enumerate(self.__models):
+                candidates = unknown & model_mask[:, i]
+                if np.any(candidates) and model.intersects_any(sphere_centers[candidates], sphere_radius):
+                    return True
+            return False
+
+        def capsules_intersect_any(self, starts: np.ndarray, ends: np.ndarray, radii):
+            """ True if any capsule (segment from starts[i] to ends[i], N×3, with one radius for all or one per capsule) touches any model.
+                Goes through the same broad phase layers as the sphere queries, counted per capsule. """
+            starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+            ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+            radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(starts),))
+            stats = KCL.BroadPhaseStats
+            stats.queries += len(starts)
+            capsule_mins, capsule_maxs = np.minimum(starts, ends) - radii[:, np.newaxis], np.maximum(starts, ends) + radii[:, np.newaxis]
+
+            in_object = np.all((capsule_mins <= self.__object_bounds[1]) & (capsule_maxs >= self.__object_bounds[0]), axis=1)
+            stats.object_rejected += int(np.count_nonzero(~in_object))
+            starts, ends, radii, capsule_mins, capsule_maxs = starts[in_object], ends[in_object], radii[in_object], capsule_mins[in_object], capsule_maxs[in_object]
+            if len(starts) == 0:
+                return False
+
+            distance_field = self.get_distance_field()
+            if distance_field is not None:
+                # A capsule is inside the sphere around its midpoint and contains the spheres at its endpoints
+                half_lengths = np.linalg.norm(ends - starts, axis=1) / 2
+                if np.any(distance_field.classify(starts, radii) == KCL.DistanceField.HIT) or np.any(distance_field.classify(ends, radii) == KCL.DistanceField.HIT):
+                    stats.distance_field_resolved += len(starts)
+                    return True
+                unknown = distance_field.classify((starts + ends) / 2, radii + half_lengths) != KCL.DistanceField.CLEAR
+                stats.distance_field_resolved += int(np.count_nonzero(~unknown))
+                starts, ends, radii, capsule_mins, capsule_maxs = starts[unknown], ends[unknown], radii[unknown], capsule_mins[unknown], capsule_maxs[unknown]
+
+            model_mask = np.all((capsule_mins[:, np.newaxis] <= self.__model_maxs[np.newaxis]) & (capsule_maxs[:, np.newaxis] >= self.__model_mins[np.newaxis]), axis=2)
+            outside_models = ~model_mask.any(axis=1)
+            stats.model_rejected += int(np.count_nonzero(outside_models))
+            stats.narrow_phase += int(np.count_nonzero(~outside_models))
+            for i, model in enumerate(self.__models):
+                candidates = model_mask[:, i]
+                if np.any(candidates) and model.capsules_intersect_any(starts[candidates], ends[candidates], radii[candidates]):
+                    return True
+            return False
+
+        def distances(self, points: np.ndarray):
+            """ Distance from each of the N×3 points to the closest triangle across all models """
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+            if self.__merge_aabb_trees:
+                return aabb_tree_distances(self.__get_merged_aabb_tree(), points)
+            return np.min([model.distances(points) for model in self.__models], axis=0)
                     
-        def get_random_standable_pos(self, sphere_radius: float, target_surface_normal: Vec = Vec(0, 1, 0), angle_threshold_degrees: int = 45):
-            """ Get a pos on this object that is standable for an actor of the given radius. """
-            for i in range(10000):
-                model = random.choice(self.__models)
-                output = model.try_get_random_standable_pos(target_surface_normal, angle_threshold_degrees)
-                if output is None:
-                    continue
-                    
-                pos_on_object_surface, normal = output
-                actor_center = pos_on_object_surface + Vec(normal.x(), normal.y(), normal.z())*(sphere_radius+1)
-                # Ensure the space is large enough for mario to stand
-                if self.intersects(actor_center, sphere_radius):
-                    continue
+        def intersects_each(self, sphere_centers: np.ndarray, sphere_radius: float):
+            """ Per-center intersects() over N×3 sphere centers, returned as an N bool array """
+            sphere_centers = np.asarray(sphere_centers, dtype=np.float64).reshape(-1, 3)
+            states, model_mask = self.__broad_phase(sphere_centers, sphere_radius)
+            hits = states == KCL.DistanceField.HIT
+            unknown = states == KCL.DistanceField.UNKNOWN
+            if self.__uses_merged_aabb_tree():
+                hits[unknown] = aabb_tree_intersects_each(self.__get_merged_aabb_tree(), sphere_centers[unknown], sphere_radius)
+                return hits
+            for i, model in enumerate(self.__models):
+                candidates = unknown & model_mask[:, i]
+                hits[candidates] = model.intersects_each(sphere_centers[candidates], sphere_radius)
+                unknown &= ~hits
+            return hits
+
+        def get_random_standable_pos(self, sphere_radius: float, target_surface_normal: Vec = Vec(0, 1, 0), angle_threshold_degrees: int = 45, rng = random):
+            """ Get a pos on this object that is standable for an actor of the given radius, drawn from rng (the random module or a random.Random). """
+            key = (tuple(target_surface_normal.get_data()), angle_threshold_degrees, sphere_radius)
+            if key not in self.__standable_surfaces:
+                self.__standable_surfaces[key] = self.__build_standable_surface(sphere_radius, target_surface_normal, angle_threshold_degrees)
+            positions, cumulative_areas = self.__standable_surfaces[key]
+            if len(positions) == 0:
+                raise KCL.NoStandablePosError('Could not find standable pos on object')
+
+            # Area weighted, so every point on the standable surface is equally likely
+            i = bisect.bisect_right(cumulative_areas, rng.random() * cumulative_areas[-1])
+            return Vec(*positions[min(i, len(positions) - 1)])
+
+        def __build_standable_surface(self, sphere_radius: float, target_surface_normal: Vec, angle_threshold_degrees: int):
+            """ Triangle centroids that face the target normal and leave room for the actor, with their cumulative areas for sampling """
+            centroids, normals, areas = [np.concatenate(arrays) for arrays in zip(*[
+                model.get_standable_triangles(target_surface_normal, angle_threshold_degrees) for model in self.__models
+            ])]
+            actor_centers = centroids + normals*(sphere_radius+1)
+            # Ensure the space is large enough for the actor to stand
+            has_clearance = ~self.intersects_each(actor_centers, sphere_radius)
+            centroids, areas = centroids[has_clearance], areas[has_clearance]
+            if len(areas) > 0 and areas.sum() <= 0:
+                areas = np.ones(len(areas)) # Only degenerate triangles left, fall back to uniform
+            return centroids.tolist(), np.cumsum(areas).tolist()
 
-                return pos_on_object_surface
-            raise Exception('Could not find standable pos on object')
-        
         def to_obj(self, vertices: List[Vec], translation: Vec):
             for model in self.__models:
                 model.to_obj(vertices, translation)
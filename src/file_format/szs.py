@@ -0,0 +1,154 @@
+import hashlib
+import multiprocessing
+import os
+from typing import Dict
+
+import libyaz0
+
+from src import sarc_tool
+from src.profiling import Trace
+
+def compress_archive(data: bytes, max_alignment: int, level: int):
+    return bytes(libyaz0.compress(data, max_alignment, level))
+
+class SZS:
+    """ SARC archives, Yaz0 compressed or not, handled in memory as a dict of archive path -> file bytes """
+
+    UNCOMPRESSED = -1 # Compress level for a plain SARC archive
+    COMPRESS_LEVELS = list(range(10)) # 0 only wraps the archive in Yaz0, 9 compresses best and slowest
+
+    class Compressor:
+        """ Compresses and writes the archives of SZS.write. With workers, archives are compressed concurrently in worker processes
+            and written as they finish, all of them by the time the compressor exits.
+            With a cache dir, compressed archives are stored under the hash of their uncompressed SARC bytes, so an unchanged archive
+            is never compressed twice. """
+
+        def __init__(self, level: int = 9, num_workers: int = 0, cache_dir: str = None):
+            self.__level = level
+            self.__num_workers = num_workers
+            self.__cache_dir = os.path.join(cache_dir, 'yaz0') if cache_dir else None
+            self.__pool = None
+            self.__pending = [] # (output path, cache key, async result) of archives being compressed
+
+        def __enter__(self):
+            if self.__num_workers > 0:
+                self.__pool = multiprocessing.Pool(self.__num_workers)
+            return self
+
+        def __exit__(self, exc_type, *args):
+            if self.__pool is None:
+                return
+            if exc_type is None:
+                self.wait()
+                self.__pool.close()
+            else:
+                self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+            self.__pending = []
+
+        def write(self, path: str, files: Dict[str, bytes]):
+            data, max_alignment = SZS.to_sarc(files)
+            if self.__level == SZS.UNCOMPRESSED:
+                SZS.write_file(path, data)
+                return
+
+            key = self.__cache_key(data, max_alignment)
+            compressed = self.__load_cached(key)
+            if compressed is not None:
+                SZS.write_file(path, compressed)
+            elif self.__pool is not None:
+                self.__pending.append((path, key, self.__pool.apply_async(compress_archive, (data, max_alignment, self.__level))))
+                self.__write_finished()
+            else:
+                with Trace.span('yaz0_compress', archive=path, level=self.__level, uncompressed_bytes=len(data)):
+                    compressed = compress_archive(data, max_alignment, self.__level)
+                self.__store(path, key, compressed)
+
+        def wait(self):
+            """ Wait for all archives given to write so far to be written """
+            with Trace.span('yaz0_compress_wait', archives=len(self.__pending)):
+                for path, key, result in self.__pending:
+                    self.__store(path, key, result.get())
+            self.__pending = []
+
+        def __write_finished(self):
+            pending = []
+            for path, key, result in self.__pending:
+                if result.ready():
+                    self.__store(path, key, result.get())
+                else:
+                    pending.append((path, key, result))
+            self.__pending = pending
+
+        def __store(self, path: str, key: str, compressed: bytes):
+            SZS.write_file(path, compressed)
+            if self.__cache_dir is not None:
+                SZS.write_file(self.__cache_path(key), compressed)
+
+        def __cache_key(self, data: bytes, max_alignment: int):
+            if self.__cache_dir is None:
+                return None
+            return f'{hashlib.sha256(data).hexdigest()}-{max_alignment}-{self.__level}'
+
+        def __cache_path(self, key: str):
+            return os.path.join(self.__cache_dir, f'{key}.szs')
+
+        def __load_cached(self, key: str):
+            if key is None or not os.path.exists(self.__cache_path(key)):
+                return None
+            with open(self.__cache_path(key), 'rb') as f:
+                return f.read()
+
+    __COMPRESSOR = None
+
+    @staticmethod
+    def set_compressor(compressor):
+        """ Compressor used by SZS.write, None for the default (level 9, in this process, no cache) """
+        SZS.__COMPRESSOR = compressor
+
+    @staticmethod
+    def get_compressor():
+        if SZS.__COMPRESSOR is None:
+            SZS.__COMPRESSOR = SZS.Compressor()
+        return SZS.__COMPRESSOR
+
+    @staticmethod
+    def read(path: str) -> Dict[str, bytes]:
+        with sarc_tool.open_archive(path) as archive:
+            return {name: bytes(data) for name, data in archive.iter_entries()}
+
+    @staticmethod
+    def from_bytes(data: bytes) -> Dict[str, bytes]:
+        while libyaz0.IsYazCompressed(data):
+            data = libyaz0.decompress(data)
+        with sarc_tool.Archive(data) as archive:
+            return {name: bytes(data) for name, data in archive.iter_entries()}
+
+    @staticmethod
+    def to_sarc(files: Dict[str, bytes], endianness: str = '>'):
+        """ Uncompressed SARC bytes and the largest file alignment in them. Same bytes as packing the files from a directory with sarc_tool """
+        return sarc_tool.build_sarc(files, endianness)
+
+    @staticmethod
+    def to_bytes(files: Dict[str, bytes], compress_level: int = 9, endianness: str = '>') -> bytes:
+        data, max_alignment = SZS.to_sarc(files, endianness)
+        if compress_level == SZS.UNCOMPRESSED:
+            return data
+        return compress_archive(data, max_alignment, compress_level)
+
+    @staticmethod
+    def write(path: str, files: Dict[str, bytes]):
+        """ Compress and write with the compressor set by SZS.set_compressor. With compression workers, the file is written later """
+        SZS.get_compressor().write(path, files)
+
+    @staticmethod
+    def write_file(path: str, data: bytes):
+        """ Written to a temp file first, so processes reading the file never see a partial one """
+        out_dir = os.path.dirname(path)
+        if out_dir != '':
+            os.makedirs(out_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
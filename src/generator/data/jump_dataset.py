@@ -1,17 +1,24 @@
 import os
 from typing import List
+import numpy as np
 import yaml
 from google.protobuf import json_format
 from src.generator.data.proto import jump_metadata_pb2
-from src.math import Vec
+from src.math import AABB, Vec
 
 class JumpData:
 
-    def __init__(self, name: str, metadata_pb: jump_metadata_pb2.JumpMetadata, mario_trajectory: List[Vec], cappy_trajectory: List[Vec]):
+    def __init__(self, name: str, metadata_pb: jump_metadata_pb2.JumpMetadata, mario_trajectory: np.ndarray, cappy_trajectory: np.ndarray):
         self.__name = name
         self.__metadata_pb = metadata_pb
-        self.__mario_trajectory = mario_trajectory
-        self.__cappy_trajectory = cappy_trajectory
+        # N×3 points as recorded, the derived values below are relative to the first point like in generator.Trajectory
+        self.__mario_points = np.asarray(mario_trajectory, dtype=np.float64).reshape(-1, 3)
+        self.__cappy_points = np.asarray(cappy_trajectory, dtype=np.float64).reshape(-1, 3)
+        self.__mario_trajectory = [Vec(*p) for p in self.__mario_points.tolist()]
+        self.__cappy_trajectory = [Vec(*p) for p in self.__cappy_points.tolist()]
+        local_mario_points = self.__mario_points - self.__mario_points[0]
+        self.__mario_endpoint = Vec(*local_mario_points[-1].tolist())
+        self.__mario_aabb = AABB(Vec(local_mario_points.min(axis=0).tolist()), Vec(local_mario_points.max(axis=0).tolist()))
 
     def name(self):
         return self.__name
@@ -28,6 +35,23 @@ class JumpData:
     def get_cappy_trajectory(self):
         return self.__cappy_trajectory
 
+    def get_mario_points(self):
+        return self.__mario_points
+
+    def get_cappy_points(self):
+        return self.__cappy_points
+
+    def get_point_count(self):
+        return len(self.__mario_points)
+
+    def get_mario_endpoint(self):
+        """ Landing point relative to the take-off point, before scaling and rotation """
+        return self.__mario_endpoint
+
+    def get_mario_aabb(self):
+        """ Bounds of the mario trajectory relative to the take-off point, before scaling and rotation """
+        return self.__mario_aabb
+
     @staticmethod
     def from_data_dir(name: str, dir: str):
         metadata_pb = jump_metadata_pb2.JumpMetadata()
@@ -45,22 +69,30 @@ class JumpData:
         
     @staticmethod
     def __parse_trajectory(filepath: str):
-        trajectory: List[Vec] = []
+        trajectory: List[List[float]] = []
         with open(filepath) as obj_file:
             lines = obj_file.read().split('\n')
             for line in lines:
                 split = line.split(' ')
                 if len(split) >= 4 and split[0] == 'v':
                     [x, y, z] = split[1:4]
-                    trajectory.append(Vec(float(x), float(y), float(z)))
-        return trajectory
+                    trajectory.append([float(x), float(y), float(z)])
+        return np.array(trajectory, dtype=np.float64).reshape(-1, 3)
 
 
 class JumpDataset:
 
+    __JUMP_CACHE = {} # capture type folder -> jumps, loaded once per process
+
     @staticmethod
     def get_all_jumps(capture_type: str = None):
         folder_name = 'Mario' if capture_type is None else capture_type
+        if folder_name not in JumpDataset.__JUMP_CACHE:
+            JumpDataset.__JUMP_CACHE[folder_name] = JumpDataset.__load_jumps(folder_name)
+        return JumpDataset.__JUMP_CACHE[folder_name]
+
+    @staticmethod
+    def __load_jumps(folder_name: str):
         jumps = []
         base_dir = os.path.join('src/generator/data/jumps/', folder_name)
         for jump_folder in os.listdir(base_dir):
@@ -68,4 +100,4 @@ class JumpDataset:
                 jump_folder,
                 os.path.join(base_dir, jump_folder))
             jumps.append(jump)
-        return jumps
\ No newline at end of file
+        return tuple(jumps) # Shared by every caller, so it must not be mutated
\ No newline at end of file
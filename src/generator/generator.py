@@ -1,36 +1,114 @@
+import contextlib
 from functools import reduce
 import math
+import multiprocessing
 import random
+import time
 from typing import List
+import numpy as np
 from src.generator.data.kingdom_dataset import KingdomDataset
 from src.generator.data.jump_dataset import JumpDataset, JumpData
+from src.generator.placement_index import PlacementIndex
+from src.generator.metrics import GenerationMetrics
+from src.file_format import KCL
 from src import stage
-from src.math import Vec
+from src.math import AABB, Vec
 from src.config import GlobalConfig
+from src.profiling import Trace
+
+TRAJECTORY_COLLISION_CAPSULES = 'capsules'
+TRAJECTORY_COLLISION_SPHERES = 'spheres'
+TRAJECTORY_COLLISION_MODES = [TRAJECTORY_COLLISION_CAPSULES, TRAJECTORY_COLLISION_SPHERES]
 
 class Trajectory:
 
-    def __init__(self, points: List[Vec]):
-        self.__points = points
-        if self.__points[0] != Vec(0,0,0):
-            # Translate so jump trajectory starts at the origin
-            self.__points = [p - self.__points[0] for p in self.__points]
+    CAPSULE_MERGE_TOLERANCE = 10 # Max distance of a merged sample from its capsule's axis, in unscaled trajectory units
+
+    __MARIO_TRAJECTORY_CACHE = {} # JumpData -> unscaled Trajectory, so capsule merging runs once per jump
+
+    @staticmethod
+    def of_mario_jump(jump: JumpData):
+        if jump not in Trajectory.__MARIO_TRAJECTORY_CACHE:
+            trajectory = Trajectory(jump.get_mario_points())
+            trajectory.__get_capsules() # Inherited by every scaled copy
+            Trajectory.__MARIO_TRAJECTORY_CACHE[jump] = trajectory
+        return Trajectory.__MARIO_TRAJECTORY_CACHE[jump]
+
+    def __init__(self, points, capsules = None):
+        # N×3 array relative to the first point, transformed as a whole instead of one Vec per point
+        if not isinstance(points, np.ndarray):
+            points = [p.get_data() for p in points]
+        self.__points = np.array(points, dtype=np.float64).reshape(-1, 3)
+        # Translate so jump trajectory starts at the origin
+        self.__points -= self.__points[0]
+        self.__capsules = capsules # (indices of the points kept as capsule endpoints, per capsule deviation of the merged samples)
 
     def endpoint(self):
-        return self.__points[-1]
+        return Vec(*self.__points[-1].tolist())
     
     def scale(self, scale: float):
-        return Trajectory([p*scale for p in self.__points])
+        capsules = None
+        if self.__capsules is not None:
+            breaks, deviations = self.__capsules
+            capsules = (breaks, deviations*scale)
+        return Trajectory(self.__points*scale, capsules=capsules)
+
+    def world_points(self, start_pos: Vec, y_rotation: float):
+        """ Points rotated around Y and moved to start_pos, same math as start_pos + point.rotate_y(y_rotation) """
+        c, s = math.cos(y_rotation), math.sin(y_rotation)
+        x, y, z = self.__points[:, 0], self.__points[:, 1], self.__points[:, 2]
+        return np.stack([c*x + s*z, y, -s*x + c*z], axis=1) + start_pos.get_data()
+
+    def capsules(self, start_pos: Vec, y_rotation: float, radius: float):
+        """ Start points, end points and radii of capsules covering the path between the samples. Nearly collinear runs of samples
+            are merged into one capsule, widened by how far the merged samples are from its axis. """
+        breaks, deviations = self.__get_capsules()
+        points = self.world_points(start_pos, y_rotation)
+        return points[breaks[:-1]], points[breaks[1:]], radius + deviations
+
+    def __get_capsules(self):
+        if self.__capsules is None:
+            self.__capsules = Trajectory.__merge_collinear_segments(self.__points, Trajectory.CAPSULE_MERGE_TOLERANCE)
+        return self.__capsules
+
+    @staticmethod
+    def __merge_collinear_segments(points: np.ndarray, tolerance: float):
+        """ Greedily extend each capsule over the following samples while all samples it skips stay within tolerance of its axis """
+        def max_deviation(i: int, j: int):
+            a, ab, skipped = points[i], points[j] - points[i], points[i+1:j]
+            t = np.clip(((skipped - a) @ ab) / max(ab @ ab, 1e-12), 0, 1)
+            return float(np.linalg.norm(a + t[:, np.newaxis]*ab - skipped, axis=1).max(initial=0))
+
+        breaks, deviations = [0], []
+        i = 0
+        while i < len(points) - 1:
+            j, deviation = i + 1, 0.0
+            while j + 1 < len(points):
+                next_deviation = max_deviation(i, j + 1)
+                if next_deviation > tolerance:
+                    break
+                j, deviation = j + 1, next_deviation
+            breaks.append(j)
+            deviations.append(deviation)
+            i = j
+        if len(deviations) == 0: # Single sample, one zero length capsule
+            breaks.append(0)
+            deviations.append(0.0)
+        return np.array(breaks), np.array(deviations)
     
     def intersects_object(self, start_pos: Vec, y_rotation: float, radius: float, obj: stage.Object):
-        for point in self.__points:
-            p = start_pos + point.rotate_y(y_rotation)
-            if obj.test_collision(p, radius):
-                return True
-        return False
+        if GlobalConfig.args.trajectory_collision == TRAJECTORY_COLLISION_SPHERES:
+            return obj.test_collision_any(self.world_points(start_pos, y_rotation), radius)
+        return obj.test_collision_capsules(*self.capsules(start_pos, y_rotation, radius))
+
+    def swept_aabb(self, start_pos: Vec, y_rotation: float, radius: float):
+        """ World AABB of the spheres and capsules along this trajectory """
+        sphere_centers = self.world_points(start_pos, y_rotation)
+        radius += self.__get_capsules()[1].max()
+        return AABB(Vec((sphere_centers.min(axis=0) - radius).tolist()), Vec((sphere_centers.max(axis=0) + radius).tolist()))
     
     def points(self):
-        return self.__points
+        return [Vec(*p) for p in self.__points.tolist()]
 
 MARIO_RADIUS = 180
 CAPPY_RADIUS = 90
@@ -45,25 +123,42 @@ class Jump:
         self.__y_rotation = y_rotation
         self.__jump_start_pos = jump_start_pos
 
-    def is_possible(self, objs: List[stage.Object], jumps):
+    def get_rejection(self, objs: List[stage.Object], jumps, placement_index: PlacementIndex):
+        """ Why this jump is impossible among the placed objects and jumps, a GenerationMetrics.REJECTED_* reason, or None if it's possible """
+        return self.get_rejection_among(*self.get_nearby(objs, jumps, placement_index))
+
+    def get_nearby(self, objs: List[stage.Object], jumps, placement_index: PlacementIndex):
+        """ The placed objects near this jump's path and the earlier jumps near its new object, the only ones that can make it impossible """
+        return [objs[i][0] for i in placement_index.objects_near(self.swept_aabb())], [jumps[i] for i in placement_index.jumps_near(self.__obj2.collision_aabb())]
+
+    def get_rejection_among(self, nearby_objs: List[stage.Object], nearby_jumps):
         # check this jump doesn't intersect any objects in the list
-        for obj in objs:
-            if self.intersects_object(obj[0]):
-                print(f"Intersected with on: {obj[0].name()}")
-                return False
+        for obj in nearby_objs:
+            if self.intersects_object(obj):
+                return GenerationMetrics.REJECTED_TRAJECTORY_HIT_OBJECT
             
         # check new object (self.__obj2) doesn't intersect and of the existing jumps
         new_obj = self.__obj2
-        for jump in jumps:
+        for jump in nearby_jumps:
             if jump.intersects_object(new_obj):
-                return False
+                return GenerationMetrics.REJECTED_OBJECT_HIT_JUMP
         
-        return True
+        return None
+
+    def detached(self):
+        """ Copy that only keeps the collision of its objects, cheap to send to a worker process """
+        return Jump(self.__obj1.placed_collision(), self.__obj2.placed_collision(), self.__jump_start_pos, self.__y_rotation, self.__mario_trajectory, self.__cappy_trajectory)
 
     def intersects_object(self, obj: stage.Object):
         return self.__mario_trajectory.intersects_object(self.__jump_start_pos + Vec(0, stage.Object.Y_OFFSET, 0), self.__y_rotation, MARIO_RADIUS, obj) and \
                self.__cappy_trajectory.intersects_object(self.__jump_start_pos + Vec(0, stage.Object.Y_OFFSET, 0), self.__y_rotation, CAPPY_RADIUS, obj)
 
+    def swept_aabb(self):
+        """ World AABB of everything this jump can collide with """
+        start_pos = self.__jump_start_pos + Vec(0, stage.Object.Y_OFFSET, 0)
+        return self.__mario_trajectory.swept_aabb(start_pos, self.__y_rotation, MARIO_RADIUS).union(
+            self.__cappy_trajectory.swept_aabb(start_pos, self.__y_rotation, CAPPY_RADIUS))
+
 
     def add_debug_viz(self, scenario: stage.Scenario):
         pass
@@ -73,6 +168,61 @@ class Jump:
         #                                                              debug_links=[self.__obj1, self.__obj2]))
 
 
+def init_candidate_worker(args):
+    GlobalConfig.args = args
+
+def check_jump_candidate(candidate):
+    jump, nearby_objs, nearby_jumps = candidate
+    return jump.get_rejection_among(nearby_objs, nearby_jumps)
+
+class CandidateEvaluator:
+    """ Runs the feasibility check of jump candidates, in this process or batched over worker processes that keep their own warm
+        collision caches. Either way the result is the lowest-index feasible candidate, so the stage doesn't depend on the batching. """
+
+    def __init__(self, num_workers: int, batch_size: int):
+        self.__num_workers = num_workers
+        self.__batch_size = batch_size if num_workers > 0 else 1 # In process, candidates are created one at a time so none are wasted
+        self.__pool = None
+
+    def __enter__(self):
+        if self.__num_workers > 0:
+            self.__pool = multiprocessing.Pool(self.__num_workers, initializer=init_candidate_worker, initargs=(GlobalConfig.args,))
+        return self
+
+    def __exit__(self, *args):
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool = None
+
+    def batch_size(self):
+        return self.__batch_size
+
+    def first_feasible(self, jumps: List[Jump], objs: List[stage.Object], placed_jumps: List[Jump], placement_index: PlacementIndex):
+        """ Index of the first jump that is possible (None for none) and the rejection reason of every jump that was checked, by index.
+            Entries may be None for candidates that were dropped early. """
+        rejections = {}
+        if self.__pool is None:
+            for i, jump in enumerate(jumps):
+                if jump is None:
+                    continue
+                rejections[i] = jump.get_rejection(objs, placed_jumps, placement_index)
+                if rejections[i] is None:
+                    return i, rejections
+            return None, rejections
+
+        indices, candidates = [], []
+        for i, jump in enumerate(jumps):
+            if jump is None:
+                continue
+            nearby_objs, nearby_jumps = jump.get_nearby(objs, placed_jumps, placement_index)
+            indices.append(i)
+            candidates.append((jump.detached(), [obj.placed_collision() for obj in nearby_objs], [nearby_jump.detached() for nearby_jump in nearby_jumps]))
+        rejections = dict(zip(indices, self.__pool.map(check_jump_candidate, candidates)))
+        for i in indices:
+            if rejections[i] is None:
+                return i, rejections
+        return None, rejections
+
 class SegmentBase:
 
     def __init__(self, num_objects: int, kingdom_dataset: KingdomDataset):
@@ -91,29 +241,32 @@ class SegmentBase:
     def is_done(self):
         return self.__num_objs_remaining <= 0
         
-    def get_random_object_name(self):
-        return random.choice(self.object_set())
+    # Methods taking rng draw from it instead of the global random state, so each jump candidate can have its own stream.
+    # rng is the random module or a random.Random.
+
+    def get_random_object_name(self, rng = random):
+        return rng.choice(self.object_set())
         
-    def get_random_jump(self):
-        return random.choice(self.jump_set())    
-    def get_jump_scale(self, jump_name):
-        if random.random() < 1/5:
-            return random.uniform(0.8, 1.1)
+    def get_random_jump(self, rng = random):
+        return rng.choice(self.jump_set())    
+    def get_jump_scale(self, jump_name, rng = random):
+        if rng.random() < 1/5:
+            return rng.uniform(0.8, 1.1)
         else:
-            return random.uniform(0.4, 0.9)
+            return rng.uniform(0.4, 0.9)
         
-    def get_random_jump_y_rotation(self):
-        return random.uniform(0, 2*math.pi)
+    def get_random_jump_y_rotation(self, rng = random):
+        return rng.uniform(0, 2*math.pi)
         
-    def get_entry_pos_on_obj_surface(self, obj_name: str, collision):
-        return self.__get_standable_pos_on_obj_surface(collision), Vec(0, 1, 0)
+    def get_entry_pos_on_obj_surface(self, obj_name: str, collision, rng = random):
+        return self.__get_standable_pos_on_obj_surface(collision, rng), Vec(0, 1, 0)
 
-    def get_exit_pos_on_obj_surface(self, obj_name: str, collision):
-        return self.__get_standable_pos_on_obj_surface(collision)
+    def get_exit_pos_on_obj_surface(self, obj_name: str, collision, rng = random):
+        return self.__get_standable_pos_on_obj_surface(collision, rng)
 
-    def __get_standable_pos_on_obj_surface(self, collision):
+    def __get_standable_pos_on_obj_surface(self, collision, rng):
         # Returns pos on obj surface in local obj space (relative to obj origin)
-        return collision.get_random_standable_pos(MARIO_RADIUS)
+        return collision.get_random_standable_pos(MARIO_RADIUS, rng=rng)
 
     def object_set(self):
         pass
@@ -121,7 +274,16 @@ class SegmentBase:
     def jump_set(self):
         pass
 
-    def create_object(self, obj_name: str, pos: Vec):
+    def create_object(self, obj_name: str, pos: Vec, rng = random):
+        pass
+
+    def on_objects_placed(self, objs: List[stage.Object]):
+        # Called once the objects returned by create_object are accepted into the stage. create_object also runs for rejected candidates,
+        # so anything that links the new objects into the stage belongs here.
+        pass
+
+    def on_objects_removed(self, objs: List[stage.Object]):
+        # Called when the generator backtracks over objects passed to on_objects_placed, undoes what it linked
         pass
 
     def initial_objects(self, segment_start_pos: Vec):
@@ -140,14 +302,14 @@ class DefaultSegment(SegmentBase):
     def jump_set(self):
         return JumpDataset.get_all_jumps(capture_type=None)
     
-    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec):
-        if self.__allow_moving_objects and (not is_last_obj) and random.uniform(0,1) < 0.4 and (prev_obj.get_parameter_config_name() != 'KeyMoveMapParts') and \
+    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec, rng = random):
+        if self.__allow_moving_objects and (not is_last_obj) and rng.uniform(0,1) < 0.4 and (prev_obj.get_parameter_config_name() != 'KeyMoveMapParts') and \
               (stage.ObjectFactory.get_collision(obj_name).get_aabb().max_dim() < 1000):
             points = [
                 pos,
-                pos + Vec(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1))*500 - jump_offset.normalize()*750,
+                pos + Vec(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1))*500 - jump_offset.normalize()*750,
             ]
-            speed = random.uniform(7, 15)
+            speed = rng.uniform(7, 15)
             obj = stage.ObjectFactory.create_key_move_parts(obj_name,
                 stage.Components.KeyMoveNext.Key(points[0], speed, 0), 
                 stage.Components.KeyMoveNext.Key(points[1], speed, 0),
@@ -179,23 +341,27 @@ class TimerSegment(SegmentBase):
     def jump_set(self):
         return self.__segment.jump_set()
     
-    def increment_num_objs_remaining(self):
-        super().increment_num_objs_remaining()
-        # Revert linking so reverted object isn't accidentally included in the stage
-        self.__timer_start_obj.linkset().switch_appear_target[:] = self.__timer_start_obj.linkset().switch_appear_target[:-1]
-    
-    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec):
+    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec, rng = random):
         objs = self.__segment.create_object(obj_name=obj_name,
                                            pos=pos,
                                            is_last_obj=is_last_obj,
                                            prev_obj=prev_obj,
-                                           jump_offset=jump_offset)
+                                           jump_offset=jump_offset,
+                                           rng=rng)
         for obj in objs:
             obj.set_is_link_dest(True)
             obj.set_comment('TimerSegment')
-            self.__timer_start_obj.linkset().switch_appear_target.append(obj)
             # obj.linkset().group_clipping = [self.__group_clipping]
         return objs
+
+    def on_objects_placed(self, objs: List[stage.Object]):
+        for obj in objs:
+            self.__timer_start_obj.linkset().switch_appear_target.append(obj)
+
+    def on_objects_removed(self, objs: List[stage.Object]):
+        # Unlink every removed object (moving objects come with a rail drawer) so none is left in the stage through the timer
+        targets = self.__timer_start_obj.linkset().switch_appear_target
+        targets[:] = [target for target in targets if all(target is not obj for obj in objs)]
     
     def initial_objects(self, segment_start_pos: Vec):
         self.__timer_start_obj = stage.ObjectFactory.create_trample_switch_timer(
@@ -220,10 +386,10 @@ class MoeEyeSegment(SegmentBase):
     def jump_set(self):
         return JumpDataset.get_all_jumps()
     
-    def get_jump_scale(self, jump_name):
-        return random.uniform(0.3, 0.4)
+    def get_jump_scale(self, jump_name, rng = random):
+        return rng.uniform(0.3, 0.4)
     
-    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec):
+    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec, rng = random):
         if self.is_last_obj_in_segment():
             return [stage.ObjectFactory.create_fix_map_parts('SandWorldHomeLift001', pos=pos)]
         else:
@@ -255,19 +421,19 @@ class LavaBubbleSegment(SegmentBase):
     def jump_set(self):
         return JumpDataset.get_all_jumps('TestCaptureBubble')
     
-    def get_jump_scale(self, jump_name):
-        return random.uniform(0.8, 1)
+    def get_jump_scale(self, jump_name, rng = random):
+        return rng.uniform(0.8, 1)
     
-    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec):
+    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec, rng = random):
         if self.is_last_obj_in_segment():
             return [stage.ObjectFactory.create_fix_map_parts('LavaWorldHomeTimer002WobbleParts000', pos=pos)]
         else:
-            if random.random() < 0.5:
+            if rng.random() < 0.5:
                 points = [
                     pos,
-                    pos + Vec(random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1))*150
+                    pos + Vec(rng.uniform(-1, 1), rng.uniform(-1, 1), rng.uniform(-1, 1))*150
                 ]
-                speed = random.uniform(3, 6)
+                speed = rng.uniform(3, 6)
                 obj = stage.ObjectFactory.create_key_move_parts(obj_name,
                     stage.Components.KeyMoveNext.Key(points[0], speed, 0), 
                     stage.Components.KeyMoveNext.Key(points[1], speed, 0),
@@ -297,42 +463,42 @@ class PokioSegment(SegmentBase):
     def jump_set(self):
         return JumpDataset.get_all_jumps('Pokio')
     
-    def get_jump_scale(self, jump_name):
-        return random.uniform(0.8, 1)
+    def get_jump_scale(self, jump_name, rng = random):
+        return rng.uniform(0.8, 1)
     
-    def get_random_jump_y_rotation(self):
+    def get_random_jump_y_rotation(self, rng = random):
         return 0
 
-    def get_entry_pos_on_obj_surface(self, obj_name: str, collision):
+    def get_entry_pos_on_obj_surface(self, obj_name: str, collision, rng = random):
         if obj_name not in self.object_set(): # finding entry pos of final object in this segment that is a normal non-pokio platform
-            return super().get_entry_pos_on_obj_surface(obj_name, collision)
-        pos = reduce(lambda a,b: a if a.y() < b.y() else b, self.__get_random_pokeable_positions(collision))
+            return super().get_entry_pos_on_obj_surface(obj_name, collision, rng)
+        pos = reduce(lambda a,b: a if a.y() < b.y() else b, self.__get_random_pokeable_positions(collision, rng))
         # print(f'Entry: {pos.to_byml_dict()}')
         return pos, Vec(0, 0, 0)
 
-    def get_exit_pos_on_obj_surface(self, obj_name: str, collision):
+    def get_exit_pos_on_obj_surface(self, obj_name: str, collision, rng = random):
         if obj_name not in self.object_set(): # finding exit pos of previous segment's last object. In this case, use normal generation from the surface of the object
-            return super().get_exit_pos_on_obj_surface(obj_name, collision)
-        pos = reduce(lambda a,b: a if a.y() > b.y() else b, self.__get_random_pokeable_positions(collision))
+            return super().get_exit_pos_on_obj_surface(obj_name, collision, rng)
+        pos = reduce(lambda a,b: a if a.y() > b.y() else b, self.__get_random_pokeable_positions(collision, rng))
         # print(f'Exit: {pos.to_byml_dict()}')
         return pos
 
-    def __get_random_pokeable_positions(self, collision):
+    def __get_random_pokeable_positions(self, collision, rng):
         SAMPLE_COUNT = 20
         return [
-            collision.get_random_standable_pos(MARIO_RADIUS, target_surface_normal=Vec(0, 0, 1), angle_threshold_degrees=45)
+            collision.get_random_standable_pos(MARIO_RADIUS, target_surface_normal=Vec(0, 0, 1), angle_threshold_degrees=45, rng=rng)
             for _ in range(SAMPLE_COUNT)
         ]
     
-    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec):
+    def create_object(self, obj_name: str, pos: Vec, is_last_obj: bool, prev_obj: stage.Object, jump_offset: Vec, rng = random):
         if self.is_last_obj_in_segment():
             return [stage.ObjectFactory.create_fix_map_parts('LavaWorldHomeTimer002WobbleParts000', pos=pos + Vec(0, -1750, -500))]
         else:
             points = [
                 pos + Vec(0, 0, 0),
-                pos + Vec(random.uniform(250, 700), 0, 0)
+                pos + Vec(rng.uniform(250, 700), 0, 0)
             ]
-            speed = random.uniform(3, 6)
+            speed = rng.uniform(3, 6)
             obj = stage.ObjectFactory.create_key_move_parts(obj_name,
                 stage.Components.KeyMoveNext.Key(points[0], speed, 0), 
                 stage.Components.KeyMoveNext.Key(points[1], speed, 0),
@@ -353,15 +519,52 @@ class Zone:
         self.name = name
         self.base_pos = base_pos
         self.scenario = stage.Scenario(default_data=False)
+
+class SearchState:
+    """ A point the generator's backtracking search can return to. The candidates tried from a state are a fixed sequence drawn from
+        its seed, so next_candidate records every candidate that was rejected from it, or accepted and later backtracked over. """
+
+    def __init__(self, seed: int, segment: SegmentBase, placed_objs: List[stage.Object] = None, prev_segment: SegmentBase = None):
+        self.seed = seed
+        self.next_candidate = 0
+        self.segment = segment
+        self.placed_objs = placed_objs # Objects placed to reach this state, None if the state started a zone (or is the starting platform)
+        self.prev_segment = prev_segment # Segment that was active before the zone this state started
+
+    def starts_zone(self):
+        return self.prev_segment is not None
+
 class Generator:
 
     def __init__(self, kingdom_dataset: KingdomDataset): #, difficulty)
         self.__dataset = kingdom_dataset
+        self.__metrics = GenerationMetrics()
+
+    def get_metrics(self):
+        """ GenerationMetrics of the last generate call, packaging the stage can add to them """
+        return self.__metrics
+
+    @contextlib.contextmanager
+    def __timed(self, phase: str):
+        """ Time a phase without the collision loads it triggers, those are counted as collision loading for the whole generate call """
+        start, load_start = time.perf_counter(), stage.ObjectFactory.get_collision_load_seconds()
+        try:
+            yield
+        finally:
+            self.__metrics.add_time(phase, time.perf_counter() - start - (stage.ObjectFactory.get_collision_load_seconds() - load_start))
 
     def generate(self, player_start_pos: Vec, current_stage_name: str, prev_stage_name: str, next_stage_name: str):
+        with Trace.span('generate', kingdom=self.__dataset.name(), stage=current_stage_name):
+            return self.__generate(player_start_pos, current_stage_name, prev_stage_name, next_stage_name)
+
+    def __generate(self, player_start_pos: Vec, current_stage_name: str, prev_stage_name: str, next_stage_name: str):
+        self.__metrics = GenerationMetrics()
+        collision_load_start = stage.ObjectFactory.get_collision_load_seconds()
         starting_platform_obj_name = 'CapWorldHomeGround001' if self.__dataset.name() != 'LavaWorld' else 'LavaWorldHomeTimer002WobbleParts000' # CapWorldHomeGround001 causes tons of lag in LavaWorld (maybe grass + heat distortion is laggy, idk)
         objs = [[stage.ObjectFactory.create_fix_map_parts(starting_platform_obj_name, pos=player_start_pos - Vec(0, 1500, 0))]]
         jumps = []
+        placement_index = PlacementIndex() # Mirrors objs and jumps, every append or revert of them must be applied here too
+        placement_index.add_object(objs[0][0].collision_aabb())
         collision_debug_verts = []
         num_objects = 55 if self.__dataset.name() != 'SkyWorld' else 45
 
@@ -388,6 +591,7 @@ class Generator:
                 elif isinstance(obj, stage.Object):
                     if obj.get_collision() is not None:
                         objs.append([obj])
+                        placement_index.add_object(obj.collision_aabb())
                     zones[-1].scenario.add_object(obj)
                 else:
                     raise Exception(f'Unsupported initial object: {obj}')
@@ -400,25 +604,51 @@ class Generator:
 
         add_initial_objects(segment)
 
-        while len(objs) < num_objects:
-            if segment.is_done():
-                prev_segment = segment
-                if len(SEGMENT_CREATORS) == 1:
-                    segment = SEGMENT_CREATORS[0](self.__dataset)
-                else:
-                    while type(segment).__name__ == type(prev_segment).__name__: # Ensure the same segment type doesn't occur back-to-back unless there is only one type
-                        segment = random.choice(SEGMENT_CREATORS)(self.__dataset)
-                zones.append(Zone(f'OnlyUp{self.__dataset.name()}{type(segment).__name__}Zone{len(zones)}'))
-                zone_obj_indices.append(len(objs))
-                zone_jump_indices.append(len(jumps))
-                add_initial_objects(segment)
-            jump_data = self.__find_new_jump(objs, jumps, collision_debug_verts, segment=segment, is_last_obj=len(objs)==num_objects-1, player_start_pos=player_start_pos, zone_obj_indices=zone_obj_indices, zone_jump_indices=zone_jump_indices, target_num_objs=num_objects)
-            if jump_data is None:
-                continue
-            new_obj, new_jump = jump_data
-            objs.append(new_obj)
-            jumps.append(new_jump)
-            segment.decrement_num_objs_remaining()
+        # Depth-first search over placements: one SearchState per placed object or started zone. A dead end undoes the newest placement
+        # and resumes its parent state with the candidates it hasn't tried yet.
+        search_states = [SearchState(random.getrandbits(64), segment)]
+        furthest_num_jumps = 0
+        failures_since_furthest = 0
+        with CandidateEvaluator(GlobalConfig.args.candidate_workers, GlobalConfig.args.candidate_batch_size) as candidate_evaluator:
+            while len(objs) < num_objects:
+                if segment.is_done():
+                    prev_segment = segment
+                    if len(SEGMENT_CREATORS) == 1:
+                        segment = SEGMENT_CREATORS[0](self.__dataset)
+                    else:
+                        while type(segment).__name__ == type(prev_segment).__name__: # Ensure the same segment type doesn't occur back-to-back unless there is only one type
+                            segment = random.choice(SEGMENT_CREATORS)(self.__dataset)
+                    zones.append(Zone(f'OnlyUp{self.__dataset.name()}{type(segment).__name__}Zone{len(zones)}'))
+                    zone_obj_indices.append(len(objs))
+                    zone_jump_indices.append(len(jumps))
+                    add_initial_objects(segment)
+                    search_states.append(SearchState(random.getrandbits(64), segment, prev_segment=prev_segment))
+                with Trace.span('find_new_jump', num_objs=len(objs), segment=type(segment).__name__):
+                    jump_data = self.__find_new_jump(objs, jumps, placement_index, candidate_evaluator, collision_debug_verts, search_states[-1], segment=segment, is_last_obj=len(objs)==num_objects-1, player_start_pos=player_start_pos, target_num_objs=num_objects)
+                if jump_data is None:
+                    if len(search_states) == 1:
+                        print(f'Failed on the starting platform, trying more candidates')
+                        continue
+                    # Backtrack one step, or further when the search keeps failing around the same place, so it can leave a region where
+                    # nothing fits in a few steps instead of retrying every combination of its last placements
+                    num_steps = 2 ** (failures_since_furthest // Generator.BACKTRACK_DOUBLING_FAILURES)
+                    failures_since_furthest += 1
+                    segment = self.__backtrack(num_steps, search_states, objs, jumps, placement_index, zones, zone_obj_indices, zone_jump_indices)
+                    continue
+                new_obj, new_jump = jump_data
+                objs.append(new_obj)
+                jumps.append(new_jump)
+                placement_index.add_object(new_obj[0].collision_aabb())
+                placement_index.add_jump(new_jump.swept_aabb())
+                segment.on_objects_placed(new_obj)
+                segment.decrement_num_objs_remaining()
+                search_states.append(SearchState(random.getrandbits(64), segment, placed_objs=new_obj))
+                if len(jumps) > furthest_num_jumps:
+                    furthest_num_jumps = len(jumps)
+                    failures_since_furthest = 0
+        self.__metrics.placed = len(jumps)
+        metrics = self.__metrics
+        print(f'Placed {metrics.placed} objects with {metrics.tries} jump candidates ({metrics.tries_per_object():.1f} per object), {metrics.backtracks} backtracks, {metrics.zone_reverts} zone reverts')
         zone_obj_indices.append(len(objs))
         
         zone_index = 0
@@ -467,64 +697,105 @@ class Generator:
         
         main_scenario.add_object(stage.Object('LifeMaxUpItem', parameter_config_name='LifeMaxUpItem', pos=player_start_pos + Vec(250, -800, 0)))
 
+        self.__metrics.add_time(GenerationMetrics.PHASE_COLLISION_LOADING, stage.ObjectFactory.get_collision_load_seconds() - collision_load_start)
         return main_scenario
 
-    def __find_new_jump(self, objs: List[stage.Object], jumps: List[Jump], collision_debug_verts: List[Vec], segment: SegmentBase, is_last_obj: bool, player_start_pos: Vec, zone_obj_indices: List[int], zone_jump_indices: List[int], target_num_objs: int):
+    MAX_JUMP_CANDIDATES = 100 # Per try from a search state, a state that runs out of them is a dead end
+    BACKTRACK_DOUBLING_FAILURES = 4 # Dead ends in a row without getting further than before, after which each backtrack goes twice as far
+
+    def __find_new_jump(self, objs: List[stage.Object], jumps: List[Jump], placement_index: PlacementIndex, candidate_evaluator: CandidateEvaluator, collision_debug_verts: List[Vec], search_state: SearchState, segment: SegmentBase, is_last_obj: bool, player_start_pos: Vec, target_num_objs: int):
         def add_object_collision_debug(obj: stage.Object):
             obj.get_collision().to_obj(collision_debug_verts, obj.pos())
 
-        new_obj = None
-        for i in range(100):
-            
-            new_obj_name = segment.get_random_object_name() if not is_last_obj else 'LavaWorldWireStep000' # Force lava world wire step as final platform
-            # print(f'Trying: {new_obj_name}')
-
-            jump_type = segment.get_random_jump()
-
-            random_rotation = segment.get_random_jump_y_rotation()
-            jump_scale = segment.get_jump_scale(jump_type.name())
-
-            mario_trajectory = Trajectory(jump_type.get_mario_trajectory()).scale(jump_scale)
-            cappy_trajectory = Trajectory(jump_type.get_mario_trajectory()).scale(jump_scale)
-
-            jump_offset = mario_trajectory.endpoint().rotate_y(random_rotation)
-            jump_start_pos = objs[-1][0].pos() + (segment.get_exit_pos_on_obj_surface(objs[-1][0].name(), objs[-1][0].get_collision())) # Must ADD the local surface pos offset because we already have the obj pos and are offsetting the next jump. You only need to subtract the local offset when trying to place the destination object so the jump lands at the target local standing pos offset.
-            local_object_jump_landing_pos, entry_normal = segment.get_entry_pos_on_obj_surface(new_obj_name, stage.ObjectFactory.get_collision(new_obj_name))
-            new_obj_pos = jump_start_pos + jump_offset - local_object_jump_landing_pos - entry_normal*(MARIO_RADIUS+1)
-
-            if random.random() < new_obj_pos.distance_to(player_start_pos) / 35_000: # If an object is this distance away, then there is a 100% chance it will get cut and retried. If it's half this distance, then 50% chance, etc.
-                # This guides the stage vertically upwards and prevents it from drifting too far away from the start
-                # This makes falls less likely to cause a total reset to the begininning
-                # Russian roulette style termination of jumps based on distance from player start pos in XZ plane
-                continue
-        
-            # print(f'Trying: {new_obj_name}')
-            # print(new_obj_pos.to_byml_dict())
-            new_objs = segment.create_object(new_obj_name, 
-                                            pos=new_obj_pos, 
-                                            is_last_obj=is_last_obj,
-                                            prev_obj=objs[-1][0],
-                                            jump_offset=jump_offset)
-            new_obj = new_objs[0]
-            new_jump = Jump(objs[-1][0], new_obj, jump_start_pos=jump_start_pos, y_rotation=random_rotation, mario_trajectory=mario_trajectory, cappy_trajectory=cappy_trajectory)
-            if new_jump.is_possible(objs, jumps):
-                add_object_collision_debug(new_obj)
-                print(f'[{len(objs)}/{target_num_objs}] Added: {new_obj_name}')
+        # Candidate i always draws from its own stream and gets the same object ids, so which candidate wins only depends on the seed.
+        # Every try from a state continues after the candidates it already went through, so none is tested twice.
+        first_candidate = search_state.next_candidate
+        end_candidate = first_candidate + Generator.MAX_JUMP_CANDIDATES
+        id_checkpoint = stage.Object.get_id_checkpoint()
+        for batch_start in range(first_candidate, end_candidate, candidate_evaluator.batch_size()):
+            candidates = []
+            for i in range(batch_start, min(batch_start + candidate_evaluator.batch_size(), end_candidate)):
+                stage.Object.restore_id_checkpoint(id_checkpoint)
+                new_obj_name, candidate, rejection = self.__create_jump_candidate(random.Random(f'{search_state.seed}:{i}'), objs, segment, is_last_obj, player_start_pos)
+                candidates.append((new_obj_name, candidate, rejection, stage.Object.get_id_checkpoint()))
+
+            with self.__timed(GenerationMetrics.PHASE_TRAJECTORY_CHECKS):
+                chosen, rejections = candidate_evaluator.first_feasible([None if candidate is None else candidate[1] for _, candidate, _, _ in candidates], objs, jumps, placement_index)
+            # Only candidates up to the chosen one count, the rest of a batch was checked ahead of time and is never used
+            for i, (new_obj_name, _, rejection, _) in enumerate(candidates[:len(candidates) if chosen is None else chosen + 1]):
+                self.__metrics.record_try(new_obj_name, rejection if rejection is not None else rejections.get(i))
+            if chosen is not None:
+                _, (new_objs, new_jump), _, end_id_checkpoint = candidates[chosen]
+                stage.Object.restore_id_checkpoint(end_id_checkpoint)
+                search_state.next_candidate = batch_start + chosen + 1
+                add_object_collision_debug(new_objs[0])
+                print(f'[{len(objs)}/{target_num_objs}] Added: {new_objs[0].name()}')
                 return new_objs, new_jump
-        if len(objs) > zone_obj_indices[-1] and len(jumps) > zone_jump_indices[-1]: # Make sure we don't revert across zone boundaries and potentially cause an impossible section or leftover links
-            print(f'Failed on {objs[-1][0].name()}, reverting slightly and re-attempting')
-            objs[:] = objs[:-1]
-            jumps[:] = jumps[:-1]
-            segment.increment_num_objs_remaining()
-        else:
-            # revert entire previous segment
-            objs[:] = objs[:zone_obj_indices[-1]]
-            jumps[:] = jumps[:zone_jump_indices[-1]]
-            zone_obj_indices[:] = zone_obj_indices[:-1]
-            zone_jump_indices[:] = zone_jump_indices[:-1]
-            print(f'Failed, reverting entire previous segment')
+        stage.Object.restore_id_checkpoint(id_checkpoint)
+        search_state.next_candidate = end_candidate
         return None
-        # raise Exception(f'Max number of new jump tries exceeded, exiting to prevent infinite loop. Stuck on object {objs[-1][0].name()}')        
+
+    def __backtrack(self, num_steps: int, search_states: List[SearchState], objs: List[stage.Object], jumps: List[Jump], placement_index: PlacementIndex, zones: List[Zone], zone_obj_indices: List[int], zone_jump_indices: List[int]):
+        """ Undo the newest num_steps placements or started zones, never the starting platform. Returns the segment to continue with. """
+        for _ in range(min(num_steps, len(search_states) - 1)):
+            search_state = search_states.pop()
+            if search_state.starts_zone():
+                print(f'Failed at the start of {zones[-1].name}, reverting it')
+                zones.pop()
+                objs[:] = objs[:zone_obj_indices.pop()]
+                jumps[:] = jumps[:zone_jump_indices.pop()]
+                segment = search_state.prev_segment
+                self.__metrics.zone_reverts += 1
+            else:
+                print(f'Failed on {objs[-1][0].name()}, reverting slightly and re-attempting')
+                objs.pop()
+                jumps.pop()
+                segment = search_state.segment
+                segment.on_objects_removed(search_state.placed_objs)
+                segment.increment_num_objs_remaining()
+            self.__metrics.backtracks += 1
+        placement_index.revert(len(objs), len(jumps))
+        return segment
+
+    def __create_jump_candidate(self, rng: random.Random, objs: List[stage.Object], segment: SegmentBase, is_last_obj: bool, player_start_pos: Vec):
+        """ Name of the new object and (new objects, jump onto them), drawn from rng. When the candidate is dropped before its feasibility
+            check, the second is None and the third the GenerationMetrics.REJECTED_* reason. """
+        new_obj_name = segment.get_random_object_name(rng) if not is_last_obj else 'LavaWorldWireStep000' # Force lava world wire step as final platform
+        # print(f'Trying: {new_obj_name}')
+
+        jump_type = segment.get_random_jump(rng)
+
+        random_rotation = segment.get_random_jump_y_rotation(rng)
+        jump_scale = segment.get_jump_scale(jump_type.name(), rng)
+
+        mario_trajectory = Trajectory.of_mario_jump(jump_type).scale(jump_scale)
+        cappy_trajectory = Trajectory.of_mario_jump(jump_type).scale(jump_scale)
+
+        jump_offset = mario_trajectory.endpoint().rotate_y(random_rotation)
+        try:
+            with self.__timed(GenerationMetrics.PHASE_SURFACE_SAMPLING):
+                jump_start_pos = objs[-1][0].pos() + (segment.get_exit_pos_on_obj_surface(objs[-1][0].name(), objs[-1][0].get_collision(), rng)) # Must ADD the local surface pos offset because we already have the obj pos and are offsetting the next jump. You only need to subtract the local offset when trying to place the destination object so the jump lands at the target local standing pos offset.
+                local_object_jump_landing_pos, entry_normal = segment.get_entry_pos_on_obj_surface(new_obj_name, stage.ObjectFactory.get_collision(new_obj_name), rng)
+        except KCL.NoStandablePosError:
+            return new_obj_name, None, GenerationMetrics.REJECTED_NO_STANDABLE_POS
+        new_obj_pos = jump_start_pos + jump_offset - local_object_jump_landing_pos - entry_normal*(MARIO_RADIUS+1)
+
+        if rng.random() < new_obj_pos.distance_to(player_start_pos) / 35_000: # If an object is this distance away, then there is a 100% chance it will get cut and retried. If it's half this distance, then 50% chance, etc.
+            # This guides the stage vertically upwards and prevents it from drifting too far away from the start
+            # This makes falls less likely to cause a total reset to the begininning
+            # Russian roulette style termination of jumps based on distance from player start pos in XZ plane
+            return new_obj_name, None, GenerationMetrics.REJECTED_DISTANCE_ROULETTE
+    
+        # print(f'Trying: {new_obj_name}')
+        # print(new_obj_pos.to_byml_dict())
+        new_objs = segment.create_object(new_obj_name, 
+                                        pos=new_obj_pos, 
+                                        is_last_obj=is_last_obj,
+                                        prev_obj=objs[-1][0],
+                                        jump_offset=jump_offset,
+                                        rng=rng)
+        new_obj = new_objs[0]
+        return new_obj_name, (new_objs, Jump(objs[-1][0], new_obj, jump_start_pos=jump_start_pos, y_rotation=random_rotation, mario_trajectory=mario_trajectory, cappy_trajectory=cappy_trajectory)), None
 
     def __add_warp_areas_between_stages(self, main_scenario: stage.Scenario, end_of_stage_height: float, player_start_pos: Vec, current_stage_name: str, prev_stage_name: str, next_stage_name: str):
         # Add captures below in case captures die and need to respawn
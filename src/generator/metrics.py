@@ -0,0 +1,85 @@
+import contextlib
+import json
+import os
+import time
+from typing import Dict
+
+class GenerationMetrics:
+    """ Counters and phase timings of one kingdom's generation, reported as JSON """
+
+    # Why a jump candidate was rejected
+    REJECTED_DISTANCE_ROULETTE = 'distance_roulette' # Dropped for being far from the player start, before any collision test
+    REJECTED_NO_STANDABLE_POS = 'no_standable_pos'
+    REJECTED_TRAJECTORY_HIT_OBJECT = 'trajectory_hit_object'
+    REJECTED_OBJECT_HIT_JUMP = 'object_hit_jump' # The new object blocks the path of an earlier jump
+    REJECTION_REASONS = [REJECTED_DISTANCE_ROULETTE, REJECTED_NO_STANDABLE_POS, REJECTED_TRAJECTORY_HIT_OBJECT, REJECTED_OBJECT_HIT_JUMP]
+
+    # Exclusive phases, collision loads triggered while sampling or checking count as collision loading only
+    PHASE_COLLISION_LOADING = 'collision_loading'
+    PHASE_SURFACE_SAMPLING = 'surface_sampling'
+    PHASE_TRAJECTORY_CHECKS = 'trajectory_checks'
+    PHASE_SERIALIZATION = 'serialization'
+    PHASES = [PHASE_COLLISION_LOADING, PHASE_SURFACE_SAMPLING, PHASE_TRAJECTORY_CHECKS, PHASE_SERIALIZATION]
+
+    def __init__(self):
+        self.tries = 0 # Jump candidates drawn, including the accepted ones
+        self.accepted = 0
+        self.backtracks = 0 # Placements or zones undone
+        self.zone_reverts = 0
+        self.placed = 0 # Objects reached by a jump in the finished stage
+        self.__rejections = {reason: 0 for reason in GenerationMetrics.REJECTION_REASONS}
+        self.__tries_by_object: Dict[str, int] = {}
+        self.__rejections_by_object: Dict[str, int] = {}
+        self.__seconds = {phase: 0.0 for phase in GenerationMetrics.PHASES}
+
+    def tries_per_object(self):
+        return self.tries / max(self.placed, 1)
+
+    def record_try(self, obj_name: str, rejection: str = None):
+        """ Count a jump candidate landing on obj_name, rejected for the given reason or accepted if None """
+        self.tries += 1
+        self.__tries_by_object[obj_name] = self.__tries_by_object.get(obj_name, 0) + 1
+        if rejection is None:
+            self.accepted += 1
+        else:
+            self.__rejections[rejection] += 1
+            self.__rejections_by_object[obj_name] = self.__rejections_by_object.get(obj_name, 0) + 1
+
+    def get_rejections(self, reason: str):
+        return self.__rejections[reason]
+
+    def add_time(self, phase: str, seconds: float):
+        self.__seconds[phase] += seconds
+
+    def get_time(self, phase: str):
+        return self.__seconds[phase]
+
+    @contextlib.contextmanager
+    def time(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    def to_dict(self):
+        return {
+            'tries': self.tries,
+            'accepted': self.accepted,
+            'backtracks': self.backtracks,
+            'zone_reverts': self.zone_reverts,
+            'placed': self.placed,
+            'tries_per_object': self.tries_per_object(),
+            'rejections': dict(self.__rejections),
+            'tries_by_object': dict(sorted(self.__tries_by_object.items())),
+            'rejections_by_object': dict(sorted(self.__rejections_by_object.items())),
+            'seconds': dict(self.__seconds),
+        }
+
+    def write_json(self, path: str, **extra):
+        """ Write the metrics to path, with any extra keyword arguments as additional top-level fields """
+        out_dir = os.path.dirname(path)
+        if out_dir != '':
+            os.makedirs(out_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({**extra, **self.to_dict()}, f, indent=2)
@@ -0,0 +1,111 @@
+import math
+from typing import Dict, List, Tuple
+from src.math import AABB
+
+class UniformGrid:
+    """ Append-only uniform grid over AABBs. Entries are numbered in insertion order, which lets truncate() roll back to an
+        earlier entry count by popping from the end of each touched cell. """
+
+    MAX_CELLS_PER_ENTRY = 512 # Larger entries (e.g. huge starting platforms) are kept in a list that every query returns
+
+    def __init__(self, cell_size: float):
+        self.__cell_size = cell_size
+        self.__cells: Dict[Tuple[int, int, int], List[int]] = {}
+        self.__oversized: List[int] = []
+        self.__entry_cells: List[List[Tuple[int, int, int]]] = []
+        self.__entry_bounds: List[Tuple[List[float], List[float]]] = []
+
+    def __len__(self):
+        return len(self.__entry_bounds)
+
+    def __cell_range(self, aabb: AABB):
+        lo = [math.floor(v / self.__cell_size) for v in aabb.minpt.get_data()]
+        hi = [math.floor(v / self.__cell_size) for v in aabb.maxpt.get_data()]
+        return lo, hi
+
+    @staticmethod
+    def __cell_count(lo: List[int], hi: List[int]):
+        return (hi[0]-lo[0]+1) * (hi[1]-lo[1]+1) * (hi[2]-lo[2]+1)
+
+    @staticmethod
+    def __iter_cells(lo: List[int], hi: List[int]):
+        for x in range(lo[0], hi[0]+1):
+            for y in range(lo[1], hi[1]+1):
+                for z in range(lo[2], hi[2]+1):
+                    yield (x, y, z)
+
+    def insert(self, aabb: AABB):
+        index = len(self.__entry_bounds)
+        lo, hi = self.__cell_range(aabb)
+        cells = []
+        if UniformGrid.__cell_count(lo, hi) > UniformGrid.MAX_CELLS_PER_ENTRY:
+            self.__oversized.append(index)
+        else:
+            cells = list(UniformGrid.__iter_cells(lo, hi))
+            for cell in cells:
+                self.__cells.setdefault(cell, []).append(index)
+        self.__entry_cells.append(cells)
+        self.__entry_bounds.append((aabb.minpt.get_data(), aabb.maxpt.get_data()))
+        return index
+
+    def truncate(self, num_entries: int):
+        """ Remove every entry inserted after the first num_entries """
+        while len(self.__entry_bounds) > num_entries:
+            index = len(self.__entry_bounds) - 1
+            cells = self.__entry_cells.pop()
+            self.__entry_bounds.pop()
+            if len(cells) == 0:
+                self.__oversized.pop()
+            for cell in cells:
+                cell_entries = self.__cells[cell]
+                cell_entries.pop() # Always the newest entry in the cell
+                if len(cell_entries) == 0:
+                    del self.__cells[cell]
+
+    def query(self, aabb: AABB):
+        """ Indices of the entries whose AABB overlaps the given one, in insertion order """
+        lo, hi = self.__cell_range(aabb)
+        if UniformGrid.__cell_count(lo, hi) > len(self.__cells):
+            candidates = range(len(self.__entry_bounds)) # Cheaper to check every entry than to walk the cells
+        else:
+            candidates = set(self.__oversized)
+            for cell in UniformGrid.__iter_cells(lo, hi):
+                candidates.update(self.__cells.get(cell, []))
+        qmin, qmax = aabb.minpt.get_data(), aabb.maxpt.get_data()
+        return sorted(
+            i for i in candidates
+            if all(self.__entry_bounds[i][0][k] <= qmax[k] and qmin[k] <= self.__entry_bounds[i][1][k] for k in range(3))
+        )
+
+class PlacementIndex:
+    """ Spatial index over the placed objects' world AABBs and the jumps' swept AABBs, numbered like Generator's objs and jumps
+        lists so only nearby pairs get an exact collision test """
+
+    CELL_SIZE = 2000
+
+    def __init__(self):
+        self.__objects = UniformGrid(PlacementIndex.CELL_SIZE)
+        self.__jumps = UniformGrid(PlacementIndex.CELL_SIZE)
+
+    def num_objects(self):
+        return len(self.__objects)
+
+    def num_jumps(self):
+        return len(self.__jumps)
+
+    def add_object(self, obj_aabb: AABB):
+        return self.__objects.insert(obj_aabb)
+
+    def add_jump(self, jump_aabb: AABB):
+        return self.__jumps.insert(jump_aabb)
+
+    def revert(self, num_objects: int, num_jumps: int):
+        """ Drop the objects and jumps added after the first num_objects and num_jumps, mirroring a revert of the objs and jumps lists """
+        self.__objects.truncate(num_objects)
+        self.__jumps.truncate(num_jumps)
+
+    def objects_near(self, aabb: AABB):
+        return self.__objects.query(aabb)
+
+    def jumps_near(self, aabb: AABB):
+        return self.__jumps.query(aabb)
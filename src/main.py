@@ -1,8 +1,10 @@
 import argparse
+import cProfile
 from enum import Enum
 from typing import List
+import hashlib
+import multiprocessing
 import sys
-import tempfile
 import os
 import byml
 import random
@@ -10,13 +12,18 @@ import re
 
 from src import stage
 from src.stage.serializer import SerializerContext
+from src.stage.collision_cache import CollisionCache
 from src.generator.data.kingdom_dataset import KingdomDataset
 from src.file_format.bfres import BFRES
+from src.file_format.kcl import KCL
+from src.file_format.szs import SZS
 from src.config import GlobalConfig
+from src.profiling import Trace
 
-import sarc_tool
 from src.math import AABB, Vec
 from src.generator import Generator
+from src.generator.generator import TRAJECTORY_COLLISION_MODES, TRAJECTORY_COLLISION_CAPSULES
+from src.generator.metrics import GenerationMetrics
 
 class Difficulty(Enum):
     EASY = 'easy'
@@ -59,41 +66,38 @@ class DataCache:
         DataCache.object_index = 1
 
 def generate_stage(kingdom_dataset: KingdomDataset, current_stage_name: str, prev_stage_name: str, next_stage_name: str):
-    return Generator(kingdom_dataset).generate(PLAYER_START_POS, current_stage_name, prev_stage_name, next_stage_name)
+    """ The generated scenario and the generation metrics """
+    generator = Generator(kingdom_dataset)
+    scenario = generator.generate(PLAYER_START_POS, current_stage_name, prev_stage_name, next_stage_name)
+    return scenario, generator.get_metrics()
 
-def extract_szs(input_file: str, output_dir: str):
-    sarc_tool.main(['-o', output_dir, input_file])
+def get_report_dir():
+    if GlobalConfig.args.report_dir is not None:
+        return GlobalConfig.args.report_dir
+    return f'{os.path.normpath(GlobalConfig.args.output_romfs_path)}_reports' # Next to the romfs rather than inside it, so it never ends up in the mod
 
-def pack_szs(input_dir: str, output_file: str):
-    out_dir = os.path.dirname(output_file)
-    if out_dir != '' and not os.path.exists(out_dir):
-        os.makedirs(os.path.dirname(output_file))
-    sarc_tool.main(['-o', output_file, '-compress', '9', input_dir])
-
-def convert_byml_to_yaml(input_file: str):
-    with open(input_file, 'rb') as f:
-        parser = byml.Byml(bytearray(f.read()))
-        return parser.parse()
+def convert_byml_to_yaml(data: bytes):
+    parser = byml.Byml(bytearray(data))
+    return parser.parse()
     
-def convert_yaml_to_byml(yml: dict, output_file: str):
-    with open(output_file, 'wb+') as f:
-        writer = byml.Writer(yml, be=True)
-        writer.write(f)
+def convert_yaml_to_byml(yml: dict):
+    writer = byml.Writer(yml, be=True)
+    return writer.get_bytes()
 
-class SZSTransformerTempDir:
+class SZSTransformer:
+    """ Opens the input archive as a dict of archive path -> file bytes, and writes the modified files to the output archive """
 
     def __init__(self, szs_input_path: str, szs_output_path: str):
         self.szs_input_path = szs_input_path
         self.szs_output_path = szs_output_path
 
     def __enter__(self):
-        self.tmpdir = tempfile.TemporaryDirectory()
-        extract_szs(self.szs_input_path, self.tmpdir.name)
-        return self.tmpdir.name
+        self.files = SZS.read(self.szs_input_path)
+        return self.files
 
-    def __exit__(self, *args):
-        pack_szs(self.tmpdir.name, self.szs_output_path)
-        self.tmpdir.cleanup()
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            SZS.write(self.szs_output_path, self.files)
 
 def reformat_key(key: str):
     words = re.findall('[A-Z][^A-Z]*', key)
@@ -112,41 +116,83 @@ def reformat_yml(yml):
     
 
 def process_stage_map_file(kingdom_dataset: KingdomDataset, output_stage_name: str, prev_stage_name: str, next_stage_name: str):
-    scenario = generate_stage(kingdom_dataset, output_stage_name, prev_stage_name, next_stage_name)
+    scenario, metrics = generate_stage(kingdom_dataset, output_stage_name, prev_stage_name, next_stage_name)
     ctx = SerializerContext(PLAYER_START_POS)
-    ctx.package_map_szs(
-        scenario,
-        os.path.join(GlobalConfig.args.output_romfs_path, f'StageData/{output_stage_name}Map.szs'),
-        output_stage_name)
+    with metrics.time(GenerationMetrics.PHASE_SERIALIZATION):
+        ctx.package_map_szs(
+            scenario,
+            os.path.join(GlobalConfig.args.output_romfs_path, f'StageData/{output_stage_name}Map.szs'),
+            output_stage_name)
+    metrics.write_json(os.path.join(get_report_dir(), f'{output_stage_name}.json'), kingdom=kingdom_dataset.name(), stage=output_stage_name, seed=GlobalConfig.args.seed)
 
 def process_stage_sound_file(input_stage_name: str, output_stage_name: str):
-    with SZSTransformerTempDir(os.path.join(GlobalConfig.args.input_romfs_path, f'StageData/{input_stage_name}Sound.szs'), os.path.join(GlobalConfig.args.output_romfs_path, f'StageData/{output_stage_name}Sound.szs')) as tmpdir:
-        yml = convert_byml_to_yaml(os.path.join(tmpdir, f'{input_stage_name}Sound.byml'))
+    with SZSTransformer(os.path.join(GlobalConfig.args.input_romfs_path, f'StageData/{input_stage_name}Sound.szs'), os.path.join(GlobalConfig.args.output_romfs_path, f'StageData/{output_stage_name}Sound.szs')) as files:
+        yml = convert_byml_to_yaml(files[f'{input_stage_name}Sound.byml'])
         yml = [{'AreaList': [], 'ObjectList': []} for _ in yml]
-        convert_yaml_to_byml(yml, os.path.join(tmpdir, os.path.join(tmpdir, f'{output_stage_name}Sound.byml')))
+        files[f'{output_stage_name}Sound.byml'] = convert_yaml_to_byml(yml)
 
 def process_stage_design_file(input_stage_name: str, output_stage_name: str):
-    with SZSTransformerTempDir(os.path.join(GlobalConfig.args.input_romfs_path, f'StageData/{input_stage_name}Design.szs'), os.path.join(GlobalConfig.args.output_romfs_path, f'StageData/{output_stage_name}Design.szs')) as tmpdir:
-        yml = convert_byml_to_yaml(os.path.join(tmpdir, f'{input_stage_name}Design.byml'))
+    with SZSTransformer(os.path.join(GlobalConfig.args.input_romfs_path, f'StageData/{input_stage_name}Design.szs'), os.path.join(GlobalConfig.args.output_romfs_path, f'StageData/{output_stage_name}Design.szs')) as files:
+        yml = convert_byml_to_yaml(files[f'{input_stage_name}Design.byml'])
         yml = [{'AreaList': [], 'ObjectList': []} for _ in yml]
-        convert_yaml_to_byml(yml, os.path.join(tmpdir, os.path.join(tmpdir, f'{output_stage_name}Design.byml')))
+        files[f'{output_stage_name}Design.byml'] = convert_yaml_to_byml(yml)
 
 def process_stage_cube_map(input_stage_name: str, output_stage_name: str):
     output_file_path =  os.path.join(GlobalConfig.args.output_romfs_path, f'ObjectData/CubeMap{output_stage_name}.szs')
     if os.path.exists(output_file_path):
         return # Early return to speed up generation time
     print(f'Copying cube map: {input_stage_name} --> {output_stage_name}')
-    with SZSTransformerTempDir(os.path.join(GlobalConfig.args.input_romfs_path, f'ObjectData/CubeMap{input_stage_name}.szs', output_file_path)) as tmpdir:
-        BFRES.rename(
-            os.path.join(tmpdir, f'CubeMap{input_stage_name}.bfres'),
-            os.path.join(tmpdir, f'CubeMap{output_stage_name}.bfres'),
+    with SZSTransformer(os.path.join(GlobalConfig.args.input_romfs_path, f'ObjectData/CubeMap{input_stage_name}.szs'), output_file_path) as files:
+        files[f'CubeMap{output_stage_name}.bfres'] = BFRES.rename_data(
+            files.pop(f'CubeMap{input_stage_name}.bfres'),
+            f'CubeMap{input_stage_name}',
+            f'CubeMap{output_stage_name}',
         )
 
 def process_stage(kingdom_dataset: KingdomDataset, input_stage_name, output_stage_name, prev_stage_name, next_stage_name):
-    process_stage_map_file(kingdom_dataset, output_stage_name, prev_stage_name, next_stage_name)
-    process_stage_sound_file(input_stage_name, output_stage_name)
-    process_stage_design_file(input_stage_name, output_stage_name)
-    process_stage_cube_map(input_stage_name, output_stage_name)
+    with Trace.span('process_stage', kingdom=kingdom_dataset.name(), stage=output_stage_name):
+        process_stage_map_file(kingdom_dataset, output_stage_name, prev_stage_name, next_stage_name)
+        with Trace.span('sound_file', stage=output_stage_name):
+            process_stage_sound_file(input_stage_name, output_stage_name)
+        with Trace.span('design_file', stage=output_stage_name):
+            process_stage_design_file(input_stage_name, output_stage_name)
+        with Trace.span('cube_map', stage=output_stage_name):
+            process_stage_cube_map(input_stage_name, output_stage_name)
+
+def kingdom_seed(seed: str, stage_name: str, difficulty: Difficulty, kingdom_name: str):
+    """ Seed for the generation of one kingdom. Uses SHA-256 rather than hash(), which is salted per process for strings """
+    key = '\0'.join([seed, stage_name, difficulty.value, kingdom_name])
+    return int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big')
+
+def init_kingdom_worker(args):
+    GlobalConfig.args = args
+    GlobalConfig.args.candidate_workers = 0 # Pool workers can't start pools of their own, candidates are checked in process instead (same stage)
+    SZS.set_compressor(create_compressor(0)) # Same for compression, kingdoms compress their archives in parallel already
+    if GlobalConfig.args.trace is not None:
+        Trace.enable(f'Kingdom worker {os.getpid()}')
+
+def create_compressor(num_workers: int):
+    return SZS.Compressor(GlobalConfig.args.compress_level, num_workers, GlobalConfig.args.cache_dir)
+
+def generate_kingdom(task):
+    """ Generate and package one kingdom's stage. Only depends on the task, so kingdoms can run in any process and order.
+        Returns the kingdom name and the trace events recorded for it. """
+    kingdom_index, stage_name, difficulty, prev_stage_name, next_stage_name, first_object_id = task
+    kingdom_dataset = KingdomDataset.get_all_datasets()[kingdom_index]
+    random.seed(kingdom_seed(GlobalConfig.args.seed, stage_name, difficulty, kingdom_dataset.name()))
+    stage.Object.restore_id_checkpoint(first_object_id) # Object ids restart for every kingdom instead of continuing from the previous one
+    DataCache.clear()
+    GlobalConfig.difficulty = difficulty
+    output_stage_name = f'{stage_name}{kingdom_dataset.name()}Stage'
+    profile = cProfile.Profile() if GlobalConfig.args.cprofile else None
+    if profile is not None:
+        profile.enable()
+    process_stage(kingdom_dataset, f'{kingdom_dataset.name()}HomeStage', output_stage_name, prev_stage_name, next_stage_name)
+    if profile is not None:
+        profile.disable()
+        os.makedirs(get_report_dir(), exist_ok=True)
+        profile.dump_stats(os.path.join(get_report_dir(), f'{output_stage_name}.pstats'))
+    return kingdom_dataset.name(), Trace.take_events()
 
 def generate_only_up_stage():
     configs = [
@@ -157,16 +203,55 @@ def generate_only_up_stage():
         return f'{stage_name}{kingdom_dataset.name()}Stage'
 
     kingdom_datasets = KingdomDataset.get_all_datasets()
+    first_object_id = stage.Object.get_id_checkpoint()
+    tasks = []
     for stage_name, difficulty in configs:
         for i in range(len(kingdom_datasets)):
             prev_stage_name = None if i == 0 else get_stage_name(kingdom_datasets[i-1]) # no prev kingdom for first kingdom
             next_stage_name = 'OnlyUpWinStage' if i+1 >= len(kingdom_datasets) else get_stage_name(kingdom_datasets[i+1])
-            kingdom_dataset = kingdom_datasets[i]
-            random.seed(hash(GlobalConfig.args.seed) + sum([ord(c) for c in stage_name])) # Offset seed by sum of stage name characters so the segment choices are different for each kingdom
-            DataCache.clear()
-            GlobalConfig.difficulty = difficulty
-            process_stage(kingdom_dataset, f'{kingdom_dataset.name()}HomeStage', get_stage_name(kingdom_dataset), prev_stage_name, next_stage_name)
+            tasks.append((i, stage_name, difficulty, prev_stage_name, next_stage_name, first_object_id))
+
+    # Archives written by this process are compressed by the compression workers, which are done when the compressor exits
+    with create_compressor(GlobalConfig.args.compress_workers if GlobalConfig.args.jobs <= 1 else 0) as compressor:
+        SZS.set_compressor(compressor)
+        if GlobalConfig.args.jobs > 1:
+            with multiprocessing.Pool(min(GlobalConfig.args.jobs, len(tasks)), initializer=init_kingdom_worker, initargs=(GlobalConfig.args,)) as pool:
+                for kingdom_name, trace_events in pool.imap_unordered(generate_kingdom, tasks):
+                    Trace.add_events(trace_events)
+                    print(f'Kingdom done: {kingdom_name}')
+        else:
+            for task in tasks:
+                _, trace_events = generate_kingdom(task)
+                Trace.add_events(trace_events)
+        SZS.set_compressor(None)
     print('Stage generation done')
+    if GlobalConfig.args.trace is not None:
+        Trace.write(GlobalConfig.args.trace)
+        print(f'Trace written to {GlobalConfig.args.trace}')
+
+def add_collision_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        '--collision_backend',
+        choices=KCL.BACKENDS,
+        default=KCL.BACKEND_CGAL,
+        help='Collision query engine. "cgal" builds an AABB tree per object on load, "octree" walks the spatial index stored in the KCL file and skips tree construction'
+    )
+    parser.add_argument(
+        '--cache_dir',
+        default=os.path.join(os.path.expanduser('~'), '.cache', 'OnlyUpSMO'),
+        help='Directory for the persistent compiled collision cache, keyed by the hash of each input ObjectData/*.szs. Pass an empty string to disable'
+    )
+    parser.add_argument(
+        '--distance_field',
+        action='store_true',
+        help='Answer collision queries from a per-object voxel distance field where it is conclusive, and only run exact queries near surfaces. Fields are stored in the collision cache'
+    )
+    parser.add_argument(
+        '--distance_field_voxel_size',
+        type=float,
+        default=KCL.DistanceField.DEFAULT_VOXEL_SIZE,
+        help='Voxel size of the distance field. Smaller voxels leave fewer queries to the exact test but take longer to build'
+    )
 
 def parse_args(args: List[str]):
     parser = argparse.ArgumentParser(
@@ -189,16 +274,110 @@ def parse_args(args: List[str]):
         required=True,
         help='A string used to seed the random generation. Similar to MineCraft, the same seed will always produce the same level',
     )
+    parser.add_argument(
+        '--report_dir',
+        default=None,
+        help='Directory for the JSON generation report of each kingdom (tries, rejection reasons, phase timings). Defaults to <output_romfs_path>_reports'
+    )
     parser.add_argument(
         '--object_collision_debug_dir',
         default=None,
         help='Optional output dir for exporting stage object collisions as .obj files. Should only be necessary if you\'re updating the generation algorithm itself'
     )
+    parser.add_argument(
+        '--trajectory_collision',
+        choices=TRAJECTORY_COLLISION_MODES,
+        default=TRAJECTORY_COLLISION_CAPSULES,
+        help='How jump trajectories are tested against objects. "capsules" covers the whole path between recorded samples, "spheres" only tests a sphere at each sample (the behavior of older versions, for reproducing their seeds)'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of kingdoms generated in parallel, each in its own process. The output is the same as with 1 job. Jump candidates are then checked in process, --candidate_workers only applies to a single job'
+    )
+    parser.add_argument(
+        '--candidate_workers',
+        type=int,
+        default=0,
+        help='Worker processes for checking jump candidates in parallel, 0 checks them one at a time in the main process. The generated stage is the same either way'
+    )
+    parser.add_argument(
+        '--candidate_batch_size',
+        type=int,
+        default=8,
+        help='Jump candidates drawn and checked together when --candidate_workers is set'
+    )
+    parser.add_argument(
+        '--compress_level',
+        type=int,
+        choices=SZS.COMPRESS_LEVELS,
+        default=9,
+        help='Yaz0 compression level of the output archives. 9 gives the smallest files, 0 skips compression and is much faster for testing changes in game'
+    )
+    parser.add_argument(
+        '--compress_workers',
+        type=int,
+        default=0,
+        help='Worker processes compressing output archives in parallel with generation, 0 compresses them one at a time in the generating process. Only applies to a single job, with --jobs every kingdom compresses its own archives'
+    )
+    parser.add_argument(
+        '--trace',
+        default=None,
+        help='Optional output .json file for a timeline of where the run spends its time (generation, collision loading, packaging, compression), in the Chrome trace event format. Open it in Perfetto or chrome://tracing'
+    )
+    parser.add_argument(
+        '--cprofile',
+        action='store_true',
+        help='Profile the generation of each kingdom with cProfile and write the stats to <report_dir>/<stage>.pstats'
+    )
+    add_collision_args(parser)
 
     return parser.parse_args(args)
 
+def parse_warm_cache_args(args: List[str]):
+    parser = argparse.ArgumentParser(
+                    prog='SMO OnlyUp Stage Generator warm-cache',
+                    description='Precompile the collision of every object in the kingdom datasets into the collision cache')
+    parser.add_argument(
+        '-i', '--input_romfs_path',
+        required=True,
+        help='A romfs dump of SMO obtained from your copy of SMO, used for reading object collisions'
+    )
+    add_collision_args(parser)
+    return parser.parse_args(args)
+
+def warm_collision_cache():
+    obj_names = set()
+    for kingdom_dataset in KingdomDataset.get_all_datasets():
+        obj_names.update(kingdom_dataset.get_objects())
+        obj_names.update(kingdom_dataset.get_capture_specific_objects())
+    obj_names = sorted(obj_names)
+    # Distance fields are built from AABB tree queries, only pay for them on objects that previous runs actually queried
+    compiled_cache = stage.ObjectFactory.get_compiled_collision_cache()
+    aabb_tree_usage = compiled_cache.get_aabb_tree_usage() if compiled_cache is not None else None
+    for i, obj_name in enumerate(obj_names):
+        collision = stage.ObjectFactory.get_collision(obj_name)
+        status = '' if collision is not None else ' (no collision)'
+        if collision is not None and GlobalConfig.args.distance_field:
+            szs_path = os.path.join(GlobalConfig.args.input_romfs_path, f'ObjectData/{obj_name}.szs')
+            if aabb_tree_usage is None or CollisionCache.key(szs_path) in aabb_tree_usage:
+                collision.get_distance_field() # Builds and caches the distance field
+            else:
+                status = ' (distance field skipped, never queried)'
+        print(f'[{i+1}/{len(obj_names)}] {obj_name}{status}')
+    print('Collision cache warm-up done')
+
 def main(args: List[str]):
+    if len(args) > 0 and args[0] == 'warm-cache':
+        GlobalConfig.args = parse_warm_cache_args(args[1:])
+        if not GlobalConfig.args.distance_field:
+            GlobalConfig.args.collision_backend = KCL.BACKEND_OCTREE # Only the compiled file is needed, skip building query trees
+        warm_collision_cache()
+        return
     GlobalConfig.args = parse_args(args)
+    if GlobalConfig.args.trace is not None:
+        Trace.enable('Stage generator')
     generate_only_up_stage()
 
 if __name__ == '__main__':
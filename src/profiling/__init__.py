@@ -0,0 +1 @@
+from src.profiling.trace import Trace
@@ -0,0 +1,71 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import List
+
+class Trace:
+    """ Process-wide recorder of nested timing spans, written in the Chrome trace event format for Perfetto or chrome://tracing.
+        Spans are no-ops until enable() is called. """
+
+    __events: List[dict] = None
+
+    @staticmethod
+    def enable(process_name: str = None):
+        """ Start recording, dropping any events recorded before (e.g. inherited by a forked worker) """
+        Trace.__events = []
+        if process_name is not None:
+            Trace.__events.append({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'tid': 0, 'args': {'name': process_name}})
+
+    @staticmethod
+    def is_enabled():
+        return Trace.__events is not None
+
+    @staticmethod
+    def __now_us():
+        # perf_counter is the system-wide monotonic clock on Linux, so spans of worker processes line up with the main process
+        return time.perf_counter_ns() / 1000
+
+    @staticmethod
+    @contextlib.contextmanager
+    def span(name: str, **args):
+        """ Record the time spent in the with block as a span, args are shown with it """
+        if Trace.__events is None:
+            yield
+            return
+        start = Trace.__now_us()
+        try:
+            yield
+        finally:
+            Trace.__events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': start,
+                'dur': Trace.__now_us() - start,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    @staticmethod
+    def take_events():
+        """ Events recorded so far, e.g. to send them from a worker process to the main one. Recording continues with an empty list. """
+        if Trace.__events is None:
+            return []
+        events = Trace.__events
+        Trace.__events = []
+        return events
+
+    @staticmethod
+    def add_events(events: List[dict]):
+        if Trace.__events is not None:
+            Trace.__events.extend(events)
+
+    @staticmethod
+    def write(path: str):
+        out_dir = os.path.dirname(path)
+        if out_dir != '':
+            os.makedirs(out_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': Trace.__events or [], 'displayTimeUnit': 'ms'}, f)
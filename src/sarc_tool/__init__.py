@@ -21,9 +21,13 @@
 ################################################################
 ################################################################
 
+import fnmatch
+import mmap
 import os
+import struct
 import sys
-import time
+
+from src.profiling import Trace
 
 try:
     import SarcLib
@@ -58,138 +62,191 @@ except ImportError:
         sys.exit(1)
 
 
-def extract(file, outname):
+class Archive:
     """
-    Extrct the given archive
+    A SARC archive opened for reading.
+    Entries are memoryviews into the archive data, valid until the archive is closed.
     """
-    with open(file, "rb") as inf:
-        inb = inf.read()
 
-    while libyaz0.IsYazCompressed(inb):
-        inb = libyaz0.decompress(inb)
+    def __init__(self, data, mapped=None):
+        self._data = memoryview(data)
+        self._mapped = mapped
 
-    name = os.path.splitext(file)[0]
-    ext = SarcLib.guessFileExt(inb)
+        if self._data[:4] != b'SARC':
+            self.close()
+            raise ValueError("Not a SARC archive!")
 
-    if ext != ".sarc":
-        with open(''.join([name, ext]), "wb") as out:
-            out.write(inb)
+        endianness = '>' if self._data[6:8] == b'\xFE\xFF' else '<'
+        dataStartOffset, = struct.unpack_from(endianness + 'I', self._data, 0x0C)
+        sfatHeaderLen, numFiles = struct.unpack_from(endianness + 'HH', self._data, 0x18)
+        nodesOffset = 0x14 + sfatHeaderLen
+        namesOffset = nodesOffset + 0x10 * numFiles + 0x08  # Names follow the SFNT header
 
-    else:
-        arc = SarcLib.SARC_Archive()
-        arc.load(inb)
+        self._entries = []
+        for i in range(numFiles):
+            nameHash, nameAttrs, fileStart, fileEnd = struct.unpack_from(endianness + '4I', self._data, nodesOffset + 0x10 * i)
+            fileData = self._data[dataStartOffset + fileStart:dataStartOffset + fileEnd]
 
-        root = outname if outname != "" else os.path.join(os.path.dirname(file), name)
-        if not os.path.isdir(root):
-            os.mkdir(root)
+            if nameAttrs & 0xFF000000:
+                nameStart = namesOffset + (nameAttrs & 0xFFFFFF) * 4
+                nameEnd = nameStart
+                while self._data[nameEnd] != 0:
+                    nameEnd += 1
+                name = bytes(self._data[nameStart:nameEnd]).decode('utf-8')
 
-        files = []
+            else:
+                # Same name SarcLib gives files stored without a name
+                name = ''.join(["hash_" + hex(nameHash), SarcLib.guessFileExt(fileData)])
+
+            self._entries.append((name, fileData))
+
+    def names(self):
+        return [name for name, _ in self._entries]
+
+    def iter_entries(self, pattern=None):
+        """
+        Yield (name, memoryview) of the entries whose name matches the glob pattern, of every entry if pattern is None
+        """
+        for name, fileData in self._entries:
+            if pattern is None or fnmatch.fnmatchcase(name, pattern):
+                yield name, fileData
+
+    def close(self):
+        self._entries = []
+        self._data.release()
+        if self._mapped is not None:
+            try:
+                self._mapped.close()
 
-        def getAbsPath(folder, path):
-            nonlocal root
-            nonlocal files
+            except BufferError:
+                pass  # Entries are still referenced, the mapping closes once they are freed
 
-            for checkObj in folder.contents:
-                if isinstance(checkObj, SarcLib.File):
-                    files.append(["/".join([path, checkObj.name]), checkObj.data])
+            self._mapped = None
 
-                else:
-                    path_ = os.path.join(root, "/".join([path, checkObj.name]))
-                    if not os.path.isdir(path_):
-                        os.mkdir(path_)
+    def __enter__(self):
+        return self
 
-                    getAbsPath(checkObj, "/".join([path, checkObj.name]))
+    def __exit__(self, *args):
+        self.close()
 
-        for checkObj in arc.contents:
-            if isinstance(checkObj, SarcLib.File):
-                files.append([checkObj.name, checkObj.data])
 
-            else:
-                path = os.path.join(root, checkObj.name)
-                if not os.path.isdir(path):
-                    os.mkdir(path)
+def _read_decompressed(file):
+    """
+    Memory-map the file. Yaz0 compressed files are decompressed in memory instead.
+    Returns the data and the mapping to close, None if the data is not mapped
+    """
+    with open(file, "rb") as inf:
+        if os.fstat(inf.fileno()).st_size == 0:
+            return b'', None
 
-                getAbsPath(checkObj, checkObj.name)
+        mapped = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
 
-        for file, fileData in files:
-            # print(file)
-            with open(os.path.join(root, file), "wb") as out:
-                out.write(fileData)
+    if not libyaz0.IsYazCompressed(mapped):
+        return mapped, mapped
 
+    inb = libyaz0.decompress(mapped)
+    mapped.close()
+    while libyaz0.IsYazCompressed(inb):
+        inb = libyaz0.decompress(inb)
 
-def pack(root, endianness, level, outname):
+    return inb, None
+
+
+def open_archive(file):
     """
-    Pack the files and folders in the root folder.
+    Open the given SARC or SZS archive for reading
     """
+    data, mapped = _read_decompressed(file)
+    return Archive(data, mapped)
 
-    if "\\" in root:
-        root = "/".join(root.split("\\"))
-
-    if root[-1] == "/":
-        root = root[:-1]
 
+def build_sarc(mapping, endianness='>'):
+    """
+    Build an uncompressed SARC archive from a mapping of archive path -> file bytes.
+    Returns the archive and the largest file alignment in it
+    """
     arc = SarcLib.SARC_Archive(endianness=endianness)
-    lenroot = len(root.split("/"))
 
-    for path, dirs, files in os.walk(root):
-        if "\\" in path:
-            path = "/".join(path.split("\\"))
+    for filename, inb in mapping.items():
+        # Only full paths are stored in the archive, so files don't need to be put in folders
+        hasFilename = True
+        if filename.split("/")[-1][:5] == "hash_":
+            hasFilename = False
 
-        lenpath = len(path.split("/"))
+        arc.addFile(SarcLib.File(filename, bytes(inb), hasFilename))
 
-        if lenpath == lenroot:
-            path = ""
+    return arc.save()
 
-        else:
-            path = "/".join(path.split("/")[lenroot - lenpath:])
 
-        for file in files:
-            if path:
-                filename = ''.join([path, "/", file])
+def build_archive(mapping, endianness='>', level=-1):
+    """
+    Build a SARC archive from a mapping of archive path -> file bytes, Yaz0 compressed with the given level (-1 for no compression)
+    """
+    data, maxAlignment = build_sarc(mapping, endianness)
 
-            else:
-                filename = file
+    if level == -1:
+        return data
 
-            # print(filename)
+    if not 0 <= level <= 9:
+        raise ValueError("Invalid compression level: %d (expected 0-9)" % level)
 
-            fullname = ''.join([root, "/", filename])
+    with Trace.span('yaz0_compress', level=level, uncompressed_bytes=len(data)):
+        return bytes(libyaz0.compress(data, maxAlignment, level))
 
-            i = 0
-            for folder in filename.split("/")[:-1]:
-                if not i:
-                    exec("folder%i = SarcLib.Folder(folder + '/'); arc.addFolder(folder%i)".replace('%i', str(i)))
 
-                else:
-                    exec("folder%i = SarcLib.Folder(folder + '/'); folder%m.addFolder(folder%i)".replace('%i', str(i)).replace('%m', str(i - 1)))
+def extract(file, outname):
+    """
+    Extrct the given archive
+    """
+    inb, mapped = _read_decompressed(file)
 
-                i += 1
+    name = os.path.splitext(file)[0]
+    ext = SarcLib.guessFileExt(inb)
 
-            with open(fullname, "rb") as f:
-                inb = f.read()
+    if ext != ".sarc":
+        with open(''.join([name, ext]), "wb") as out:
+            out.write(inb)
 
-            hasFilename = True
-            if file[:5] == "hash_":
-                hasFilename = False
+        if mapped is not None:
+            mapped.close()
 
-            if not i:
-                arc.addFile(SarcLib.File(file, inb, hasFilename))
+    else:
+        root = outname if outname != "" else os.path.join(os.path.dirname(file), name)
 
-            else:
-                exec("folder%m.addFile(SarcLib.File(file, inb, hasFilename))".replace('%m', str(i - 1)))
+        with Archive(inb, mapped) as arc:
+            for filename, fileData in arc.iter_entries():
+                path = os.path.join(root, filename)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as out:
+                    out.write(fileData)
+
+                fileData.release()
 
-    data, maxAlignment = arc.save()
 
-    if level != -1:
-        outData = libyaz0.compress(data, maxAlignment, level)
-        del data
+def pack(root, endianness, level, outname):
+    """
+    Pack the files and folders in the root folder.
+    """
 
-        if not outname:
-            outname = ''.join([root, ".szs"])
+    if "\\" in root:
+        root = "/".join(root.split("\\"))
 
-    else:
-        outData = data
-        if not outname:
-            outname = ''.join([root, ".sarc"])
+    if root[-1] == "/":
+        root = root[:-1]
+
+    mapping = {}
+    for path, dirs, files in os.walk(root):
+        for file in files:
+            fullname = os.path.join(path, file)
+            filename = "/".join(os.path.relpath(fullname, root).split(os.sep))
+
+            with open(fullname, "rb") as f:
+                mapping[filename] = f.read()
+
+    outData = build_archive(mapping, endianness, level)
+
+    if not outname:
+        outname = ''.join([root, ".sarc" if level == -1 else ".szs"])
 
     with open(outname, "wb+") as output:
         output.write(outData)
@@ -204,9 +261,6 @@ def printInfo():
     print(" -compress <level>     Yaz0 (SZS) compress the output with the specified level(0-9) (1 is the default)")
     print("                       0: No compression (Fastest)")
     print("                       9: Best compression (Slowest)")
-    print("\nExiting in 5 seconds...")
-    time.sleep(5)
-    sys.exit(1)
 
 
 def main(args):
@@ -215,6 +269,7 @@ def main(args):
 
     if len(args) < 2:
         printInfo()
+        raise ValueError("Expected options and a file or folder, got: %s" % args)
 
     if "-o" in args:
         outname = args[args.index("-o") + 1]
@@ -240,17 +295,11 @@ def main(args):
                 level = 1
 
             if not 0 <= level <= 9:
-                print("Invalid compression level!\n")
-                print("Exiting in 5 seconds...")
-                time.sleep(5)
-                sys.exit(1)
+                raise ValueError("Invalid compression level: %d (expected 0-9)" % level)
 
         pack(root, endianness, level, outname)
 
     else:
-        print(f"File/Folder doesn't exist! {args}")
-        print("\nExiting in 5 seconds...")
-        time.sleep(5)
-        sys.exit(1)
+        raise FileNotFoundError(f"File/Folder doesn't exist! {args}")
 
 # if __name__ == '__main__': main()
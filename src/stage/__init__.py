@@ -1,4 +1,4 @@
 from src.stage.scenario import Scenario
 from src.stage.area import Area, DeathArea, ChangeStageArea, WaterArea
-from src.stage.object import ObjectFactory, Object, Components, LinkSet
+from src.stage.object import ObjectFactory, Object, PlacedCollision, Components, LinkSet
 from src.stage.scenario_start_camera import ScenarioStartCamera
\ No newline at end of file
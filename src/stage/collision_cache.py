@@ -0,0 +1,76 @@
+import hashlib
+import os
+import tempfile
+from src.file_format import KCL
+
+class CollisionCache:
+    """ Compiled collision data (see KCL.load_compiled) stored on disk and keyed by the content hash of the source ObjectData/*.szs,
+        so the SZS extraction and KCL parsing is paid once per romfs instead of once per run. """
+
+    def __init__(self, cache_dir: str):
+        self.__dir = os.path.join(cache_dir, 'collision', f'v{KCL.COMPILED_VERSION}')
+        self.__recorded_aabb_tree_usage = set()
+
+    @staticmethod
+    def key(szs_path: str):
+        h = hashlib.sha256()
+        with open(szs_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def __path(self, key: str):
+        return os.path.join(self.__dir, f'{key}.kclc')
+
+    def load(self, key: str, backend: str):
+        path = self.__path(key)
+        if not os.path.exists(path):
+            return None
+        return KCL.load_compiled(path, backend=backend)
+
+    def store(self, key: str, collision_data: KCL.CollisionData):
+        self.__write_atomic(self.__path(key), collision_data.write_compiled)
+
+    def __distance_field_path(self, key: str, voxel_size: float, band: float):
+        return os.path.join(self.__dir, f'{key}-sdf-{voxel_size:g}-{band:g}.bin')
+
+    def load_distance_field(self, key: str, voxel_size: float, band: float):
+        path = self.__distance_field_path(key, voxel_size, band)
+        if not os.path.exists(path):
+            return None
+        return KCL.DistanceField.read(path)
+
+    def store_distance_field(self, key: str, voxel_size: float, band: float, distance_field: KCL.DistanceField):
+        self.__write_atomic(self.__distance_field_path(key, voxel_size, band), distance_field.write)
+
+    def __aabb_tree_usage_path(self):
+        return os.path.join(self.__dir, 'aabb_tree_usage.txt')
+
+    def record_aabb_tree_usage(self, key: str):
+        """ Remember that the object with this key needed an AABB tree, so warm-up knows which objects are worth the tree-dependent work """
+        if key in self.__recorded_aabb_tree_usage:
+            return
+        self.__recorded_aabb_tree_usage.add(key)
+        os.makedirs(self.__dir, exist_ok=True)
+        with open(self.__aabb_tree_usage_path(), 'a') as f:
+            f.write(key + '\n')
+
+    def get_aabb_tree_usage(self):
+        """ Keys of all objects that ever needed an AABB tree, None if nothing has been recorded yet """
+        path = self.__aabb_tree_usage_path()
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def __write_atomic(self, path: str, write):
+        os.makedirs(self.__dir, exist_ok=True)
+        # Write to a temp file first so an interrupted run never leaves a truncated entry behind
+        fd, tmp_path = tempfile.mkstemp(dir=self.__dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -2,9 +2,9 @@ import byml
 import copy
 from dataclasses import dataclass
 import json
+import numpy as np
 import os
 import uuid
-import tempfile
 import typing
 import time
 from typing import List
@@ -13,8 +13,10 @@ from src.stage.proto import math_pb2, stage_pb2
 from src.stage.serializer import SerializerContext
 from src.math import AABB, Vec
 from src import sarc_tool
-from src.file_format import KCL
+from src.file_format import KCL, SZS
+from src.stage.collision_cache import CollisionCache
 from src.config import GlobalConfig
+from src.profiling import Trace
 
 Y_OFFSET = 582 # No clue why this offset is needed by it works
 
@@ -45,8 +47,6 @@ class Object:
         self.__components = components
         self.__linkset = linkset
 
-        self.__update_object_file_if_needed(obj_name)
-
         self._obj_pb = stage_pb2.StageObject()
 
         self._obj_pb.id = Object.__get_next_object_id()
@@ -103,6 +103,10 @@ class Object:
         self._obj_pb.is_link_dest = is_link_dest
 
     def to_proto(self, ctx: SerializerContext):
+        # Only objects that end up in a stage get serialized, so candidates the generator rejected never touch the output romfs
+        self.__update_object_file_if_needed(self.name())
+        # Shared objects such as the start camera rails get serialized once per stage, rebuild the components instead of appending again
+        self._obj_pb.ClearField('components')
         self._obj_pb.components.extend([component.to_proto(ctx) for component in self.__components])
         if self.name() != 'GroupView': # Prevent infinite recursion on view group since it's a default link
             self._obj_pb.links.CopyFrom(self.linkset().to_proto(ctx))
@@ -138,6 +142,30 @@ class Object:
     def test_collision(self, sphere_center: Vec, sphere_radius: Vec):
         adjusted_sphere_center = sphere_center - self.pos() # Shift sphere center to compensate for translation on object, since collision geometry assumes the object is at the origin
         return self.get_collision().intersects(adjusted_sphere_center, sphere_radius)
+
+    def placed_collision(self):
+        return PlacedCollision(self.name(), self.pos())
+
+    def test_collision_any(self, sphere_centers: np.ndarray, sphere_radius: float):
+        return self.placed_collision().test_collision_any(sphere_centers, sphere_radius)
+
+    def test_collision_capsules(self, starts: np.ndarray, ends: np.ndarray, radii):
+        return self.placed_collision().test_collision_capsules(starts, ends, radii)
+
+    def collision_aabb(self):
+        return self.placed_collision().collision_aabb()
+
+    def collision_distances(self, points: np.ndarray):
+        return self.placed_collision().collision_distances(points)
+
+    @staticmethod
+    def get_id_checkpoint():
+        return Object.__next_object_id
+
+    @staticmethod
+    def restore_id_checkpoint(checkpoint: int):
+        """ Hand out ids from checkpoint again, e.g. after creating objects that were never added to the stage """
+        Object.__next_object_id = checkpoint
     
     __OBJECTS_UPDATED = set()
     def __update_object_file_if_needed(self, obj_name: str):
@@ -157,44 +185,28 @@ class Object:
         Object.__OBJECTS_UPDATED.add(obj_name)
         print(f'Updating pose on {obj_name}...')
 
-        def extract_szs(input_file: str, output_dir: str):
-            sarc_tool.main(['-o', output_dir, input_file])
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            extract_szs(os.path.join(GlobalConfig.args.input_romfs_path, f'ObjectData/{obj_name}.szs'), tmpdir)
-            
-            def convert_byml_to_yaml(input_file: str):
-                with open(input_file, 'rb') as f:
-                    parser = byml.Byml(bytearray(f.read()))
-                    return parser.parse()
-                
-            def pack_szs(input_dir: str, output_file: str):
-                out_dir = os.path.dirname(output_file)
-                if out_dir != '' and not os.path.exists(out_dir):
-                    os.makedirs(os.path.dirname(output_file))
-                sarc_tool.main(['-o', output_file, '-compress', '9', input_dir])
-
-            def convert_byml_to_yaml(input_file: str):
-                with open(input_file, 'rb') as f:
-                    parser = byml.Byml(bytearray(f.read()))
-                    return parser.parse()
-                
-            def convert_yaml_to_byml(yml: dict, output_file: str):
-                with open(output_file, 'wb+') as f:
-                    writer = byml.Writer(yml, be=True)
-                    writer.write(f)
-            
-            yml = convert_byml_to_yaml(os.path.join(tmpdir, 'InitPose.byml'))
-            yml['Pose'] = 'TQSV' # Needed for KeyMoveMapParts to prevent quaternion slerp crash
-            convert_yaml_to_byml(yml, os.path.join(tmpdir, 'InitPose.byml'))
+        def convert_byml_to_yaml(data: bytes):
+            parser = byml.Byml(bytearray(data))
+            return parser.parse()
+
+        def convert_yaml_to_byml(yml: dict):
+            writer = byml.Writer(yml, be=True)
+            return writer.get_bytes()
 
+        with Trace.span('update_object_file', object=obj_name):
+            files = SZS.read(os.path.join(GlobalConfig.args.input_romfs_path, f'ObjectData/{obj_name}.szs'))
+
+            yml = convert_byml_to_yaml(files['InitPose.byml'])
+            yml['Pose'] = 'TQSV' # Needed for KeyMoveMapParts to prevent quaternion slerp crash
+            files['InitPose.byml'] = convert_yaml_to_byml(yml)
 
-            yml = convert_byml_to_yaml(os.path.join(tmpdir, 'InitClipping.byml'))
+            yml = convert_byml_to_yaml(files['InitClipping.byml'])
             if 'Radius' in yml:
                 yml = {'Radius': byml.byml.Float(5 * yml['Radius'])}
-            convert_yaml_to_byml(yml, os.path.join(tmpdir, 'InitClipping.byml'))
+            files['InitClipping.byml'] = convert_yaml_to_byml(yml)
 
-            pack_szs(tmpdir, os.path.join(GlobalConfig.args.output_romfs_path, f'ObjectData/{obj_name}.szs'))
+            # Kingdoms generated in parallel may update the same object, SZS.write never leaves a partial archive for them to read
+            SZS.write(os.path.join(GlobalConfig.args.output_romfs_path, f'ObjectData/{obj_name}.szs'), files)
 
             print(f'Updated pose to TQSV on {obj_name}')
 
@@ -457,9 +469,58 @@ class LinkSet:
             **o,
         )
 
+class PlacedCollision:
+    """ An object's collision at its stage position and nothing else of the object. Cheap to pickle,
+        so collision checks can run in worker processes that load the collision from their own ObjectFactory cache. """
+
+    def __init__(self, obj_name: str, pos: Vec):
+        self.__obj_name = obj_name
+        self.__pos = pos
+
+    def name(self):
+        return self.__obj_name
+
+    def pos(self):
+        return self.__pos
+
+    def get_collision(self):
+        return ObjectFactory.get_collision(self.__obj_name)
+
+    def test_collision_any(self, sphere_centers: np.ndarray, sphere_radius: float):
+        """ Batched test_collision over N×3 world-space sphere centers, e.g. a whole jump trajectory """
+        return self.get_collision().intersects_any(np.asarray(sphere_centers) - self.__pos.get_data(), sphere_radius)
+
+    def test_collision_capsules(self, starts: np.ndarray, ends: np.ndarray, radii):
+        """ Batched capsule test over N×3 world-space segment start and end points, e.g. a whole jump trajectory """
+        pos = self.__pos.get_data()
+        return self.get_collision().capsules_intersect_any(np.asarray(starts) - pos, np.asarray(ends) - pos, radii)
+
+    def collision_aabb(self):
+        """ World space AABB of this object's collision """
+        return self.get_collision().get_model_aabb().translate(self.__pos)
+
+    def collision_distances(self, points: np.ndarray):
+        """ Distance from each of the N×3 world-space points to this object's collision """
+        return self.get_collision().distances(np.asarray(points) - self.__pos.get_data())
+
 class ObjectFactory:
 
     __COLLISION_CACHE = {}
+    __COMPILED_COLLISION_CACHE = None
+    __COLLISION_LOAD_SECONDS = 0.0
+
+    @staticmethod
+    def get_collision_load_seconds():
+        """ Time this process spent loading object collisions, including cache hits from disk """
+        return ObjectFactory.__COLLISION_LOAD_SECONDS
+
+    @staticmethod
+    def get_compiled_collision_cache():
+        if not GlobalConfig.args.cache_dir:
+            return None
+        if ObjectFactory.__COMPILED_COLLISION_CACHE is None:
+            ObjectFactory.__COMPILED_COLLISION_CACHE = CollisionCache(GlobalConfig.args.cache_dir)
+        return ObjectFactory.__COMPILED_COLLISION_CACHE
 
     @staticmethod
     def get_collision(obj_name: str):
@@ -469,29 +530,53 @@ class ObjectFactory:
         if GlobalConfig.args is None:
             return None
 
-        def extract_szs(input_file: str, output_dir: str):
-            sarc_tool.main(['-o', output_dir, input_file])
-
         def get_collision_data(filepath):
             if not filepath.endswith('.szs'):
                 return None
             if not os.path.exists(filepath):
                 return None
-            with tempfile.TemporaryDirectory() as tmpdir:
-                extract_szs(filepath, tmpdir)
-                collision_data = None
-                for kcl_file in os.listdir(tmpdir):
-                    if not kcl_file.endswith('.kcl'):
-                        continue
-                
-                    new_collision_data = KCL.get_collision_data(os.path.join(tmpdir, kcl_file))
+
+            compiled_cache = ObjectFactory.get_compiled_collision_cache()
+            cache_key = CollisionCache.key(filepath) if compiled_cache is not None else None
+
+            collision_data = None
+            if compiled_cache is not None:
+                collision_data = compiled_cache.load(cache_key, backend=GlobalConfig.args.collision_backend)
+            if collision_data is None:
+                collision_data = extract_collision_data(filepath)
+                if compiled_cache is not None and collision_data is not None:
+                    compiled_cache.store(cache_key, collision_data)
+            if collision_data is None:
+                return None
+
+            collision_data.merge_aabb_trees()
+            if compiled_cache is not None:
+                collision_data.set_on_aabb_tree_built(lambda: compiled_cache.record_aabb_tree_usage(cache_key))
+
+            if GlobalConfig.args.distance_field:
+                voxel_size, band = GlobalConfig.args.distance_field_voxel_size, KCL.DistanceField.DEFAULT_BAND
+                distance_field, on_build = None, None
+                if compiled_cache is not None:
+                    distance_field = compiled_cache.load_distance_field(cache_key, voxel_size, band)
+                    on_build = lambda built_distance_field: compiled_cache.store_distance_field(cache_key, voxel_size, band, built_distance_field)
+                collision_data.enable_distance_field(voxel_size, band, distance_field=distance_field, on_build=on_build)
+            return collision_data
+
+        def extract_collision_data(filepath):
+            collision_data = None
+            with sarc_tool.open_archive(filepath) as archive:
+                for _, kcl_data in sorted(archive.iter_entries('*.kcl'), key=lambda entry: entry[0]):
+                    new_collision_data = KCL.parse_collision_data(kcl_data, backend=GlobalConfig.args.collision_backend)
                     if collision_data is None:
                         collision_data = new_collision_data
                     else:
                         collision_data = collision_data.union(new_collision_data)
-                return collision_data
+            return collision_data
 
-        collision = get_collision_data(os.path.join(GlobalConfig.args.input_romfs_path, f'ObjectData/{obj_name}.szs'))
+        start = time.perf_counter()
+        with Trace.span('load_collision', object=obj_name):
+            collision = get_collision_data(os.path.join(GlobalConfig.args.input_romfs_path, f'ObjectData/{obj_name}.szs'))
+        ObjectFactory.__COLLISION_LOAD_SECONDS += time.perf_counter() - start
         ObjectFactory.__COLLISION_CACHE[obj_name] = collision
         return collision
     
@@ -0,0 +1,95 @@
+import byml
+from google.protobuf.descriptor import Descriptor, FieldDescriptor
+
+class BymlEncoder:
+    """ Converts stage protobuf messages to the node tree byml.Writer takes (dicts, lists, str, bool, byml Int/Float) in a single walk.
+        Field keys and component handling are worked out once per message type from its descriptor. """
+
+    COMPONENTS_FIELD_NAME = 'components'
+
+    class __Plan:
+        """ How to encode one message type. Every field is written, scalars and lists with their defaults if unset. """
+
+        def __init__(self, descriptor: Descriptor, in_component: bool):
+            self.defaults = {} # byml key -> default value of unset scalar fields
+            self.list_keys = [] # byml keys of repeated fields, empty lists if unset
+            self.fields = {} # field name -> (byml key, value encoder, is repeated)
+            self.components_key = None
+
+            for field in descriptor.fields:
+                key = BymlEncoder.to_byml_key(field.name)
+                if in_component:
+                    # Component values used to be renamed twice, which drops escape underscores (NoDelete_Shine -> NoDeleteShine).
+                    # Kept so the output stays byte-identical.
+                    key = BymlEncoder.to_byml_key(key)
+                is_repeated = field.label == FieldDescriptor.LABEL_REPEATED
+                if field.name == BymlEncoder.COMPONENTS_FIELD_NAME and is_repeated and field.message_type is not None:
+                    self.components_key = key
+                    value_encoder = BymlEncoder.encode_component
+                elif field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+                    value_encoder = BymlEncoder.encode_component_value if in_component else BymlEncoder.encode
+                else:
+                    value_encoder = BymlEncoder.SCALAR_ENCODERS.get(field.cpp_type)
+                    if value_encoder is None:
+                        raise Exception(f'Unsupported field type for byml: {descriptor.full_name}.{field.name}')
+                    if not is_repeated:
+                        self.defaults[key] = value_encoder(field.default_value)
+                if is_repeated:
+                    self.list_keys.append(key)
+                self.fields[field.name] = (key, value_encoder, is_repeated)
+
+    SCALAR_ENCODERS = {
+        FieldDescriptor.CPPTYPE_BOOL: bool,
+        FieldDescriptor.CPPTYPE_INT32: byml.byml.Int,
+        FieldDescriptor.CPPTYPE_UINT32: byml.byml.Int,
+        FieldDescriptor.CPPTYPE_FLOAT: byml.byml.Float,
+        FieldDescriptor.CPPTYPE_DOUBLE: byml.byml.Float,
+        FieldDescriptor.CPPTYPE_STRING: str,
+    }
+
+    __PLANS = {} # (message full name, in component) -> __Plan
+
+    @staticmethod
+    def to_byml_key(field_name: str):
+        """ snake_case field name to the PascalCase byml key, a double underscore escapes an underscore (no_delete__shine -> NoDelete_Shine) """
+        return ''.join('_' if word == '' else word[0].upper() + word[1:] for word in field_name.split('_'))
+
+    @staticmethod
+    def encode(message):
+        return BymlEncoder.__encode(message, False)
+
+    @staticmethod
+    def encode_component_value(message):
+        return BymlEncoder.__encode(message, True)
+
+    @staticmethod
+    def encode_component(component):
+        """ {OneofKey: values} of a Component message """
+        return {BymlEncoder.to_byml_key(field.name): BymlEncoder.encode_component_value(value) for field, value in component.ListFields()}
+
+    @staticmethod
+    def __get_plan(descriptor: Descriptor, in_component: bool):
+        plan_key = (descriptor.full_name, in_component)
+        if plan_key not in BymlEncoder.__PLANS:
+            BymlEncoder.__PLANS[plan_key] = BymlEncoder.__Plan(descriptor, in_component)
+        return BymlEncoder.__PLANS[plan_key]
+
+    @staticmethod
+    def __encode(message, in_component: bool):
+        plan = BymlEncoder.__get_plan(message.DESCRIPTOR, in_component)
+        node = dict(plan.defaults)
+        for key in plan.list_keys:
+            node[key] = []
+        # ListFields skips unset fields, so unset messages stay absent like in the proto3 JSON mapping
+        for field, value in message.ListFields():
+            key, value_encoder, is_repeated = plan.fields[field.name]
+            node[key] = [value_encoder(v) for v in value] if is_repeated else value_encoder(value)
+
+        if plan.components_key is not None:
+            # Component values are also written flat on the object. Its own fields win, then the first component with a key.
+            for component in node[plan.components_key]:
+                for values in component.values():
+                    for key, value in values.items():
+                        if key not in node:
+                            node[key] = value
+        return node